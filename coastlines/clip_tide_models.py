@@ -0,0 +1,128 @@
+import os
+from pathlib import Path
+
+import click
+import xarray as xr
+from eo_tides.utils import _standardise_models, clip_models
+
+from coastlines.utils import (
+    click_config_path,
+    configure_logging,
+    load_config,
+    load_json,
+    subset_tiles,
+)
+
+
+def get_tide_model_names(
+    tide_model: str, directory: str, ensemble_model_list: list[str] | None = None
+) -> list[str]:
+    """The tide models that need files, including each ensemble member"""
+    models_to_process, _, _ = _standardise_models(
+        tide_model, directory, ensemble_model_list
+    )
+    return models_to_process
+
+
+def get_modified_times(directory: Path) -> dict[Path, int]:
+    """The modification time of each NetCDF file under `directory`"""
+    return {path: path.stat().st_mtime_ns for path in directory.rglob("*.nc")}
+
+
+def compress_netcdf(path: Path, complevel: int = 4) -> bool:
+    """
+    Rewrite a NetCDF file with compressed, chunked numeric variables,
+    keeping the original when that isn't smaller. Returns whether the file
+    was replaced.
+    """
+    with xr.open_dataset(path, decode_cf=False) as ds:
+        ds = ds.load()
+
+    encoding = {
+        name: {"zlib": True, "complevel": complevel, "shuffle": True}
+        for name, variable in ds.variables.items()
+        if variable.dtype.kind in "iuf" and variable.ndim > 0
+    }
+
+    tmp_path = path.with_suffix(".tmp.nc")
+    ds.to_netcdf(tmp_path, engine="netcdf4", encoding=encoding)
+
+    # Very small clips can grow, as NetCDF4 files have more overhead
+    if tmp_path.stat().st_size >= path.stat().st_size:
+        tmp_path.unlink()
+        return False
+
+    os.replace(tmp_path, path)
+    return True
+
+
+@click.command("coastlines-clip-tide-models")
+@click_config_path
+@click.option("--tide-data-location", type=str, required=True)
+@click.option(
+    "--output-location",
+    type=str,
+    required=True,
+    help="The local directory to write the clipped tide models to. Pass it "
+    "as `--tide-data-location` to the other commands to use them.",
+)
+@click.option("--tiles-subset", type=str, default="[]")
+@click.option(
+    "--margin",
+    type=float,
+    default=5.0,
+    help="How far around the tiles to keep tide model data, in degrees. "
+    "Defaults to 5.",
+)
+@click.option("--overwrite/--no-overwrite", default=False)
+def cli(
+    config_path: str,
+    tide_data_location: str,
+    output_location: str,
+    tiles_subset: str,
+    margin: float,
+    overwrite: bool,
+) -> None:
+    config = load_config(config_path, "coastlines")
+    log = configure_logging("Coastlines clip tide models")
+
+    tiles = load_json(config.input.grid_path)
+
+    tiles = subset_tiles(tiles, tiles_subset)
+
+    models = get_tide_model_names(
+        config.options.tide_model,
+        tide_data_location,
+        config.options.ensemble_model_list,
+    )
+    bbox = tuple(tiles.total_bounds)
+    log.info(f"Clipping {', '.join(models)} to {bbox} plus {margin} degrees")
+
+    output_location = Path(output_location)
+    modified_before = get_modified_times(output_location)
+    clip_models(
+        tide_data_location,
+        output_location,
+        bbox,
+        model=models,
+        buffer=margin,
+        overwrite=overwrite,
+    )
+
+    # clip_models writes uncompressed files, so shrink the ones it wrote,
+    # including existing files it overwrote
+    modified_after = get_modified_times(output_location)
+    written = [
+        path
+        for path, modified in modified_after.items()
+        if modified_before.get(path) != modified
+    ]
+    for path in sorted(written):
+        if compress_netcdf(path):
+            log.info(f"Compressed {path}")
+
+    log.info(f"Wrote clipped tide models to {output_location}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,23 +2,56 @@ import sys
 from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, Union
+from typing import Callable, Tuple, Union
 
 import click
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import xarray as xr
 from datacube.utils.dask import start_local_dask
-from eo_tides.eo import pixel_tides
-from dea_tools.spatial import hillshade, subpixel_contours
-from odc.algo import mask_cleanup, to_f32
+from dea_tools.spatial import subpixel_contours
+from odc.algo import to_f32
+from odc.geo.geobox import GeoBox
 from odc.stac import configure_s3_access, load
-from pystac import ItemCollection
+from pystac import Item
 from pystac_client import Client
 from s3path import S3Path
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
 
+from coastlines.composites import CompositeStore, sliding_yearly_composites
 from coastlines.config import CoastlinesConfig
+from coastlines.grids import get_tile_geobox
+from coastlines.kernels import fused_water_index, median_count_std
+from coastlines.masks import ObservationMask
+from coastlines.morphology import xr_cleanup_masks
+from coastlines.read_cache import CachingRioDriver, ChunkCache
+from coastlines.stac import (
+    CachedCatalog,
+    SceneRecord,
+    SnapshotCatalog,
+    StacSearchCache,
+    footprint_coverage,
+    get_search_fields,
+    is_grid_aligned,
+    read_item_snapshot,
+    select_scenes,
+    slim_item,
+    solar_day,
+    solar_day_coverage,
+)
 
-# from dea_tools.datahandling import parallel_apply  # Needs a PR merged
+from coastlines.terrain import (
+    DEM_STAC_CATALOG,
+    DEM_STAC_COLLECTION,
+    DemCache,
+    iter_terrain_shadow_masks,
+    load_dem,
+    terrain_shadow_masks,
+)
+from coastlines.tide_service import TideServiceClient
+from coastlines.tides import TideContext, TideStore
 from coastlines.utils import (
     CoastlinesException,
     click_config_path,
@@ -30,7 +63,6 @@ from coastlines.utils import (
     get_study_site_geometry,
     is_s3,
     load_config,
-    parallel_apply,
     tide_cutoffs,
 )
 from coastlines.vector import (
@@ -54,6 +86,14 @@ STAC_CFG = {
 }
 
 
+# Landsat QA_PIXEL bits for cloud (3) and cloud shadow (4)
+CLOUD_BITMASK = (1 << 3) | (1 << 4)
+# Landsat QA_PIXEL bit for fill (0)
+FILL_BITMASK = 1 << 0
+# DE Africa uses 10 and 5, which Alex doesn't like!
+CLOUD_MASK_FILTERS = [("opening", 5), ("dilation", 6)]
+
+
 # TODO: Make this changeable...
 def http_to_s3_url(http_url):
     """Convert a USGS HTTP URL to an S3 URL"""
@@ -101,43 +141,112 @@ def get_output_path(
     return output_path
 
 
-def load_and_mask_data_with_stac(
-    config: CoastlinesConfig,
-    query: dict,
-    include_nir: bool = False,
-    include_awei: bool = False,
-    include_wi: bool = False,
-    debug: bool = False,
-) -> xr.Dataset:
-    lower_limit = config.stac.lower_scene_limit
-    upper_limit = config.stac.upper_scene_limit
-    index = config.options.water_index
+def get_bands(
+    include_nir: bool = False, include_awei: bool = False, include_wi: bool = False
+) -> list[str]:
+    bands = ["green", "swir16", "qa_pixel"]
 
-    if index not in ["mndwi", "ndwi", "combined", "mndwi_nir"]:
-        raise CoastlinesException(
-            f"Unknown water index: {index}. Must be one of 'mndwi', 'ndwi', 'combined' or 'mndwi_nir'"
+    if include_nir:
+        bands.append("nir08")
+
+    if include_awei:
+        bands = bands + ["swir22", "blue"]
+
+    if include_wi:
+        bands.append("red")
+
+    return bands
+
+
+def get_snapshot_path(snapshot_location: str, tile_id: str) -> str:
+    """The path to a tile's prefetched STAC item snapshot"""
+    return f"{snapshot_location.rstrip('/')}/items_{sanitise_tile_id(tile_id)}.json"
+
+
+def get_load_area(
+    config: CoastlinesConfig, geometry: gpd.GeoDataFrame
+) -> BaseGeometry:
+    """The study area geometry in EPSG:4326, including the load buffer"""
+    return (
+        geometry.to_crs(config.output.crs)
+        .buffer(config.options.load_buffer_distance)
+        .to_crs("epsg:4326")
+        .iloc[0]
+    )
+
+
+def get_query(config: CoastlinesConfig, geometry: gpd.GeoDataFrame) -> dict:
+    """The STAC search parameters for a study area, including the load buffer"""
+    bbox = tuple(get_load_area(config, geometry).bounds)
+
+    return {
+        "bbox": bbox,
+        "datetime": f"{config.options.start_year - 1}/{config.options.end_year + 1}",
+    }
+
+
+def get_items_snapshot(config: CoastlinesConfig, study_area: str) -> str | None:
+    """The item snapshot configured for a study area, if there is one"""
+    if config.stac is None:
+        return None
+    if config.stac.items_snapshot is not None:
+        return config.stac.items_snapshot
+    if config.stac.snapshot_location is not None:
+        return get_snapshot_path(config.stac.snapshot_location, study_area)
+    return None
+
+
+def get_catalog(
+    config: CoastlinesConfig, study_area: str
+) -> CachedCatalog | SnapshotCatalog:
+    """Use an item snapshot if one is configured, otherwise the STAC API"""
+    snapshot_path = get_items_snapshot(config, study_area)
+    if snapshot_path is not None:
+        return SnapshotCatalog(read_item_snapshot(snapshot_path))
+
+    return get_stac_catalog(config)
+
+
+def get_stac_catalog(config: CoastlinesConfig) -> CachedCatalog:
+    """Open the STAC API, using the search cache if one is configured"""
+    cache = None
+    if config.stac.cache is not None:
+        cache = StacSearchCache(
+            config.stac.cache.location,
+            ttl_hours=config.stac.cache.ttl_hours,
+            max_size_mb=config.stac.cache.max_size_mb,
         )
 
-    client = Client.open(config.stac.stac_api_url)
+    return CachedCatalog(config.stac.stac_api_url, cache=cache)
+
+
+def get_read_cache(config: CoastlinesConfig) -> ChunkCache | None:
+    if config.stac.read_cache is None:
+        return None
 
+    return ChunkCache(
+        config.stac.read_cache.location,
+        max_size_mb=config.stac.read_cache.max_size_mb,
+    )
+
+
+def search_items_server_side(
+    catalog: CachedCatalog | SnapshotCatalog,
+    query: dict,
+    lower_limit: int,
+    upper_limit: int,
+    fields: list[str] | None = None,
+) -> list[Item]:
+    """Step the search down server-side until the number of items is within limits"""
     # Search for STAC Items. First for only T1 then for both T1 and T2
-    query["collections"] = config.stac.stac_collections
     query_filter = {"landsat:collection_category": {"in": ["T1"]}}
-    search = client.search(
-        query=query_filter,
-        **query,
-    )
-    n_items = search.matched()
+    n_items = catalog.matched(query_filter, **query)
 
     # If we don't have enough T1 items, search for T2 as well
     if n_items < lower_limit:
         query_filter = {}
         print("Warning, not enough T1 items found, searching for T2 items as well")
-        search = client.search(
-            query=query_filter,
-            **query,
-        )
-        n_items = search.matched()
+        n_items = catalog.matched(query_filter, **query)
 
     # If we have too many items, filter out some high-cloud scenes
     percentage = 100
@@ -148,11 +257,7 @@ def load_and_mask_data_with_stac(
             f"Warning, too many items found ({n_items} > {upper_limit}). Pre-filtering to {percentage}% clouds"
         )
 
-        search = client.search(
-            query=query_filter,
-            **query,
-        )
-        n_items = search.matched()
+        n_items = catalog.matched(query_filter, **query)
         if percentage == 50:
             break
 
@@ -162,28 +267,143 @@ def load_and_mask_data_with_stac(
             f"Found {n_items} items using both T1 and T2 scenes. This is not enough to do a reliable process."
         )
 
-    items = list(search.get_items())
+    return list(catalog.item_collection(query_filter, fields=fields, **query))
+
+
+def search_items_locally(
+    catalog: CachedCatalog | SnapshotCatalog,
+    query: dict,
+    lower_limit: int,
+    upper_limit: int,
+    fields: list[str] | None = None,
+) -> list[Item]:
+    """Fetch all candidate items in one search and pick scenes without more requests"""
+    candidates = list(catalog.item_collection({}, fields=fields, **query))
+    items = select_scenes(candidates, lower_limit, upper_limit)
+
+    if len(items) < lower_limit:
+        raise CoastlinesException(
+            f"Found {len(items)} items using both T1 and T2 scenes. This is not enough to do a reliable process."
+        )
+
+    return items
+
+
+def filter_items_by_clear_fraction(
+    items: list[Item], load_kwargs: dict, min_clear_fraction: float, bbox: tuple
+) -> list[Item]:
+    """
+    Load only the QA band, and keep items from the days where at least
+    `min_clear_fraction` of the pixels with data are cloud free. Fill
+    pixels, like scene edges and SLC-off gaps, are not counted as data.
+    Days without any data are dropped.
+    """
+    qa = load(items, bands=["qa_pixel"], **load_kwargs)["qa_pixel"]
+    # Areas outside the footprints (0) and fill pixels are nodata, not cloud
+    valid = (qa != 0) & (qa & FILL_BITMASK == 0)
+    clear = valid & (qa & CLOUD_BITMASK == 0)
+    clear_fraction = (clear.sum(dim=["x", "y"]) / valid.sum(dim=["x", "y"])).compute()
+
+    # Match load timestamps to solar days, using the centre of the area
+    left, _, right, _ = bbox
+    offset = pd.Timedelta(hours=(left + right) / 2 / 15)
+    times = pd.to_datetime(clear_fraction.time.values) + offset
+    clear_days = {
+        t.date()
+        for t, fraction in zip(times, clear_fraction.values)
+        if fraction >= min_clear_fraction
+    }
+
+    kept = [i for i in items if solar_day(i) in clear_days]
+    print(
+        f"Keeping {len(clear_days)} of {len(times)} timesteps ({len(kept)} of {len(items)} items) "
+        f"with at least {min_clear_fraction:.0%} clear pixels"
+    )
+
+    return kept
+
+
+def load_and_mask_data_with_stac(
+    config: CoastlinesConfig,
+    query: dict,
+    include_nir: bool = False,
+    include_awei: bool = False,
+    include_wi: bool = False,
+    debug: bool = False,
+    catalog: CachedCatalog | SnapshotCatalog | None = None,
+    area: BaseGeometry | None = None,
+    geobox: GeoBox | None = None,
+) -> xr.Dataset:
+    lower_limit = config.stac.lower_scene_limit
+    upper_limit = config.stac.upper_scene_limit
+    index = config.options.water_index
+
+    if index not in ["mndwi", "ndwi", "combined", "mndwi_nir"]:
+        raise CoastlinesException(
+            f"Unknown water index: {index}. Must be one of 'mndwi', 'ndwi', 'combined' or 'mndwi_nir'"
+        )
+
+    if catalog is None:
+        catalog = get_stac_catalog(config)
+
+    bands = get_bands(include_nir, include_awei, include_wi)
+
+    # Optionally only request the properties and assets that we use
+    fields = None
+    if config.stac.project_fields:
+        fields = get_search_fields(bands)
+
+    query["collections"] = config.stac.stac_collections
+    if config.stac.scene_selection == "local":
+        items = search_items_locally(catalog, query, lower_limit, upper_limit, fields)
+    else:
+        items = search_items_server_side(
+            catalog, query, lower_limit, upper_limit, fields
+        )
 
     # Hack to remove some bad items
     items = [i for i in items if i.id not in BAD_IDS]
 
-    epsg_codes = Counter(item.properties["proj:code"] for item in items)
-    epsg_code = epsg_codes.most_common(1)[0][0]
-
-    bands = ["green", "swir16", "qa_pixel"]
+    # Drop days whose scenes only clip a corner of the area we're loading.
+    # Scenes are grouped by solar day when loading, so adjacent rows count together
+    min_coverage = config.stac.min_footprint_coverage
+    if min_coverage > 0:
+        if area is None:
+            area = box(*query["bbox"])
+        day_coverage = solar_day_coverage(items, area)
+        kept = [i for i, c in zip(items, day_coverage) if c >= min_coverage]
+
+        if len(kept) < len(items):
+            n_dropped = len(items) - len(kept)
+            n_days = len({solar_day(i) for i in items} - {solar_day(i) for i in kept})
+            # Estimate uint16 pixels at 30 m over the whole area, for each band
+            area_series = gpd.GeoSeries([area], crs="epsg:4326")
+            area_m2 = area_series.to_crs(area_series.estimate_utm_crs()).area.iloc[0]
+            # Each dropped item would only have read the part of the area it covers
+            coverage = footprint_coverage(items, area)
+            dropped_coverage = sum(
+                c for c, d in zip(coverage, day_coverage) if d < min_coverage
+            )
+            n_bytes = dropped_coverage * len(bands) * 2 * area_m2 / (30 * 30)
+            print(
+                f"Dropped {n_dropped} items from days covering less than {min_coverage:.0%} of the area, "
+                f"avoiding {n_days} timesteps and about {n_bytes / 1e9:.1f} GB of reads"
+            )
+        items = kept
 
-    if include_nir:
-        bands.append("nir08")
+        if len(items) < lower_limit:
+            raise CoastlinesException(
+                f"Only {len(items)} items are from days covering at least {min_coverage:.0%} of the area. "
+                "This is not enough to do a reliable process."
+            )
 
-    if include_awei:
-        bands = bands + ["swir22", "blue"]
+    if config.stac.project_fields:
+        items = [slim_item(i, bands) for i in items]
 
-    if include_wi:
-        bands.append("red")
+    epsg_codes = Counter(item.properties["proj:code"] for item in items)
+    epsg_code = epsg_codes.most_common(1)[0][0]
 
-    ds = load(
-        items,
-        bands=bands,
+    load_kwargs = dict(
         **query,
         resampling={"qa_pixel": "nearest", "*": "average"},
         group_by="solar_day",
@@ -195,20 +415,58 @@ def load_and_mask_data_with_stac(
         fail_on_error=False,
     )
 
+    read_cache = get_read_cache(config)
+    if read_cache is not None:
+        load_kwargs["driver"] = CachingRioDriver(read_cache)
+
+    # Load onto a fixed tile grid rather than the most common UTM zone
+    if geobox is not None:
+        for key in ["bbox", "crs", "resolution"]:
+            del load_kwargs[key]
+        load_kwargs["geobox"] = geobox
+
+        aligned = [is_grid_aligned(i, geobox) for i in items]
+        reprojected = Counter(
+            i.properties.get("proj:code") for i, a in zip(items, aligned) if not a
+        )
+        n_reprojected = sum(reprojected.values())
+        n_pixels = n_reprojected * geobox.shape.x * geobox.shape.y * len(bands)
+        print(
+            f"{len(items) - n_reprojected} scenes are aligned with the {geobox.crs} grid "
+            f"and {n_reprojected} need reprojecting ({n_pixels / 1e9:.1f} billion pixels), "
+            f"from: {dict(reprojected)}"
+        )
+
+        # If nothing needs resampling, then reading is a straight copy
+        if n_reprojected == 0:
+            load_kwargs["resampling"] = "nearest"
+
+    # Optionally check the QA band first, and only read reflectance for clear days
+    if config.stac.min_clear_fraction > 0:
+        items = filter_items_by_clear_fraction(
+            items, load_kwargs, config.stac.min_clear_fraction, query["bbox"]
+        )
+
+    ds = load(items, bands=bands, **load_kwargs)
+
+    # Go straight from raw bands to the masked index, if we don't need the extras
+    if config.options.fused_index and not (debug or include_awei or include_wi):
+        ds = fused_water_index(
+            ds,
+            index,
+            CLOUD_BITMASK,
+            CLOUD_MASK_FILTERS,
+            include_nir=include_nir,
+        )
+        return ds, [SceneRecord.from_item(i) for i in items]
+
     # Get the nodata mask, just for the two main bands
     nodata_mask = (ds.green == 0) | (ds.swir16 == 0)
 
-    # Get cloud and cloud shadow mask
-    mask_bitfields = [3, 4]  # cloud, cloud shadow
-    bitmask = 0
-    for field in mask_bitfields:
-        bitmask |= 1 << field
-
     # Get cloud mask
-    cloud_mask = ds["qa_pixel"].astype(int) & bitmask != 0
+    cloud_mask = ds["qa_pixel"].astype(int) & CLOUD_BITMASK != 0
     # Expand and contract the mask to clean it up
-    # DE Africa uses 10 and 5, which Alex doesn't like!
-    dilated_cloud_mask = mask_cleanup(cloud_mask, [("opening", 5), ("dilation", 6)])
+    dilated_cloud_mask = xr_cleanup_masks(cloud_mask, CLOUD_MASK_FILTERS)
 
     # Convert to float and scale data to 0-1
     ds["green"] = to_f32(ds["green"], scale=0.0000275, offset=-0.2)
@@ -273,6 +531,9 @@ def load_and_mask_data_with_stac(
     final_mask = nodata_mask | dilated_cloud_mask | invalid_ard_values
     ds = ds.where(~final_mask)
 
+    # Only hold on to the few properties needed after loading
+    items = [SceneRecord.from_item(i) for i in items]
+
     # If we're not debugging, just return the necessary bands
     if not debug:
         return_bands = [index]
@@ -284,83 +545,95 @@ def load_and_mask_data_with_stac(
     return ds, items
 
 
-def terrain_shadow(
-    ds: xr.Dataset,
-    dem: xr.Dataset,
-    items_by_time: dict,
-    threshold: float = 0.25,
-    radius: int = 1,
-):
-    ds = ds.squeeze()
-    item = items_by_time[ds.time.values.astype(str).split(".")[0]]
-
-    elevation = item.properties["view:sun_elevation"]
-    azimuth = item.properties["view:sun_azimuth"]
-
-    hs = hillshade(dem, elevation, azimuth)
-    hs = hs < threshold
-    hs_da = xr.DataArray(hs, dims=["y", "x"])
-    hs_da = mask_cleanup(hs_da, [("opening", radius), ("dilation", radius)])
-
-    return hs_da
-
-
 def mask_pixels_by_hillshadow(
     ds: xr.Dataset,
-    items: ItemCollection,
-    stac_catalog: str = "https://earth-search.aws.element84.com/v1/",
-    stac_collection: str = "cop-dem-glo-30",
+    items: list[SceneRecord],
+    stac_catalog: str = DEM_STAC_CATALOG,
+    stac_collection: str = DEM_STAC_COLLECTION,
     debug: bool = False,
+    angle_tolerance: float = 0,
+    skip_unshadowed: bool = False,
+    dem_cache: DemCache | None = None,
+    observation_mask: ObservationMask | None = None,
+    dem: np.ndarray | None = None,
 ) -> xr.Dataset:
-    client = Client.open(stac_catalog)
-    bbox = list(ds.geobox.extent.to_crs("epsg:4326").boundingbox)
     items_by_time = {
         item.datetime.strftime("%Y-%m-%dT%H:%M:%S"): item for item in items
     }
 
-    dem_items = list(client.search(collections=[stac_collection], bbox=bbox).items())
+    if dem is None:
+        dem = load_dem(ds.odc.geobox, stac_catalog, stac_collection, dem_cache=dem_cache)
+
+    # Slope and aspect are shared, so all timesteps are masked together
+    time_items = [items_by_time[t.split(".")[0]] for t in ds.time.values.astype(str)]
+    elevation = np.array([item.sun_elevation for item in time_items])
+    azimuth = np.array([item.sun_azimuth for item in time_items])
+
+    # Pack the masks into the observation mask a block of timesteps at a time,
+    # without ever holding them all unpacked
+    if observation_mask is not None and not debug:
+        if not np.array_equal(observation_mask.time.values, ds.time.values):
+            raise ValueError("The observation mask is for different timesteps")
+        for start, masks, inverse in iter_terrain_shadow_masks(
+            dem,
+            elevation,
+            azimuth,
+            angle_tolerance=angle_tolerance,
+            skip_unshadowed=skip_unshadowed,
+        ):
+            observation_mask.mask_by_index(masks, inverse, start=start)
+        return ds
+
+    masks = terrain_shadow_masks(
+        dem,
+        elevation,
+        azimuth,
+        angle_tolerance=angle_tolerance,
+        skip_unshadowed=skip_unshadowed,
+    )
+    hillshadow = xr.DataArray(masks, dims=["time", "y", "x"], coords={"time": ds.time})
 
-    if len(dem_items) == 0:
-        raise CoastlinesException("No DEM items found.")
+    # Filter out the hill shaded pixels
+    if observation_mask is not None:
+        observation_mask.mask(hillshadow)
     else:
-        dem = load(dem_items, like=ds, measurements=["data"])
-
-        hillshadow = parallel_apply(
-            ds,
-            "time",
-            terrain_shadow,
-            use_threads=True,
-            dem=dem.squeeze().data.values,
-            items_by_time=items_by_time,
-        )
-
-        # Filter out the hill shaded pixels
         ds = ds.where(~hillshadow)
-        if debug:
-            return ds, hillshadow
+    if debug:
+        return ds, hillshadow
 
     return ds
 
 
 def mask_pixels_by_tide(
-    ds: xr.Dataset, tide_data_location: str, tide_centre: float, tide_model: str, ensemble_model_list: list[str], ensemble_model_rankings: str, debug: bool = False
+    ds: xr.Dataset, tide_data_location: str, tide_centre: float, tide_model: str, ensemble_model_list: list[str], ensemble_model_rankings: str, debug: bool = False, tide_context: TideContext | None = None, chunked: bool = False, observation_mask: ObservationMask | None = None
 ) -> xr.Dataset:
-    tides_lowres = pixel_tides(
-        ds, resample=False, directory=tide_data_location, dask_compute=True, model=tide_model, ensemble_models=ensemble_model_list, ranking_points=ensemble_model_rankings
-    )
+    if tide_context is None:
+        tide_context = TideContext.from_dataset(
+            ds, tide_data_location, tide_model, ensemble_model_list, ensemble_model_rankings
+        )
 
-    tides = pixel_tides(
-        ds, directory=tide_data_location, dask_compute=True, model=tide_model, ensemble_models=ensemble_model_list, ranking_points=ensemble_model_rankings
-    )
+    tides_lowres = tide_context.lowres(ds)
 
-    tide_cutoff_min, tide_cutoff_max = tide_cutoffs(
-        ds, tides_lowres, tide_centre=tide_centre, reproject=True
-    )
+    if chunked:
+        # Only ever build the boolean mask, one chunk at a time
+        tides = None
+        extreme_tides = tide_context.extreme_tide_mask(ds, tide_centre=tide_centre)
+        if ds.chunks is None or len(ds.chunks) == 0:
+            extreme_tides = extreme_tides.compute()
+    else:
+        tides = tide_context.highres(ds)
+
+        tide_cutoff_min, tide_cutoff_max = tide_cutoffs(
+            ds, tides_lowres, tide_centre=tide_centre, reproject=True
+        )
 
-    extreme_tides = (tides <= tide_cutoff_min) | (tides >= tide_cutoff_max)
+        extreme_tides = (tides <= tide_cutoff_min) | (tides >= tide_cutoff_max)
 
     # Filter out the extreme high- and low-tide pixels
-    ds = ds.where(~extreme_tides)
+    if observation_mask is not None:
+        observation_mask.mask(extreme_tides)
+    else:
+        ds = ds.where(~extreme_tides)
 
     if debug:
         return ds, tides, tides_lowres, extreme_tides
@@ -369,10 +642,14 @@ def mask_pixels_by_tide(
 
 
 def filter_by_tides(
-    ds: xr.Dataset, tide_data_location: str, tide_centre: float, tide_model: str, ensemble_model_list: list[str], ensemble_model_rankings: str
+    ds: xr.Dataset, tide_data_location: str, tide_centre: float, tide_model: str, ensemble_model_list: list[str], ensemble_model_rankings: str, tide_context: TideContext | None = None
 ) -> xr.Dataset:
     """Filter out scenes that are wholy covered by extreme tides"""
-    tides_lowres = pixel_tides(ds, resample=False, directory=tide_data_location, model=tide_model, ensemble_models=ensemble_model_list, ranking_points=ensemble_model_rankings)
+    if tide_context is None:
+        tide_context = TideContext.from_dataset(
+            ds, tide_data_location, tide_model, ensemble_model_list, ensemble_model_rankings
+        )
+    tides_lowres = tide_context.lowres(ds)
 
     tide_cutoff_min, tide_cutoff_max = tide_cutoffs(
         ds, tides_lowres, tide_centre=tide_centre, reproject=False
@@ -398,25 +675,38 @@ def get_one_year_composite(
     water_index: str = "mndwi",
     include_nir: bool = False,
     debug: bool = False,
+    observation_mask: ObservationMask | None = None,
+    parallel: bool = True,
 ) -> Tuple[int, xr.Dataset]:
     one_year = ds.sel(time=str(year))
     three_years = ds.sel(time=slice(str(year - 1), str(year + 1)))
 
-    # Get the median and other statistics for this year
-    year_summary = one_year[water_index].median(dim="time").to_dataset()
+    # Only mask the timesteps used for this year
+    if observation_mask is not None:
+        one_year = observation_mask.where(one_year)
+        three_years = observation_mask.where(three_years)
+
+    # Get the median and other statistics for this year, in one pass
+    median, count, stdev = median_count_std(one_year[water_index], parallel=parallel)
+    year_summary = median.to_dataset(name=water_index)
 
-    year_summary["count"] = one_year[water_index].count(dim="time")
-    year_summary["stdev"] = one_year[water_index].std(dim="time")
+    year_summary["count"] = count
+    year_summary["stdev"] = stdev
 
     # And a gapfill summary for the three years
-    year_summary[f"gapfill_{water_index}"] = three_years[water_index].median(dim="time")
-    year_summary["gapfill_count"] = three_years[water_index].count(dim="time")
-    year_summary["gapfill_stdev"] = three_years[water_index].std(dim="time")
+    median, count, stdev = median_count_std(
+        three_years[water_index], parallel=parallel
+    )
+    year_summary[f"gapfill_{water_index}"] = median
+    year_summary["gapfill_count"] = count
+    year_summary["gapfill_stdev"] = stdev
 
     # Optional extras
     if include_nir:
-        year_summary["nir"] = one_year.nir08.median(dim="time")
-        year_summary["gapfill_nir"] = three_years.nir08.median(dim="time")
+        year_summary["nir"] = median_count_std(one_year.nir08, parallel=parallel)[0]
+        year_summary["gapfill_nir"] = median_count_std(
+            three_years.nir08, parallel=parallel
+        )[0]
 
     if debug:
         year_summary["green"] = one_year.green.median(dim="time")
@@ -436,6 +726,62 @@ def get_one_year_composite(
     return year, year_summary
 
 
+def get_year_loader(
+    ds: xr.Dataset,
+    items: list[SceneRecord],
+    config: CoastlinesConfig,
+    tide_context: TideContext,
+    log: callable,
+) -> Callable[[int], tuple[xr.Dataset, ObservationMask]]:
+    """
+    A function that loads one year of the lazy dataset `ds` into memory,
+    with an observation mask of its extreme tide and terrain shadow pixels.
+
+    The tide cutoffs still come from the whole time series, and the DEM is
+    loaded once and shared by every year.
+    """
+    years = ds.time.dt.year.values
+    extreme_tides = tide_context.extreme_tide_mask(
+        ds, tide_centre=config.options.tide_centre
+    )
+
+    dem = None
+    if config.options.mask_with_hillshade:
+        dem_cache = None
+        if config.options.dem_cache_location is not None:
+            dem_cache = DemCache(config.options.dem_cache_location)
+        try:
+            dem = load_dem(
+                ds.odc.geobox,
+                config.options.hillshade_stac_catalog or DEM_STAC_CATALOG,
+                config.options.hillshade_stac_collection or DEM_STAC_COLLECTION,
+                dem_cache=dem_cache,
+            )
+        except CoastlinesException:
+            log.warning("No DEM found for this area. Skipping hillshadow mask")
+
+    def load_year(year: int) -> tuple[xr.Dataset, ObservationMask]:
+        index = np.flatnonzero(years == year)
+        log.info(f"Loading {len(index)} timesteps for {year} into memory")
+        one_year = ds.isel(time=index).compute()
+
+        observation_mask = ObservationMask(one_year)
+        observation_mask.mask(extreme_tides.isel(time=index))
+        if dem is not None and len(index) > 0:
+            mask_pixels_by_hillshadow(
+                one_year,
+                items,
+                angle_tolerance=config.options.hillshade_angle_tolerance,
+                skip_unshadowed=config.options.hillshade_skip_unshadowed,
+                observation_mask=observation_mask,
+                dem=dem,
+            )
+
+        return one_year, observation_mask
+
+    return load_year
+
+
 def generate_yearly_composites(
     ds: xr.Dataset,
     start_year: int,
@@ -444,6 +790,9 @@ def generate_yearly_composites(
     replace_with_gapfill: bool = True,
     include_nir: bool = False,
     debug: bool = False,
+    observation_mask: ObservationMask | None = None,
+    max_error: float | None = None,
+    load_year: Callable[[int], tuple[xr.Dataset, ObservationMask]] | None = None,
 ) -> xr.Dataset:
     # Store a list of output arrays and years, knowing we might lose empty years
     yearly_ds_list = []
@@ -453,23 +802,41 @@ def generate_yearly_composites(
     # This range includes only the years we want to process...
     years = range(start_year, end_year + 1)
 
-    # Define a function to be executed in each thread
-    def process_year(year):
-        try:
-            year, year_summary = get_one_year_composite(
-                ds,
-                year,
-                water_index=water_index,
-                include_nir=include_nir,
-                debug=debug,
-            )
-            return year, year_summary
-        except KeyError:
-            return None
-
-    # Use a ThreadPoolExecutor to parallelize the operation
-    with ThreadPoolExecutor() as executor:
-        results = executor.map(process_year, years)
+    # In memory, when streaming scenes into histograms or when loading a year
+    # at a time, summarise each year once and reuse it for the gapfill windows
+    sliding = len(ds.chunks) == 0 or max_error is not None or load_year is not None
+    if sliding and not debug:
+        results = sliding_yearly_composites(
+            ds,
+            start_year,
+            end_year,
+            water_index=water_index,
+            include_nir=include_nir,
+            observation_mask=observation_mask,
+            max_error=max_error,
+            load_year=load_year,
+        )
+    else:
+        # Define a function to be executed in each thread
+        def process_year(year):
+            try:
+                year, year_summary = get_one_year_composite(
+                    ds,
+                    year,
+                    water_index=water_index,
+                    include_nir=include_nir,
+                    debug=debug,
+                    observation_mask=observation_mask,
+                    # Years already run in parallel threads, so don't nest numba's
+                    parallel=False,
+                )
+                return year, year_summary
+            except KeyError:
+                return None
+
+        # Use a ThreadPoolExecutor to parallelize the operation
+        with ThreadPoolExecutor() as executor:
+            results = executor.map(process_year, years)
 
     for result in results:
         if result is not None:
@@ -601,77 +968,122 @@ def export_results(
     return (output_points, output_contours)
 
 
-def process_coastlines(
-    config: dict,
+def load_yearly_composites(
+    config: CoastlinesConfig,
     study_area: str,
-    output_version: str,
-    output_location: str | None,
+    query: dict,
+    geometry: gpd.GeoDataFrame,
     tide_data_location: str,
     log: callable,
     load_early: bool = True,
-):
-    # Study site geometry and config parsing
-    geometry = get_study_site_geometry(config.input.grid_path, study_area)
-    log.info(f"Loaded geometry for study area {study_area}")
-
-    # Config shenanigans
-    bbox = tuple(
-        geometry.to_crs(config.output.crs)
-        .buffer(config.options.load_buffer_distance)
-        .to_crs("epsg:4326")
-        .bounds.values[0]
-    )
-    log.info(f"Using bounding box: {bbox}")
-
-    # Either use the MNDWI index or the combined index
-    log.info(f"Using water index: {config.options.water_index}")
-
-    query = {
-        "bbox": bbox,
-        "datetime": f"{config.options.start_year - 1}/{config.options.end_year + 1}",
-    }
-
+    load_by_year: bool = False,
+) -> xr.Dataset:
+    """
+    Load, mask and composite the daily data for a study area into an
+    in-memory dataset of annual composites.
+    """
     # Loading data
     data = None
+    read_cache = None
     if config.stac is not None:
+        read_cache = get_read_cache(config)
+        if read_cache is not None:
+            read_cache.reset_stats()
+
+        catalog = get_catalog(config, study_area)
+        if isinstance(catalog, SnapshotCatalog):
+            log.info(f"Using {len(catalog.items)} items from a snapshot")
+
+        geobox = None
+        if config.options.grid is not None:
+            geobox = get_tile_geobox(
+                config.options.grid,
+                study_area,
+                buffer=config.options.load_buffer_distance,
+                resolution=config.options.grid_resolution,
+            )
+            log.info(f"Loading onto the {config.options.grid} grid: {geobox}")
+
         data, items = load_and_mask_data_with_stac(
             config,
             query,
             include_nir=config.options.include_nir,
+            catalog=catalog,
+            area=get_load_area(config, geometry),
+            geobox=geobox,
         )
 
         log.info(f"Found {len(items)} items to load.")
     else:
         raise NotImplementedError("Only STAC loading is currently supported")
 
-    # Calculate tides and combine with the data
+    # Calculate tides once, for every step that needs them
+    log.info("Modelling tides")
+    tide_store = None
+    if config.options.tide_store_location is not None:
+        tide_store = TideStore(config.options.tide_store_location)
+
+    tide_cube = None
+    if config.options.tide_cube_location is not None:
+        tide_cube = xr.open_zarr(config.options.tide_cube_location)
+
+    tide_service = None
+    if config.options.tide_service_address is not None:
+        tide_service = TideServiceClient(config.options.tide_service_address)
+
+    tide_context = TideContext.from_dataset(
+        data,
+        tide_data_location,
+        config.options.tide_model,
+        ensemble_model_list=config.options.ensemble_model_list,
+        ensemble_model_rankings=config.options.ensemble_model_rankings,
+        tide_store=tide_store,
+        tide_cube=tide_cube,
+        tide_service=tide_service,
+    )
+
     log.info("Filtering by tides")
     n_times = len(data.time)
-    data = filter_by_tides(data, tide_data_location, config.options.tide_centre, config.options.tide_model, ensemble_model_list=config.options.ensemble_model_list, ensemble_model_rankings=config.options.ensemble_model_rankings)
+    data = filter_by_tides(data, tide_data_location, config.options.tide_centre, config.options.tide_model, ensemble_model_list=config.options.ensemble_model_list, ensemble_model_rankings=config.options.ensemble_model_rankings, tide_context=tide_context)
     log.info(
         f"Dropped {n_times - len(data.time)} out of {n_times} timesteps due to extreme tides"
     )
 
-    if load_early:
-        log.info("Loading daily dataset into memory")
-        data = data.compute()
-
-    log.info("Running per-pixel tide masking at high resolution")
-    data = mask_pixels_by_tide(data, tide_data_location, config.options.tide_centre, config.options.tide_model, ensemble_model_list=config.options.ensemble_model_list, ensemble_model_rankings=config.options.ensemble_model_rankings)
-
-    if config.options.mask_with_hillshade:
-        warning_message = "No DEM found for this area. Skipping hillshadow mask"
-        log.info("Running per-pixel terrain shadow masking")
-        if config.options.hillshade_stac_catalog is not None and config.options.hillshade_stac_collection  is not None:
-            try:
-                data = mask_pixels_by_hillshadow(data, items, config.options.hillshade_stac_catalog, config.options.hillshade_stac_collection)
-            except CoastlinesException:
-                log.warning(warning_message)
-        else:
-            try:
-                data = mask_pixels_by_hillshadow(data, items)
-            except CoastlinesException:
-                log.warning(warning_message)
+    streaming = config.options.streaming_composite_error is not None
+    observation_mask = None
+    load_year = None
+    if load_by_year:
+        # Load, mask and composite a year at a time, keeping the gapfill window
+        log.info("Loading and masking the daily dataset one year at a time")
+        load_year = get_year_loader(data, items, config, tide_context, log)
+    else:
+        # In memory, collect the per-pixel masks and apply them once when compositing.
+        # Streaming composites read scenes a few at a time instead of loading them all.
+        if load_early and not streaming:
+            log.info("Loading daily dataset into memory")
+            data = data.compute()
+        if load_early or streaming:
+            observation_mask = ObservationMask(data)
+
+        log.info("Running per-pixel tide masking at high resolution")
+        data = mask_pixels_by_tide(data, tide_data_location, config.options.tide_centre, config.options.tide_model, ensemble_model_list=config.options.ensemble_model_list, ensemble_model_rankings=config.options.ensemble_model_rankings, tide_context=tide_context, chunked=config.options.chunked_tide_mask or streaming, observation_mask=observation_mask)
+
+        if config.options.mask_with_hillshade:
+            warning_message = "No DEM found for this area. Skipping hillshadow mask"
+            dem_cache = None
+            if config.options.dem_cache_location is not None:
+                dem_cache = DemCache(config.options.dem_cache_location)
+            log.info("Running per-pixel terrain shadow masking")
+            if config.options.hillshade_stac_catalog is not None and config.options.hillshade_stac_collection  is not None:
+                try:
+                    data = mask_pixels_by_hillshadow(data, items, config.options.hillshade_stac_catalog, config.options.hillshade_stac_collection, angle_tolerance=config.options.hillshade_angle_tolerance, skip_unshadowed=config.options.hillshade_skip_unshadowed, dem_cache=dem_cache, observation_mask=observation_mask)
+                except CoastlinesException:
+                    log.warning(warning_message)
+            else:
+                try:
+                    data = mask_pixels_by_hillshadow(data, items, angle_tolerance=config.options.hillshade_angle_tolerance, skip_unshadowed=config.options.hillshade_skip_unshadowed, dem_cache=dem_cache, observation_mask=observation_mask)
+                except CoastlinesException:
+                    log.warning(warning_message)
 
     # Loading combined yearly composites
     log.info("Generating yearly composites")
@@ -681,13 +1093,76 @@ def process_coastlines(
         config.options.end_year,
         water_index=config.options.water_index,
         include_nir=config.options.include_nir,
+        observation_mask=observation_mask,
+        max_error=config.options.streaming_composite_error,
+        load_year=load_year,
     )
 
-    if not load_early:
+    if not load_early and not streaming and not load_by_year:
         log.info("Loading annual dataset into memory")
         combined_data = combined_data.compute()
 
-    # TODO: Maybe write the combined_data to a Zarr file somewhere
+    if read_cache is not None:
+        log.info(read_cache.summary())
+
+    return combined_data
+
+
+def process_coastlines(
+    config: dict,
+    study_area: str,
+    output_version: str,
+    output_location: str | None,
+    tide_data_location: str,
+    log: callable,
+    load_early: bool = True,
+    load_by_year: bool = False,
+):
+    # Study site geometry and config parsing
+    geometry = get_study_site_geometry(config.input.grid_path, study_area)
+    log.info(f"Loaded geometry for study area {study_area}")
+
+    # Config shenanigans
+    query = get_query(config, geometry)
+    bbox = query["bbox"]
+    log.info(f"Using bounding box: {bbox}")
+
+    # Either use the MNDWI index or the combined index
+    log.info(f"Using water index: {config.options.water_index}")
+
+    # Resume from stored annual composites if this tile has been composited before
+    composite_store = None
+    combined_data = None
+    if config.options.composite_store_location is not None:
+        composite_store = CompositeStore(config.options.composite_store_location)
+        composite_params = CompositeStore.params(
+            study_area,
+            config,
+            tide_data_location,
+            snapshot_path=get_items_snapshot(config, study_area),
+        )
+        combined_data = composite_store.get(composite_params)
+        if combined_data is not None:
+            log.info(
+                f"Using stored annual composites from {composite_store.zarr_path(composite_params)}"
+            )
+
+    if combined_data is None:
+        combined_data = load_yearly_composites(
+            config,
+            study_area,
+            query,
+            geometry,
+            tide_data_location,
+            log,
+            load_early=load_early,
+            load_by_year=load_by_year,
+        )
+        if composite_store is not None:
+            log.info(
+                f"Storing annual composites at {composite_store.zarr_path(composite_params)}"
+            )
+            composite_store.put(composite_params, combined_data)
 
     # Load the modifications layer to add/remove areas from the analysis
     log.info("Loading vectors")
@@ -779,6 +1254,20 @@ def process_coastlines(
 @click.option("--tide-data-location", type=str, required=True)
 @click_overwrite
 @click.option("--load-early/--no-load-early", default=True)
+@click.option(
+    "--load-by-year/--no-load-by-year",
+    default=False,
+    help="Load, mask and composite one year at a time, keeping at most three "
+    "years in memory. Overrides --load-early.",
+)
+@click.option(
+    "--items-snapshot",
+    type=str,
+    default=None,
+    help="A local or S3 STAC item snapshot (JSON, NDJSON or GeoParquet) to "
+    "read items from instead of searching the STAC API. Items are filtered "
+    "to the study area locally. Overrides `stac.items_snapshot` in the config.",
+)
 def cli(
     config_path,
     study_area,
@@ -787,6 +1276,8 @@ def cli(
     tide_data_location,
     overwrite,
     load_early,
+    load_by_year,
+    items_snapshot,
 ):
     # Load analysis params from config file
     config = load_config(config_path, "coastlines")
@@ -821,6 +1312,8 @@ def cli(
         raise NotImplementedError("Virtual products are not yet implemented")
     if config.stac is None:
         raise ValueError("STAC config must be provided in config file")
+    if items_snapshot is not None:
+        config.stac.items_snapshot = items_snapshot
 
     if config.aws.aws_unsigned and config.aws.aws_request_payer:
         raise ValueError("Cannot set both aws_unsigned and aws_request_payer to True")
@@ -847,6 +1340,7 @@ def cli(
             tide_data_location,
             log,
             load_early=load_early,
+            load_by_year=load_by_year,
         )
     except CoastlinesException as e:
         log.exception(f"Study area {study_area}: Failed to run process with error {e}")
@@ -0,0 +1,391 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from importlib.metadata import PackageNotFoundError, version
+from typing import Callable
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+from coastlines.config import CoastlinesConfig
+from coastlines.kernels import add_to_histogram, histogram_median, merged_median
+from coastlines.masks import ObservationMask
+
+# The range of values binned for each band in histogram summaries. Water
+# indices are between -1 and 1, and scaled surface reflectance between
+# SR_OFFSET and SR_OFFSET + 65535 * SR_SCALE.
+HISTOGRAM_RANGES = {"nir08": (-0.2, 1.6)}
+
+
+@dataclass
+class PartialSummary:
+    """
+    One year of observations for one band, reduced so that statistics for
+    that year and for windows of years can be built without rereading it.
+    """
+
+    sorted_values: np.ndarray  # (time, y, x), valid values first then nan
+    count: np.ndarray
+    total: np.ndarray
+    total_squares: np.ndarray
+
+    @classmethod
+    def from_values(cls, values: np.ndarray) -> "PartialSummary":
+        valid = ~np.isnan(values)
+        values_64 = np.where(valid, values, 0).astype("float64")
+        return cls(
+            sorted_values=np.sort(values, axis=0),
+            count=valid.sum(axis=0, dtype="int16"),
+            total=values_64.sum(axis=0),
+            total_squares=(values_64**2).sum(axis=0),
+        )
+
+    @classmethod
+    def empty(cls, shape: tuple[int, int], dtype) -> "PartialSummary":
+        return cls(
+            sorted_values=np.empty((0, *shape), dtype=dtype),
+            count=np.zeros(shape, dtype="int16"),
+            total=np.zeros(shape),
+            total_squares=np.zeros(shape),
+        )
+
+    def median(self) -> np.ndarray:
+        lower = np.maximum(self.count - 1, 0) // 2
+        upper = self.count // 2
+        if len(self.sorted_values) == 0:
+            return np.full(self.count.shape, np.nan, dtype=self.sorted_values.dtype)
+
+        # Empty pixels take the first value, which is nan
+        lower_values = np.take_along_axis(self.sorted_values, lower[np.newaxis], 0)[0]
+        upper_values = np.take_along_axis(self.sorted_values, upper[np.newaxis], 0)[0]
+        return (lower_values + upper_values) / 2
+
+
+def _stdev(count: np.ndarray, total: np.ndarray, total_squares: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        variance = np.maximum(total_squares / count - mean**2, 0)
+    return np.sqrt(variance).astype("float32")
+
+
+def window_summary(partials: list[PartialSummary]) -> dict[str, np.ndarray]:
+    """Median, count and standard deviation for up to three years together"""
+    empty = PartialSummary.empty(
+        partials[0].count.shape, partials[0].sorted_values.dtype
+    )
+    first, second, third = (partials + [empty, empty])[:3]
+
+    count = first.count + second.count + third.count
+    total = first.total + second.total + third.total
+    total_squares = first.total_squares + second.total_squares + third.total_squares
+
+    median = merged_median(
+        first.sorted_values,
+        first.count,
+        second.sorted_values,
+        second.count,
+        third.sorted_values,
+        third.count,
+    )
+    return {
+        "median": median,
+        "count": count,
+        "stdev": _stdev(count, total, total_squares),
+    }
+
+
+@dataclass
+class HistogramSummary:
+    """
+    One year of observations for one band, as per-pixel histograms of the
+    values with exact totals for the count and standard deviation.
+
+    Scenes are added one at a time, so memory scales with the number of
+    bins rather than the number of scenes. Medians are bin centres, so
+    they are within half a bin of the exact median.
+    """
+
+    histogram: np.ndarray  # (bins, y, x)
+    total: np.ndarray
+    total_squares: np.ndarray
+    low: float
+    width: float
+
+    @classmethod
+    def empty(
+        cls,
+        shape: tuple[int, int],
+        max_error: float,
+        value_range: tuple[float, float] = (-1.0, 1.0),
+    ) -> "HistogramSummary":
+        low, high = value_range
+        bins = int(np.ceil((high - low) / (2 * max_error)))
+        return cls(
+            histogram=np.zeros((bins, *shape), dtype="uint16"),
+            total=np.zeros(shape),
+            total_squares=np.zeros(shape),
+            low=low,
+            width=(high - low) / bins,
+        )
+
+    @property
+    def count(self) -> np.ndarray:
+        return self.histogram.sum(axis=0, dtype="int16")
+
+    def add(self, values: np.ndarray) -> None:
+        """Add a (y, x) scene, skipping its `nan` pixels"""
+        add_to_histogram(
+            self.histogram,
+            self.total,
+            self.total_squares,
+            np.asarray(values, dtype="float32"),
+            self.low,
+            self.width,
+        )
+
+    def median(self) -> np.ndarray:
+        return histogram_median(self.histogram, self.low, self.width)
+
+
+def histogram_window_summary(partials: list[HistogramSummary]) -> dict[str, np.ndarray]:
+    """Median, count and standard deviation for up to three years together"""
+    window = HistogramSummary(
+        histogram=sum(p.histogram for p in partials),
+        total=sum(p.total for p in partials),
+        total_squares=sum(p.total_squares for p in partials),
+        low=partials[0].low,
+        width=partials[0].width,
+    )
+    count = window.count
+    return {
+        "median": window.median(),
+        "count": count,
+        "stdev": _stdev(count, window.total, window.total_squares),
+    }
+
+
+def sliding_yearly_composites(
+    ds: xr.Dataset,
+    start_year: int,
+    end_year: int,
+    water_index: str = "mndwi",
+    include_nir: bool = False,
+    observation_mask: ObservationMask | None = None,
+    max_error: float | None = None,
+    batch_size: int = 8,
+    load_year: Callable[[int], tuple[xr.Dataset, ObservationMask | None]] | None = None,
+) -> list[tuple[int, xr.Dataset]]:
+    """
+    The same annual and three year gapfill composites as
+    `get_one_year_composite`, for each year with data from `start_year` to
+    `end_year`.
+
+    Each year's observations are summarised once, and these summaries are
+    reused for the gapfill window of the year before and after, rather
+    than reducing every year's observations four times.
+
+    Without `max_error`, each year is summarised exactly, so the dataset
+    should already be in memory. With `max_error`, each year is summarised
+    as histograms with medians within `max_error` of the exact ones, from
+    `batch_size` scenes at a time, so a lazy dataset is never loaded
+    whole. Counts and standard deviations are exact either way.
+
+    With `load_year`, each year's observations and observation mask come
+    from `load_year(year)` instead of `ds`, which then only describes the
+    data. Years are loaded in order and dropped once their gapfill windows
+    are done, so at most three years are summarised at once.
+    """
+    bands = [water_index, "nir08"] if include_nir else [water_index]
+
+    years = ds.time.dt.year.values
+    shape = (ds.sizes["y"], ds.sizes["x"])
+    partials = {}
+
+    def summarise_year(
+        one_year: xr.Dataset, observation_mask: ObservationMask | None
+    ) -> dict:
+        if max_error is None:
+            if observation_mask is not None:
+                one_year = observation_mask.where(one_year)
+            return {
+                band: PartialSummary.from_values(one_year[band].values)
+                if len(one_year.time) > 0
+                else PartialSummary.empty(shape, ds[band].dtype)
+                for band in bands
+            }
+
+        summaries = {
+            band: HistogramSummary.empty(
+                shape, max_error, HISTOGRAM_RANGES.get(band, (-1.0, 1.0))
+            )
+            for band in bands
+        }
+        for start in range(0, len(one_year.time), batch_size):
+            batch = one_year[bands].isel(time=slice(start, start + batch_size))
+            if observation_mask is not None:
+                batch = observation_mask.where(batch)
+            batch = batch.compute()
+            for band in bands:
+                for scene in batch[band].values:
+                    summaries[band].add(scene)
+        return summaries
+
+    def get_partials(year: int) -> dict:
+        if year not in partials:
+            if load_year is None:
+                one_year = ds.isel(time=np.flatnonzero(years == year))
+                partials[year] = summarise_year(one_year, observation_mask)
+            else:
+                partials[year] = summarise_year(*load_year(year))
+        return partials[year]
+
+    summarise_window = window_summary if max_error is None else histogram_window_summary
+
+    template = ds[water_index].isel(time=0, drop=True)
+    composites = []
+    for year in range(start_year, end_year + 1):
+        # Like `ds.sel(time=str(year))`, only skip years outside the data.
+        # Years inside it without data still get a gapfill composite.
+        if year < years.min() or year > years.max():
+            continue
+
+        # Only the gapfill window needs to be held in memory
+        for old_year in [y for y in partials if y < year - 1]:
+            del partials[old_year]
+
+        one_year = get_partials(year)
+        window = [get_partials(y) for y in range(year - 1, year + 2)]
+
+        index = one_year[water_index]
+        gapfill = summarise_window([p[water_index] for p in window])
+        stdev = _stdev(index.count, index.total, index.total_squares)
+
+        year_summary = xr.Dataset(coords=template.coords)
+        year_summary[water_index] = (template.dims, index.median())
+        year_summary["count"] = (template.dims, index.count)
+        year_summary["stdev"] = (template.dims, stdev)
+        year_summary[f"gapfill_{water_index}"] = (template.dims, gapfill["median"])
+        year_summary["gapfill_count"] = (template.dims, gapfill["count"])
+        year_summary["gapfill_stdev"] = (template.dims, gapfill["stdev"])
+
+        if include_nir:
+            gapfill_nir = summarise_window([p["nir08"] for p in window])
+            year_summary["nir"] = (template.dims, one_year["nir08"].median())
+            year_summary["gapfill_nir"] = (template.dims, gapfill_nir["median"])
+
+        composites.append((year, year_summary))
+
+    return composites
+
+
+# Options that don't change the annual composites, only how they're made or
+# what happens to them afterwards
+NON_COMPOSITE_OPTIONS = {
+    "baseline_year",
+    "index_threshold",
+    "mask_with_esa_wc",
+    "use_combined_index",
+    "chunked_tide_mask",
+    "dem_cache_location",
+    "tide_store_location",
+    "tide_service_address",
+    "composite_store_location",
+}
+NON_COMPOSITE_STAC_OPTIONS = {"project_fields", "cache", "read_cache"}
+# Bump this when a change to loading, masking or compositing changes the
+# composites, so that stored composites aren't resumed from
+COMPOSITE_SCHEMA_VERSION = 1
+
+
+def _file_checksum(path: str) -> str:
+    with fsspec.open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _tide_cube_fingerprint(location: str | None) -> dict | None:
+    """The attributes of a tide cube, which include an ID for each build"""
+    if location is None:
+        return None
+    with xr.open_zarr(location) as cube:
+        return dict(cube.attrs)
+
+
+def _package_version() -> str | None:
+    try:
+        return version("coastlines")
+    except PackageNotFoundError:
+        return None
+
+
+class CompositeStore:
+    """
+    A persistent store of annual composites, as one Zarr per tile.
+
+    Each Zarr is named by a hash of everything that goes into its
+    composites, from `CompositeStore.params`, so reruns that only change
+    later steps read the composites back instead of loading and compositing
+    again. A JSON file of the hashed params is written after the Zarr, and
+    marks it complete.
+    """
+
+    def __init__(self, location: str):
+        self.location = location.rstrip("/")
+        self.fs, self.root = fsspec.core.url_to_fs(self.location)
+
+    @staticmethod
+    def params(
+        study_area: str,
+        config: CoastlinesConfig,
+        tide_data_location: str,
+        snapshot_path: str | None = None,
+    ) -> dict:
+        """
+        The study area, config and inputs that go into its composites. The
+        grid and item snapshot are included by their checksums, and the tide
+        cube by its attributes, so inputs rebuilt at the same paths make new
+        composites.
+        """
+        return {
+            "study_area": study_area,
+            "schema_version": COMPOSITE_SCHEMA_VERSION,
+            "coastlines_version": _package_version(),
+            "grid_path": config.input.grid_path,
+            "grid_checksum": _file_checksum(config.input.grid_path),
+            "tide_cube": _tide_cube_fingerprint(config.options.tide_cube_location),
+            "tide_data_location": tide_data_location,
+            "snapshot_checksum": None
+            if snapshot_path is None
+            else _file_checksum(snapshot_path),
+            "options": config.options.model_dump(exclude=NON_COMPOSITE_OPTIONS),
+            "stac": None
+            if config.stac is None
+            else config.stac.model_dump(exclude=NON_COMPOSITE_STAC_OPTIONS),
+        }
+
+    @staticmethod
+    def key(params: dict) -> str:
+        as_json = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(as_json.encode("utf-8")).hexdigest()
+
+    def _marker(self, params: dict) -> str:
+        return f"{self.root}/{params['study_area']}/{self.key(params)}.json"
+
+    def zarr_path(self, params: dict) -> str:
+        return f"{self.location}/{params['study_area']}/{self.key(params)}.zarr"
+
+    def get(self, params: dict) -> xr.Dataset | None:
+        """Stored composites for these params, if they are complete"""
+        if not self.fs.exists(self._marker(params)):
+            return None
+        composites = xr.open_zarr(self.zarr_path(params), decode_coords="all")
+        return composites.load()
+
+    def put(self, params: dict, composites: xr.Dataset) -> None:
+        marker = self._marker(params)
+        # Remove the marker first, so an interrupted rewrite is never read
+        if self.fs.exists(marker):
+            self.fs.rm(marker)
+        composites.to_zarr(self.zarr_path(params), mode="w")
+        with self.fs.open(marker, "w") as f:
+            json.dump(params, f, indent=2, default=str)
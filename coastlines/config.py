@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from typing import Literal
+
+from pydantic import BaseModel, Field
 
 
 class CoastlinesInput(BaseModel):
@@ -12,12 +14,40 @@ class Output(BaseModel):
     crs: str = "EPSG:4326"
 
 
+class STACCache(BaseModel):
+    location: str
+    ttl_hours: float = 168
+    max_size_mb: float = 1024
+
+
+class ReadCache(BaseModel):
+    location: str
+    max_size_mb: float = 100_000
+
+
 class CoastlinesSTAC(BaseModel):
     stac_api_url: str
     stac_collections: list[str]
     lower_scene_limit: int
     upper_scene_limit: int
 
+    # Either step through searches on the "server" or fetch once and select "local"ly
+    scene_selection: Literal["server", "local"] = "server"
+    # Use the fields extension to only fetch the properties and assets we use
+    project_fields: bool = False
+    # Drop items from solar days whose footprints together cover less than this
+    # fraction of the load area
+    min_footprint_coverage: float = 0.0
+    # Load the QA band first and skip days with less than this fraction of clear pixels
+    min_clear_fraction: float = 0.0
+    cache: STACCache | None = None
+    # A local disk cache of raw raster reads, for repeated runs over the same tiles
+    read_cache: ReadCache | None = None
+    # A directory of per-tile item snapshots written by coastlines-prefetch
+    snapshot_location: str | None = None
+    # A single item snapshot file (JSON, NDJSON or GeoParquet) to use for all tiles
+    items_snapshot: str | None = None
+
 
 class AWS(BaseModel):
     aws_request_payer: bool = False
@@ -34,10 +64,23 @@ class CoastlinesOptions(BaseModel):
     water_index: str = "mndwi"
     index_threshold: float = 0.0
     include_nir: bool = True
+    # Calculate the masked water index from raw bands in one fused kernel
+    fused_index: bool = False
+    # Composite from per-pixel histograms, reading a few scenes at a time rather than
+    # loading them all, with medians within this error. Implies a chunked tide mask.
+    streaming_composite_error: float | None = Field(default=None, gt=0)
 
     mask_with_hillshade: bool = True
     hillshade_stac_catalog: str | None = None
     hillshade_stac_collection: str | None = None
+    # Sun positions within this many degrees share one terrain shadow mask.
+    # 0 masks each timestep separately, which matches earlier outputs exactly
+    hillshade_angle_tolerance: float = 0
+    # Don't mask timesteps where the sun is higher than the steepest slope. Each
+    # hillshade is rescaled, so these would otherwise mask dimly lit slopes
+    hillshade_skip_unshadowed: bool = False
+    # A local or S3 directory of DEMs loaded onto each tile, filled by coastlines-dem-cache
+    dem_cache_location: str | None = None
 
     use_ensemble: bool = True
     ensemble_model_list: list[str] | None = None
@@ -47,7 +90,21 @@ class CoastlinesOptions(BaseModel):
     use_combined_index: bool = False
 
     tide_centre: float = 0.0
+    # Build the per-pixel tide mask chunk by chunk, without full resolution tides
+    chunked_tide_mask: bool = False
+    # A local or S3 directory of modelled tide heights, reused between runs
+    tide_store_location: str | None = None
+    # A Zarr tide cube written by coastlines-tide-cube, interpolated instead of modelling
+    tide_cube_location: str | None = None
+    # The socket of a running coastlines-tide-service to model tides with
+    tide_service_address: str | None = None
     load_buffer_distance: int = 5000
+    # A local or S3 directory of annual composites per tile, resumed from on reruns
+    composite_store_location: str | None = None
+
+    # Optionally load onto a tile of one of the grids in coastlines.grids
+    grid: str | None = None
+    grid_resolution: float | None = None
 
 
 class CoastlinesConfig(BaseModel):
@@ -0,0 +1,73 @@
+from typing import Optional
+
+import click
+
+from coastlines.grids import get_tile_geobox
+from coastlines.terrain import DEM_STAC_CATALOG, DEM_STAC_COLLECTION, DemCache, load_dem
+from coastlines.utils import (
+    CoastlinesException,
+    click_config_path,
+    configure_logging,
+    load_config,
+    load_json,
+    subset_tiles,
+)
+
+
+@click.command("coastlines-dem-cache")
+@click_config_path
+@click.option(
+    "--output-location",
+    type=str,
+    default=None,
+    help="The local or S3 directory to write DEMs to. "
+    "Defaults to `options.dem_cache_location` in the config file.",
+)
+@click.option("--tiles-subset", type=str, default="[]")
+def cli(config_path: str, output_location: Optional[str], tiles_subset: str) -> None:
+    config = load_config(config_path, "coastlines")
+    log = configure_logging("Coastlines DEM cache")
+
+    if output_location is None:
+        output_location = config.options.dem_cache_location
+    if output_location is None:
+        raise ValueError("An output location must be provided")
+
+    # Without a grid, each tile's GeoBox depends on the scenes it loads
+    if config.options.grid is None:
+        raise ValueError("DEMs can only be cached ahead of time for `options.grid` tiles")
+
+    tiles = load_json(config.input.grid_path)
+
+    tiles = subset_tiles(tiles, tiles_subset)
+
+    # As in coastlines-combined, a custom DEM needs both a catalog and collection
+    stac_catalog, stac_collection = DEM_STAC_CATALOG, DEM_STAC_COLLECTION
+    if (
+        config.options.hillshade_stac_catalog is not None
+        and config.options.hillshade_stac_collection is not None
+    ):
+        stac_catalog = config.options.hillshade_stac_catalog
+        stac_collection = config.options.hillshade_stac_collection
+    dem_cache = DemCache(output_location)
+
+    log.info(f"Caching DEMs from {stac_collection} for {len(tiles)} tiles")
+    for tile_id in tiles.index:
+        geobox = get_tile_geobox(
+            config.options.grid,
+            tile_id,
+            buffer=config.options.load_buffer_distance,
+            resolution=config.options.grid_resolution,
+        )
+        try:
+            load_dem(geobox, stac_catalog, stac_collection, dem_cache=dem_cache)
+        except CoastlinesException:
+            log.warning(f"No DEM found for tile {tile_id}")
+            continue
+        log.info(f"Cached the DEM for tile {tile_id}")
+
+    log.info(f"Wrote DEMs to {output_location}")
+
+
+if __name__ == "__main__":
+    cli()
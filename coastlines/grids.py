@@ -1,4 +1,7 @@
+from math import ceil
+
 from odc.geo import XY
+from odc.geo.geobox import GeoBox
 from odc.geo.gridspec import GridSpec
 
 # numbers
@@ -51,4 +54,50 @@ INDONESIA_10 = GridSpec(
     tile_shape=(5000, 5000),
     resolution=10,
     origin=XY(-SIX_TWO_FIVE_MILLION, -ONE_TWO_FIVE_MILLION),
-)
\ No newline at end of file
+)
+# Landsat Collection 2 pixel edges are 15 m off multiples of 30 m, in UTM
+LANDSAT_RESOLUTION = 30
+LANDSAT_ANCHOR = XY(0.5, 0.5)
+
+GRIDS = {
+    "VIETNAM_25": VIETNAM_25,
+    "VIETNAM_10": VIETNAM_10,
+    "PHILIPPINES_25": PHILIPPINES_25,
+    "PHILIPPINES_10": PHILIPPINES_10,
+    "INDONESIA_25": INDONESIA_25,
+    "INDONESIA_10": INDONESIA_10,
+}
+
+
+def get_tile_geobox(
+    grid_name: str,
+    tile_id: str,
+    buffer: float = 0,
+    resolution: float | None = None,
+) -> GeoBox:
+    """
+    Get the GeoBox for a tile ID like "45,6" on one of the grids above.
+
+    The tile is padded by `buffer` (in the grid's CRS units). If a
+    `resolution` is given, the GeoBox is resampled to it, keeping pixel edges
+    on multiples of the resolution so that neighbouring tiles line up. At
+    Landsat's 30 m, pixel edges are offset by 15 m to match Landsat's own
+    grid, so that scenes in the same CRS are read without resampling.
+    """
+    if grid_name not in GRIDS:
+        raise ValueError(f"Unknown grid {grid_name}. Must be one of {list(GRIDS)}")
+    gridspec = GRIDS[grid_name]
+
+    index = tuple(int(part) for part in tile_id.split(","))
+    geobox = gridspec.tile_geobox(index)
+
+    if buffer > 0:
+        geobox = geobox.pad(ceil(buffer / gridspec.resolution.x))
+
+    if resolution is not None:
+        anchor = LANDSAT_ANCHOR if resolution == LANDSAT_RESOLUTION else "default"
+        geobox = GeoBox.from_bbox(
+            geobox.boundingbox, crs=geobox.crs, resolution=resolution, anchor=anchor
+        )
+
+    return geobox
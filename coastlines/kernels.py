@@ -0,0 +1,382 @@
+import dask.array as da
+import numba
+import numpy as np
+import xarray as xr
+
+from coastlines.morphology import cleanup_masks
+
+# Landsat Collection 2 surface reflectance scaling
+SR_SCALE = np.float32(0.0000275)
+SR_OFFSET = np.float32(-0.2)
+
+WATER_INDEX_CODES = {"mndwi": 0, "ndwi": 1, "combined": 2, "mndwi_nir": 3}
+
+
+# Not parallel, as Dask already runs chunks in parallel threads
+@numba.njit(cache=True, error_model="numpy")
+def _water_index_2d(green, swir, nir, cloud, index_code, out_index, out_nir):
+    ny, nx = green.shape
+    nan = np.float32(np.nan)
+    half = np.float32(0.5)
+    one = np.float32(1)
+    for y in range(ny):
+        for x in range(nx):
+            g_raw = green[y, x]
+            s_raw = swir[y, x]
+            if g_raw == 0 or s_raw == 0 or cloud[y, x]:
+                out_index[y, x] = nan
+                out_nir[y, x] = nan
+                continue
+
+            g = np.float32(g_raw) * SR_SCALE + SR_OFFSET
+            s = np.float32(s_raw) * SR_SCALE + SR_OFFSET
+            if g < 0 or g > 1 or s < 0 or s > 1:
+                out_index[y, x] = nan
+                out_nir[y, x] = nan
+                continue
+
+            # Nodata in the NIR band makes NIR based values nodata
+            n = nan
+            if nir[y, x] != 0:
+                n = np.float32(nir[y, x]) * SR_SCALE + SR_OFFSET
+            out_nir[y, x] = n
+
+            if index_code == 0:
+                value = (g - s) / (g + s)
+            elif index_code == 1:
+                value = (g - n) / (g + n)
+            elif index_code == 2:
+                value = ((g - s) / (g + s) + (g - n) / (g + n)) * half
+            else:
+                scaled_green = (g + (one - n)) * half
+                scaled_swir = (s + n) * half
+                value = (scaled_green - scaled_swir) / (scaled_green + scaled_swir)
+            out_index[y, x] = value
+
+
+def water_index_block(
+    green: np.ndarray,
+    swir: np.ndarray,
+    nir: np.ndarray,
+    qa: np.ndarray,
+    index_code: int,
+    cloud_bitmask: int,
+    mask_filters: list,
+) -> np.ndarray:
+    """
+    Turn raw uint16 bands for a (time, y, x) block into a masked water index.
+
+    Returns a float32 array shaped (2, time, y, x), holding the water index
+    and scaled NIR, with nodata, cloud and out of range pixels set to `nan`.
+    """
+    out = np.empty((2, *green.shape), dtype="float32")
+
+    # Clean up the cloud masks for all timesteps in the block together
+    clouds = cleanup_masks((qa & cloud_bitmask) != 0, mask_filters)
+
+    for t in range(green.shape[0]):
+        _water_index_2d(
+            green[t], swir[t], nir[t], clouds[t], index_code, out[0, t], out[1, t]
+        )
+
+    return out
+
+
+def fused_water_index(
+    ds: xr.Dataset,
+    water_index: str,
+    cloud_bitmask: int,
+    mask_filters: list,
+    include_nir: bool = False,
+) -> xr.Dataset:
+    """
+    Calculate a masked water index from raw Landsat bands in a single pass.
+
+    This is the same as scaling each band with `to_f32`, masking nodata,
+    cloud and invalid values and then calculating the index, but it is done
+    in one task per chunk, without building scaled bands or masks as
+    separate arrays in the Dask graph.
+
+    Parameters:
+    -----------
+    ds : xarray.Dataset
+        Raw uint16 `green`, `swir16` and `qa_pixel` bands, plus `nir08` if
+        it is needed for the index or `include_nir` is set.
+    water_index : str
+        One of "mndwi", "ndwi", "combined" or "mndwi_nir".
+    cloud_bitmask : int
+        The `qa_pixel` bits that flag cloud.
+    mask_filters : list
+        Morphological operations to clean up the cloud mask, as used by
+        `coastlines.morphology.cleanup_masks`.
+    include_nir : bool, optional
+        Whether to also return the scaled and masked `nir08` band.
+
+    Returns:
+    --------
+    xarray.Dataset
+        A dataset with the float32 water index, and `nir08` if requested.
+    """
+    needs_nir = include_nir or water_index != "mndwi"
+    if needs_nir and "nir08" not in ds:
+        raise ValueError(f"The nir08 band is needed to calculate {water_index}")
+
+    # The cloud mask cleanup needs whole images, so keep each timestep in one block
+    bands = ["green", "swir16", "nir08" if needs_nir else "green", "qa_pixel"]
+    green, swir, nir, qa = [
+        ds[band].chunk({"y": -1, "x": -1}).data for band in bands
+    ]
+
+    stacked = da.map_blocks(
+        water_index_block,
+        green,
+        swir,
+        nir,
+        qa,
+        index_code=WATER_INDEX_CODES[water_index],
+        cloud_bitmask=cloud_bitmask,
+        mask_filters=mask_filters,
+        dtype="float32",
+        new_axis=0,
+        chunks=((2,), *green.chunks),
+    )
+
+    template = ds["green"]
+    out = xr.Dataset(
+        {water_index: (template.dims, stacked[0])}, coords=template.coords
+    )
+    if include_nir:
+        out["nir08"] = (template.dims, stacked[1])
+
+    out.attrs = ds.attrs
+
+    return out
+
+
+@numba.njit(cache=True, parallel=True)
+def merged_median(first, first_count, second, second_count, third, third_count):
+    """
+    The median of the valid values in three stacks of sorted values, each
+    shaped (time, y, x) with `nan`s after the valid values, without sorting
+    them together. Returns a float32 (y, x) array.
+    """
+    ny, nx = first_count.shape
+    out = np.empty((ny, nx), dtype=np.float32)
+    for y in numba.prange(ny):
+        for x in range(nx):
+            n1, n2, n3 = first_count[y, x], second_count[y, x], third_count[y, x]
+            total = n1 + n2 + n3
+            if total == 0:
+                out[y, x] = np.nan
+                continue
+
+            # Walk the three sorted stacks together up to the middle value(s)
+            lower_k = (total - 1) // 2
+            upper_k = total // 2
+            i1 = i2 = i3 = 0
+            lower = np.float32(0)
+            for k in range(upper_k + 1):
+                v1 = first[i1, y, x] if i1 < n1 else np.inf
+                v2 = second[i2, y, x] if i2 < n2 else np.inf
+                v3 = third[i3, y, x] if i3 < n3 else np.inf
+                if v1 <= v2 and v1 <= v3:
+                    value = v1
+                    i1 += 1
+                elif v2 <= v3:
+                    value = v2
+                    i2 += 1
+                else:
+                    value = v3
+                    i3 += 1
+                if k == lower_k:
+                    lower = np.float32(value)
+            out[y, x] = (lower + np.float32(value)) / np.float32(2)
+
+    return out
+
+
+@numba.njit(cache=True, parallel=True)
+def add_to_histogram(histogram, total, total_squares, values, low, width):
+    """
+    Add a (y, x) scene to per-pixel histograms shaped (bins, y, x), and to
+    the running totals of its values and their squares. `nan`s are skipped
+    and values outside the histogram go in its first or last bin.
+    """
+    n_bins = histogram.shape[0]
+    ny, nx = values.shape
+    for y in numba.prange(ny):
+        for x in range(nx):
+            value = values[y, x]
+            if np.isnan(value):
+                continue
+            b = int(np.floor((value - low) / width))
+            b = min(max(b, 0), n_bins - 1)
+            histogram[b, y, x] += 1
+            total[y, x] += value
+            total_squares[y, x] += np.float64(value) * value
+
+
+@numba.njit(cache=True, parallel=True)
+def histogram_median(histogram, low, width):
+    """
+    The approximate median of per-pixel histograms shaped (bins, y, x), as
+    the centre of the bin holding the middle value, or the mean of the
+    centres of the two bins holding the middle values. Returns a float32
+    (y, x) array.
+    """
+    n_bins, ny, nx = histogram.shape
+    out = np.empty((ny, nx), dtype=np.float32)
+    for y in numba.prange(ny):
+        for x in range(nx):
+            count = 0
+            for b in range(n_bins):
+                count += histogram[b, y, x]
+            if count == 0:
+                out[y, x] = np.nan
+                continue
+
+            lower_k = (count - 1) // 2
+            upper_k = count // 2
+            lower_bin = -1
+            cumulative = 0
+            for b in range(n_bins):
+                cumulative += histogram[b, y, x]
+                if lower_bin < 0 and cumulative > lower_k:
+                    lower_bin = b
+                if cumulative > upper_k:
+                    break
+            out[y, x] = low + width * ((lower_bin + b) / 2 + 0.5)
+
+    return out
+
+
+def _median_count_std(values, out_median, out_count, out_std):
+    n_pixels, n_times = values.shape
+    nan = np.float32(np.nan)
+    for p in numba.prange(n_pixels):
+        # Gather the valid values, and their mean and spread
+        buffer = np.empty(n_times, dtype=np.float32)
+        n = 0
+        total = 0.0
+        for t in range(n_times):
+            value = values[p, t]
+            if not np.isnan(value):
+                buffer[n] = value
+                total += value
+                n += 1
+
+        out_count[p] = n
+        if n == 0:
+            out_median[p] = nan
+            out_std[p] = nan
+            continue
+
+        mean = total / n
+        squares = 0.0
+        for i in range(n):
+            squares += (buffer[i] - mean) ** 2
+        out_std[p] = np.sqrt(squares / n)
+
+        # Select the lower middle value in place (Wirth's algorithm)
+        k = (n - 1) // 2
+        left, right = 0, n - 1
+        while left < right:
+            pivot = buffer[k]
+            i, j = left, right
+            while True:
+                while buffer[i] < pivot:
+                    i += 1
+                while pivot < buffer[j]:
+                    j -= 1
+                if i <= j:
+                    buffer[i], buffer[j] = buffer[j], buffer[i]
+                    i += 1
+                    j -= 1
+                if i > j:
+                    break
+            if j < k:
+                left = i
+            if k < i:
+                right = j
+        lower = buffer[k]
+
+        # Everything after the lower middle value is at least as large
+        if n % 2 == 1:
+            out_median[p] = lower
+        else:
+            upper = buffer[k + 1]
+            for i in range(k + 2, n):
+                if buffer[i] < upper:
+                    upper = buffer[i]
+            out_median[p] = (lower + upper) / np.float32(2)
+
+
+# A serial version for Dask chunks, which already run in parallel threads
+_median_count_std_serial = numba.njit(cache=True, error_model="numpy")(_median_count_std)
+_median_count_std_parallel = numba.njit(
+    cache=True, error_model="numpy", parallel=True
+)(_median_count_std)
+
+
+def median_count_std_block(values: np.ndarray, parallel: bool = True) -> tuple:
+    """
+    The NaN-aware median, count and standard deviation over the last axis
+    of `values`, in a single pass for each pixel. Returns float32 medians,
+    int16 counts and float32 standard deviations.
+    """
+    shape = values.shape[:-1]
+    values = np.ascontiguousarray(
+        values.reshape(int(np.prod(shape)), values.shape[-1]), dtype="float32"
+    )
+
+    median = np.empty(len(values), dtype="float32")
+    count = np.empty(len(values), dtype="int16")
+    std = np.empty(len(values), dtype="float32")
+
+    kernel = _median_count_std_parallel if parallel else _median_count_std_serial
+    kernel(values, median, count, std)
+
+    return median.reshape(shape), count.reshape(shape), std.reshape(shape)
+
+
+def _stacked_median_count_std(values: np.ndarray) -> np.ndarray:
+    """Medians, counts and standard deviations stacked on a new last axis"""
+    return np.stack(median_count_std_block(values, parallel=False), axis=-1)
+
+
+def median_count_std(
+    array: xr.DataArray, dim: str = "time", parallel: bool = True
+) -> tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+    """
+    The median, count and standard deviation of `array` along `dim`, the
+    same as `array.median(dim)`, `array.count(dim)` and `array.std(dim)`,
+    but calculated together in one compiled pass.
+
+    Dask arrays are rechunked to a single chunk along `dim` and each chunk
+    is summarised by one task, so the graph stays as small as the input's.
+    Numpy arrays use the parallel kernel unless `parallel` is False, for
+    example when already running in a thread pool.
+    """
+    array = array.transpose(..., dim)
+    coords = {k: v for k, v in array.coords.items() if dim not in v.dims}
+
+    if isinstance(array.data, da.Array):
+        data = array.data.rechunk({array.ndim - 1: -1})
+        stacked = data.map_blocks(
+            _stacked_median_count_std,
+            chunks=data.chunks[:-1] + ((3,),),
+            dtype="float32",
+        )
+        median, count, std = (stacked[..., i] for i in range(3))
+        count = count.astype("int16")
+    else:
+        median, count, std = median_count_std_block(array.data, parallel=parallel)
+
+    outputs = []
+    for data in (median, count, std):
+        output = xr.DataArray(data, dims=array.dims[:-1], coords=coords)
+        # Set afterwards, as a Dask array's own name is used in place of None
+        output.name = array.name
+        outputs.append(output)
+
+    return tuple(outputs)
@@ -0,0 +1,88 @@
+import numpy as np
+import xarray as xr
+
+from coastlines.morphology import pack_masks, packed_ones, unpack_masks
+
+
+class ObservationMask:
+    """
+    Which pixels of a (time, y, x) dataset are valid observations, with one
+    bit for each pixel and timestep.
+
+    Masking steps mark pixels as invalid with `mask`, and the combined
+    mask is applied once with `where`, rather than each step making a new
+    copy of the dataset with `xarray.Dataset.where`.
+    """
+
+    def __init__(self, ds: xr.Dataset):
+        self.time = ds.time
+        self.shape = (len(ds.time), ds.sizes["y"], ds.sizes["x"])
+        self.words = packed_ones(*self.shape)
+        self.bits_per_word = self.words.itemsize * 8
+
+    def mask(self, invalid: xr.DataArray | np.ndarray, block_size: int = 256) -> None:
+        """
+        Mark the True pixels of a (time, y, x) mask as invalid. Dask masks
+        are computed `block_size` timesteps at a time, so the whole mask is
+        never held in memory unpacked.
+        """
+        if isinstance(invalid, xr.DataArray):
+            invalid = invalid.sel(time=self.time).transpose("time", "y", "x").data
+        if invalid.shape != self.shape:
+            raise ValueError(f"Expected a mask shaped {self.shape}, not {invalid.shape}")
+
+        self._mask_blocks(lambda i, j: invalid[i:j], 0, self.shape[0], block_size)
+
+    def mask_by_index(
+        self, masks: np.ndarray, index: np.ndarray, start: int = 0, block_size: int = 256
+    ) -> None:
+        """
+        Mark the True pixels of `masks[index[i]]` as invalid for timestep
+        `start + i`, where timesteps share a few (n, y, x) masks. Only
+        `block_size` timesteps of masks are made at a time.
+        """
+        if start % self.bits_per_word != 0 or start + len(index) > self.shape[0]:
+            raise ValueError(f"Can't mask {len(index)} timesteps from timestep {start}")
+        self._mask_blocks(
+            lambda i, j: masks[index[i - start : j - start]],
+            start,
+            start + len(index),
+            block_size,
+        )
+
+    def _mask_blocks(self, get_block, start: int, stop: int, block_size: int) -> None:
+        # Blocks need to start on word boundaries
+        block_size = -(-block_size // self.bits_per_word) * self.bits_per_word
+        for block_start in range(start, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            block = np.asarray(get_block(block_start, block_stop), dtype=bool)
+            words = pack_masks(block, word_bytes=self.words.itemsize)
+            first = block_start // self.bits_per_word
+            self.words[first : first + len(words)] &= ~words
+
+    def valid(self, time: xr.DataArray | None = None) -> xr.DataArray:
+        """
+        The valid pixels for the timesteps in `time`, or for all timesteps.
+        Only the words holding those timesteps are unpacked.
+        """
+        if time is None:
+            time = self.time
+        index = self.time.to_index().get_indexer(time.values)
+        if (index < 0).any():
+            raise ValueError("Some timesteps aren't in the observation mask")
+
+        if len(index) == 0:
+            valid = np.zeros((0, *self.shape[1:]), dtype=bool)
+        else:
+            first = index.min() // self.bits_per_word
+            last = index.max() // self.bits_per_word + 1
+            valid = unpack_masks(
+                self.words[first:last], (last - first) * self.bits_per_word
+            )
+            valid = valid[index - first * self.bits_per_word]
+
+        return xr.DataArray(valid, dims=["time", "y", "x"], coords={"time": time})
+
+    def where(self, ds: xr.Dataset) -> xr.Dataset:
+        """Set the invalid pixels of `ds` to `nan`"""
+        return ds.where(self.valid(ds.time))
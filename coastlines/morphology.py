@@ -0,0 +1,187 @@
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+MORPH_OPS = ["opening", "closing", "dilation", "erosion"]
+
+
+def _word_bytes(n_bytes: int) -> int:
+    """The smallest word, up to 64 bits, that holds `n_bytes` of packed masks"""
+    return min(8, 1 << int(np.ceil(np.log2(max(n_bytes, 1)))))
+
+
+def pack_masks(masks: np.ndarray, word_bytes: int | None = None) -> np.ndarray:
+    """
+    Pack a stack of boolean masks shaped (n, y, x) into bits, as a
+    (n_words, y, x) array of unsigned integers. Each word holds up to 64
+    masks for a pixel, and smaller stacks use smaller words unless
+    `word_bytes` is given.
+    """
+    n, ny, nx = masks.shape
+    packed = np.packbits(masks, axis=0, bitorder="little")
+
+    if word_bytes is None:
+        word_bytes = _word_bytes(packed.shape[0])
+    n_bytes = -(-packed.shape[0] // word_bytes) * word_bytes
+    if n_bytes > packed.shape[0]:
+        padding = np.zeros((n_bytes - packed.shape[0], ny, nx), dtype="uint8")
+        packed = np.concatenate([packed, padding])
+
+    # Put the bytes for each pixel next to each other, to view them as one word
+    packed = packed.reshape(n_bytes // word_bytes, word_bytes, ny, nx)
+    packed = np.ascontiguousarray(packed.transpose(0, 2, 3, 1))
+    return packed.view(f"uint{word_bytes * 8}")[..., 0]
+
+
+def packed_ones(n: int, ny: int, nx: int) -> np.ndarray:
+    """
+    The same words as `pack_masks(np.ones((n, ny, nx), dtype=bool))`, without
+    making the unpacked masks.
+    """
+    word_bytes = _word_bytes(-(-n // 8))
+    bits = word_bytes * 8
+    dtype = np.dtype(f"uint{bits}")
+
+    words = np.full((-(-n // bits), ny, nx), np.iinfo(dtype).max, dtype=dtype)
+    if n % bits:
+        words[-1] = dtype.type((1 << (n % bits)) - 1)
+    return words
+
+
+def unpack_masks(words: np.ndarray, n: int) -> np.ndarray:
+    """Unpack the first `n` masks from words made by `pack_masks`"""
+    n_words, ny, nx = words.shape
+    packed = words[..., np.newaxis].view("uint8").transpose(0, 3, 1, 2)
+    packed = packed.reshape(n_words * words.itemsize, ny, nx)
+    return np.unpackbits(packed, axis=0, count=n, bitorder="little").astype(bool)
+
+
+def _disk_widths(radius: float) -> dict[int, list[int]]:
+    """
+    The rows of a disk of `radius`, as the pixels with a distance of at most
+    `radius` from the centre. Maps each half width to the row offsets with it.
+    """
+    r = int(np.floor(radius))
+    widths = {}
+    for dy in range(-r, r + 1):
+        w = int(np.floor(np.sqrt(radius**2 - dy**2)))
+        # Guard against rounding in the square root
+        while (w + 1) ** 2 + dy**2 <= radius**2:
+            w += 1
+        while w > 0 and w**2 + dy**2 > radius**2:
+            w -= 1
+        widths.setdefault(w, []).append(dy)
+    return widths
+
+
+def _shift_or(out: np.ndarray, words: np.ndarray, offset: int, axis: int) -> None:
+    """`out |= words` shifted by `offset` pixels along `axis`, filling with 0"""
+    if offset == 0:
+        out |= words
+        return
+
+    n = words.shape[axis]
+    if abs(offset) >= n:
+        return
+
+    src = [slice(None)] * words.ndim
+    dst = [slice(None)] * words.ndim
+    if offset > 0:
+        src[axis], dst[axis] = slice(0, n - offset), slice(offset, n)
+    else:
+        src[axis], dst[axis] = slice(-offset, n), slice(0, n + offset)
+    out[tuple(dst)] |= words[tuple(src)]
+
+
+def dilate_packed(words: np.ndarray, radius: float) -> np.ndarray:
+    """
+    Dilate packed masks by a disk, the same as `isotropic_dilation`.
+
+    The disk is split into rows, so each word is visited about 4 times per
+    pixel of radius, rather than once per pixel of the disk.
+    """
+    widths = _disk_widths(radius)
+    dilated = np.zeros_like(words)
+    horizontal = words.copy()
+
+    for w in range(max(widths) + 1):
+        if w > 0:
+            _shift_or(horizontal, words, w, axis=2)
+            _shift_or(horizontal, words, -w, axis=2)
+        for dy in widths.get(w, []):
+            _shift_or(dilated, horizontal, dy, axis=1)
+
+    return dilated
+
+
+def erode_packed(words: np.ndarray, radius: float) -> np.ndarray:
+    """Erode packed masks by a disk, treating pixels outside as masked, like odc.algo"""
+    return ~dilate_packed(~words, radius)
+
+
+def cleanup_masks(masks: np.ndarray, mask_filters: list) -> np.ndarray:
+    """
+    Apply morphological operations to each (y, x) slice of a stack of
+    boolean masks, giving the same result as `odc.algo.mask_cleanup_np` on
+    each slice. All slices are processed together as packed bits.
+
+    Parameters:
+    -----------
+    masks : np.ndarray
+        A boolean array with the spatial dimensions last.
+    mask_filters : list
+        Operations and radii, like [("opening", 5), ("dilation", 6)].
+
+    Returns:
+    --------
+    np.ndarray
+        The cleaned up masks, with the same shape as `masks`.
+    """
+    if masks.dtype != bool:
+        raise ValueError(f"Masks must be boolean, not {masks.dtype}")
+
+    shape = masks.shape
+    stacked = masks.reshape(-1, *shape[-2:])
+    words = pack_masks(stacked)
+
+    for operation, radius in mask_filters:
+        if operation not in MORPH_OPS:
+            raise ValueError(f"Not supported morphological operation: {operation}")
+        if radius <= 0:
+            continue
+
+        if operation in ("opening", "erosion"):
+            words = erode_packed(words, radius)
+        if operation in ("opening", "closing", "dilation"):
+            words = dilate_packed(words, radius)
+        if operation == "closing":
+            words = erode_packed(words, radius)
+
+    return unpack_masks(words, len(stacked)).reshape(shape)
+
+
+def xr_cleanup_masks(masks: xr.DataArray, mask_filters: list) -> xr.DataArray:
+    """
+    `cleanup_masks` for a DataArray with `y` and `x` as the last
+    dimensions. Dask arrays are processed chunk by chunk, with enough
+    overlap between neighbouring chunks for the operations.
+    """
+    data = masks.data.astype(bool)
+
+    if isinstance(data, da.Array):
+        # Openings and closings reach twice their radius
+        depth = sum(
+            int(np.ceil(radius)) * (2 if operation in ("opening", "closing") else 1)
+            for operation, radius in mask_filters
+        )
+        data = data.map_overlap(
+            cleanup_masks,
+            depth={data.ndim - 2: depth, data.ndim - 1: depth},
+            boundary="none",
+            dtype=bool,
+            mask_filters=mask_filters,
+        )
+    else:
+        data = cleanup_masks(data, mask_filters)
+
+    return xr.DataArray(data, coords=masks.coords, dims=masks.dims, attrs=masks.attrs)
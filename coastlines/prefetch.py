@@ -0,0 +1,128 @@
+from collections import defaultdict
+from math import floor
+from typing import Optional
+
+import click
+
+from coastlines.combined import (
+    get_bands,
+    get_query,
+    get_snapshot_path,
+    get_stac_catalog,
+)
+from coastlines.stac import (
+    get_search_fields,
+    partition_items,
+    write_item_snapshot,
+)
+from coastlines.utils import (
+    click_config_path,
+    configure_logging,
+    load_config,
+    load_json,
+    subset_tiles,
+)
+
+
+def group_tiles(bboxes: dict[str, tuple], group_size: float) -> list[list[str]]:
+    """Group tiles into square cells of `group_size` degrees by their bbox centre"""
+    groups = defaultdict(list)
+    for tile_id, (left, bottom, right, top) in bboxes.items():
+        x = floor((left + right) / 2 / group_size)
+        y = floor((bottom + top) / 2 / group_size)
+        groups[(x, y)].append(tile_id)
+
+    return list(groups.values())
+
+
+def union_bbox(bboxes: list[tuple]) -> tuple:
+    return (
+        min(b[0] for b in bboxes),
+        min(b[1] for b in bboxes),
+        max(b[2] for b in bboxes),
+        max(b[3] for b in bboxes),
+    )
+
+
+@click.command("coastlines-prefetch")
+@click_config_path
+@click.option("--tiles-subset", type=str, default="[]")
+@click.option("--limit", type=int, default=None, required=False)
+@click.option(
+    "--snapshot-location",
+    type=str,
+    default=None,
+    help="The local or S3 directory to write per-tile item snapshots to. "
+    "Defaults to `stac.snapshot_location` in the config file.",
+)
+@click.option(
+    "--group-size",
+    type=float,
+    default=2.0,
+    help="The size in degrees of the groups of tiles that are searched "
+    "together. Larger groups make fewer, larger searches. Defaults to 2.",
+)
+def cli(
+    config_path: str,
+    tiles_subset: str,
+    limit: Optional[int],
+    snapshot_location: Optional[str],
+    group_size: float,
+) -> None:
+    config = load_config(config_path, "coastlines")
+    log = configure_logging("Coastlines prefetch")
+
+    if config.stac is None:
+        raise ValueError("STAC config must be provided in config file")
+
+    if snapshot_location is None:
+        snapshot_location = config.stac.snapshot_location
+    if snapshot_location is None:
+        raise ValueError("A snapshot location must be provided")
+
+    tiles = load_json(config.input.grid_path)
+
+    tiles = subset_tiles(tiles, tiles_subset)
+
+    if limit is not None:
+        tiles = tiles[:limit]
+
+    if len(tiles) == 0:
+        log.warning("No tiles to prefetch")
+        return
+
+    # Use exactly the same query as each tile's own run would
+    queries = {
+        tile_id: get_query(config, tiles.loc[[tile_id]]) for tile_id in tiles.index
+    }
+    bboxes = {tile_id: query["bbox"] for tile_id, query in queries.items()}
+    datetime = next(iter(queries.values()))["datetime"]
+
+    groups = group_tiles(bboxes, group_size)
+    log.info(f"Prefetching items for {len(tiles)} tiles in {len(groups)} searches")
+
+    fields = None
+    if config.stac.project_fields:
+        fields = get_search_fields(get_bands(include_nir=config.options.include_nir))
+
+    catalog = get_stac_catalog(config)
+    for group in groups:
+        bbox = union_bbox([bboxes[tile_id] for tile_id in group])
+        items = catalog.item_collection(
+            {},
+            bbox=bbox,
+            datetime=datetime,
+            collections=config.stac.stac_collections,
+            fields=fields,
+        )
+        log.info(f"Found {len(items)} items for {len(group)} tiles in {bbox}")
+
+        partitioned = partition_items(items, {t: bboxes[t] for t in group})
+        for tile_id, tile_items in partitioned.items():
+            snapshot_path = get_snapshot_path(snapshot_location, tile_id)
+            write_item_snapshot(tile_items, snapshot_path)
+            log.info(f"Wrote {len(tile_items)} items for tile {tile_id}")
+
+
+if __name__ == "__main__":
+    cli()
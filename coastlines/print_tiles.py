@@ -1,15 +1,10 @@
 import json
 import sys
-from json.decoder import JSONDecodeError
 from typing import Optional
 
 import click
 
-from coastlines.utils import load_config, load_json
-
-
-def read_tiles_subset_string(tiles_subset: str) -> list:
-    return json.loads(tiles_subset)
+from coastlines.utils import load_config, load_json, subset_tiles
 
 
 @click.command("print-tiles")
@@ -21,18 +16,7 @@ def cli(config_file: str, config_type: str, tiles_subset: str, limit: Optional[i
     config = load_config(config_file, config_type)
     tiles = load_json(config.input.grid_path)
 
-    try:
-        subset_list = read_tiles_subset_string(tiles_subset)
-    except JSONDecodeError:
-        print(f"Tiles subset '{tiles_subset}' is not a valid JSON string")
-        sys.exit(1)
-
-    if len(subset_list) != 0:
-        try:
-            tiles = tiles.loc[subset_list]
-        except KeyError:
-            print("One or more tile keys was not found in the grid file")
-            sys.exit(1)
+    tiles = subset_tiles(tiles, tiles_subset)
 
     if limit is not None:
         tiles = tiles[:limit]
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import time
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from odc.geo.geobox import GeoBox
+from odc.loader import RioDriver, RioReader
+from odc.loader.types import RasterLoadParams, RasterSource
+
+from coastlines.utils import evict_least_recently_used
+
+STATS_FILE = "stats.log"
+
+
+class ChunkCache:
+    """
+    A local disk cache of raw raster reads, shared between Dask worker processes.
+
+    Each entry is one band of one scene read into one destination chunk,
+    stored as a `.npz` file named by a hash of the source, band, destination
+    GeoBox and load settings. The least recently used entries are removed
+    when the cache grows beyond `max_size_mb`.
+
+    Hits and misses are appended to a small stats file, so that they can be
+    summarised from the main process after a load.
+    """
+
+    def __init__(self, location: str, max_size_mb: float = 100_000):
+        self.location = Path(location)
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.location.mkdir(parents=True, exist_ok=True)
+        self._written_since_evict = 0
+
+    @staticmethod
+    def key(
+        src: RasterSource,
+        cfg: RasterLoadParams,
+        dst_geobox: GeoBox,
+        selection=None,
+    ) -> str:
+        params = {
+            "uri": src.uri,
+            "band": src.band,
+            "subdataset": src.subdataset,
+            "crs": str(dst_geobox.crs),
+            "affine": list(dst_geobox.affine)[:6],
+            "shape": list(dst_geobox.shape.yx),
+            "dtype": str(cfg.dtype),
+            "fill_value": cfg.fill_value,
+            "resampling": cfg.resampling,
+            "use_overviews": cfg.use_overviews,
+            "src_nodata_fallback": cfg.src_nodata_fallback,
+            "src_nodata_override": cfg.src_nodata_override,
+            "selection": repr(selection),
+        }
+        as_json = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(as_json.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.location / f"{key}.npz"
+
+    def _record(self, event: str, n_bytes: int) -> None:
+        # Small appends are atomic, so this is safe across processes
+        with open(self.location / STATS_FILE, "a") as f:
+            f.write(f"{event} {n_bytes}\n")
+
+    def get(self, key: str) -> tuple[tuple[slice, slice], np.ndarray] | None:
+        path = self._path(key)
+        try:
+            with np.load(path) as loaded:
+                roi_bounds = loaded["roi"]
+                data = loaded["data"]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # Missing, evicted or partly written entries are all misses
+            return None
+
+        try:
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        except FileNotFoundError:
+            # Evicted by another process since loading, but the data is still good
+            pass
+        self._record("hit", data.nbytes)
+
+        roi = tuple(slice(int(start), int(stop)) for start, stop in roi_bounds)
+        return roi, data
+
+    def put(self, key: str, roi: tuple[slice, ...], data: np.ndarray) -> None:
+        self._record("miss", data.nbytes)
+
+        roi_bounds = np.array(
+            [[r.start or 0, (r.start or 0) + n] for r, n in zip(roi, data.shape)]
+        )
+        path = self._path(key)
+        tmp_path = self.location / f"{key}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, roi=roi_bounds, data=data)
+        os.replace(tmp_path, path)
+
+        # Only scan the whole cache once a meaningful amount has been written
+        self._written_since_evict += data.nbytes
+        if self._written_since_evict > self.max_size_bytes * 0.05:
+            self.evict()
+
+    def evict(self) -> None:
+        self._written_since_evict = 0
+        evict_least_recently_used(self.location, "*.npz", self.max_size_bytes)
+
+    def reset_stats(self) -> None:
+        (self.location / STATS_FILE).unlink(missing_ok=True)
+
+    def stats(self) -> dict[str, int]:
+        stats = {"hits": 0, "hit_bytes": 0, "misses": 0, "miss_bytes": 0}
+        try:
+            with open(self.location / STATS_FILE) as f:
+                for line in f:
+                    event, n_bytes = line.split()
+                    stats["hits" if event == "hit" else "misses"] += 1
+                    stats[f"{event}_bytes"] += int(n_bytes)
+        except FileNotFoundError:
+            pass
+
+        return stats
+
+    def summary(self) -> str:
+        stats = self.stats()
+        total = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / total if total > 0 else 0
+        return (
+            f"Read cache: {stats['hits']} hits ({stats['hit_bytes'] / 1e9:.2f} GB), "
+            f"{stats['misses']} misses ({stats['miss_bytes'] / 1e9:.2f} GB), "
+            f"{hit_rate:.0%} hit rate"
+        )
+
+
+class CachingRioReader(RioReader):
+    def __init__(self, src: RasterSource, ctx, cache: ChunkCache) -> None:
+        super().__init__(src, ctx)
+        self._cache = cache
+
+    def read(
+        self,
+        cfg: RasterLoadParams,
+        dst_geobox: GeoBox,
+        *,
+        dst: np.ndarray | None = None,
+        selection=None,
+    ) -> tuple[tuple[slice, slice], np.ndarray]:
+        key = self._cache.key(self._src, cfg, dst_geobox, selection)
+        cached = self._cache.get(key)
+        if cached is not None:
+            roi, data = cached
+            if dst is None:
+                return roi, data
+            dst[roi] = data
+            return roi, dst[roi]
+
+        roi, data = super().read(cfg, dst_geobox, dst=dst, selection=selection)
+        self._cache.put(key, roi, data)
+
+        return roi, data
+
+
+class CachingRioDriver(RioDriver):
+    """
+    The default rasterio reader driver for `odc.stac.load`, with reads
+    going through a `ChunkCache` first.
+    """
+
+    def __init__(self, cache: ChunkCache) -> None:
+        super().__init__()
+        self.cache = cache
+
+    def open(self, src: RasterSource, ctx) -> CachingRioReader:
+        return CachingRioReader(src, ctx, self.cache)
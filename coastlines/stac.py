@@ -0,0 +1,554 @@
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import NamedTuple
+
+import fsspec
+import geopandas as gpd
+from pystac import Item, ItemCollection
+from pystac_client import Client
+from odc.geo.geobox import GeoBox
+from shapely import STRtree, unary_union
+from shapely.geometry import box, shape
+from shapely.geometry.base import BaseGeometry
+
+from coastlines.utils import evict_least_recently_used
+
+
+# Item properties used by the pipeline. Everything else can be left out of searches
+SCENE_PROPERTIES = [
+    "datetime",
+    "eo:cloud_cover",
+    "landsat:collection_category",
+    "proj:code",
+    "proj:shape",
+    "proj:transform",
+    "view:sun_azimuth",
+    "view:sun_elevation",
+]
+
+
+class SceneRecord(NamedTuple):
+    """The few properties of a scene that are needed after loading"""
+
+    id: str
+    datetime: datetime
+    collection_category: str | None
+    cloud_cover: float | None
+    epsg: str | None
+    sun_elevation: float | None
+    sun_azimuth: float | None
+
+    @classmethod
+    def from_item(cls, item: Item) -> "SceneRecord":
+        properties = item.properties
+        return cls(
+            id=item.id,
+            datetime=item.datetime,
+            collection_category=properties.get("landsat:collection_category"),
+            cloud_cover=properties.get("eo:cloud_cover"),
+            epsg=properties.get("proj:code"),
+            sun_elevation=properties.get("view:sun_elevation"),
+            sun_azimuth=properties.get("view:sun_azimuth"),
+        )
+
+
+def get_search_fields(bands: list[str]) -> list[str]:
+    """Fields extension includes that limit a search to what the pipeline uses"""
+    return [
+        "id",
+        "type",
+        "stac_version",
+        "stac_extensions",
+        "collection",
+        "geometry",
+        "bbox",
+        *[f"properties.{p}" for p in SCENE_PROPERTIES],
+        *[f"assets.{band}" for band in bands],
+    ]
+
+
+def slim_item(item: Item, bands: list[str]) -> Item:
+    """Drop the links, assets and properties of an item that the pipeline doesn't use"""
+    item.properties = {
+        k: v for k, v in item.properties.items() if k in SCENE_PROPERTIES
+    }
+    item.assets = {k: v for k, v in item.assets.items() if k in bands}
+    item.links = []
+    item.extra_fields = {}
+
+    return item
+
+
+class StacSearchCache:
+    """
+    A small on-disk cache of STAC search results.
+
+    Each entry is a JSON file named by a hash of the search parameters.
+    Entries older than `ttl_hours` are treated as missing, and the least
+    recently used entries are removed once the cache grows beyond
+    `max_size_mb`.
+
+    Parameters:
+    -----------
+    location : str
+        A local directory to store cached search results in.
+    ttl_hours : float, optional
+        How long a cached result stays valid for. Defaults to one week.
+    max_size_mb : float, optional
+        The maximum total size of the cache. Defaults to 1024 MB.
+    """
+
+    def __init__(
+        self, location: str, ttl_hours: float = 168, max_size_mb: float = 1024
+    ):
+        self.location = Path(location)
+        self.ttl_seconds = ttl_hours * 60 * 60
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.location.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(**params) -> str:
+        """Build a stable cache key from a set of JSON-serialisable parameters"""
+        as_json = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(as_json.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.location / f"{key}.json"
+
+    def get(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if now - stat.st_mtime > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            return None
+
+        try:
+            with open(path) as f:
+                value = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            # A partial or corrupt entry is just a miss
+            path.unlink(missing_ok=True)
+            return None
+
+        # Record the access time explicitly, so eviction works on noatime mounts
+        os.utime(path, (now, stat.st_mtime))
+
+        return value
+
+    def put(self, key: str, value: dict) -> None:
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove expired entries, then least recently used ones until under size"""
+        evict_least_recently_used(
+            self.location, "*.json", self.max_size_bytes, self.ttl_seconds
+        )
+
+
+class CachedCatalog:
+    """
+    A thin wrapper around a STAC API that optionally caches search results.
+
+    The underlying `pystac_client.Client` is only opened when a search
+    misses the cache, so a fully cached run makes no STAC API calls.
+    """
+
+    def __init__(self, stac_api_url: str, cache: StacSearchCache | None = None):
+        self.stac_api_url = stac_api_url
+        self.cache = cache
+        self._client = None
+
+    @property
+    def client(self) -> Client:
+        if self._client is None:
+            self._client = Client.open(self.stac_api_url)
+        return self._client
+
+    def _key(self, kind: str, query_filter: dict, query: dict) -> str:
+        return self.cache.key(
+            kind=kind,
+            stac_api_url=self.stac_api_url,
+            bbox=query.get("bbox"),
+            datetime=query.get("datetime"),
+            collections=query.get("collections"),
+            query=query_filter,
+            fields=query.get("fields"),
+        )
+
+    def matched(self, query_filter: dict, **query) -> int:
+        """Return the number of items matching a search"""
+        if self.cache is None:
+            return self.client.search(query=query_filter, **query).matched()
+
+        key = self._key("matched", query_filter, query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached["matched"]
+
+        n_items = self.client.search(query=query_filter, **query).matched()
+        self.cache.put(key, {"matched": n_items})
+
+        return n_items
+
+    def item_collection(self, query_filter: dict, **query) -> ItemCollection:
+        """Return all the items matching a search"""
+        if self.cache is None:
+            return self.client.search(query=query_filter, **query).item_collection()
+
+        key = self._key("items", query_filter, query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return ItemCollection.from_dict(cached)
+
+        items = self.client.search(query=query_filter, **query).item_collection()
+        self.cache.put(key, items.to_dict(transform_hrefs=False))
+
+        return items
+
+
+def select_scenes(items: list[Item], lower_limit: int, upper_limit: int) -> list[Item]:
+    """
+    Choose scenes from a full set of candidate items, without further searches.
+
+    This mirrors the server-side search sequence: T1 scenes only, unless there
+    are fewer than `lower_limit` of them, then stepping the cloud cover limit
+    down by 5% (to no lower than 50%) while there are more than `upper_limit`.
+
+    Parameters:
+    -----------
+    items : list[pystac.Item]
+        All T1 and T2 candidate items for the area and time range.
+    lower_limit : int
+        The minimum number of scenes wanted.
+    upper_limit : int
+        The maximum number of scenes wanted.
+
+    Returns:
+    --------
+    list[pystac.Item]
+        The selected items, which may still be outside the limits if the
+        candidates don't allow otherwise.
+    """
+    selected = [
+        item
+        for item in items
+        if item.properties.get("landsat:collection_category") == "T1"
+    ]
+
+    # If we don't have enough T1 items, use T2 as well
+    if len(selected) < lower_limit:
+        print("Warning, not enough T1 items found, using T2 items as well")
+        selected = list(items)
+
+    candidates = selected
+    percentage = 100
+    while len(selected) > upper_limit:
+        percentage -= 5
+        print(
+            f"Warning, too many items found ({len(selected)} > {upper_limit}). Filtering to {percentage}% clouds"
+        )
+        selected = [
+            item
+            for item in candidates
+            if item.properties.get("eo:cloud_cover") is not None
+            and item.properties["eo:cloud_cover"] < percentage
+        ]
+        if percentage == 50:
+            break
+
+    return selected
+
+
+def _parse_datetime(value: str, end: bool = False) -> datetime | None:
+    """Parse one side of a STAC datetime range, where a year or day covers all of it"""
+    if value in ("", ".."):
+        return None
+    if len(value) == 4:
+        if end:
+            parsed = datetime(int(value), 12, 31, 23, 59, 59, 999999)
+        else:
+            parsed = datetime(int(value), 1, 1)
+    else:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if end and len(value) == 10:
+            parsed = parsed.replace(hour=23, minute=59, second=59, microsecond=999999)
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+
+    return parsed
+
+
+def _matches_filter(properties: dict, query_filter: dict) -> bool:
+    """Evaluate a STAC API query extension filter against an item's properties"""
+    operators = {
+        "eq": lambda a, b: a == b,
+        "neq": lambda a, b: a != b,
+        "lt": lambda a, b: a < b,
+        "lte": lambda a, b: a <= b,
+        "gt": lambda a, b: a > b,
+        "gte": lambda a, b: a >= b,
+        "in": lambda a, b: a in b,
+    }
+    for name, conditions in query_filter.items():
+        value = properties.get(name)
+        for op, target in conditions.items():
+            if op not in operators:
+                raise ValueError(f"Unsupported query operator: {op}")
+            if value is None or not operators[op](value, target):
+                return False
+
+    return True
+
+
+def item_matches(item: Item, query_filter: dict, **query) -> bool:
+    """
+    Check whether an item would be returned by a STAC API search.
+
+    Supports the `bbox`, `datetime` and `collections` search parameters,
+    and the query extension operators used in Coastlines.
+    """
+    collections = query.get("collections")
+    if collections is not None and item.collection_id not in collections:
+        return False
+
+    bbox = query.get("bbox")
+    if bbox is not None and item.geometry is not None:
+        if not shape(item.geometry).intersects(box(*bbox)):
+            return False
+
+    datetime_range = query.get("datetime")
+    if datetime_range is not None:
+        start_text, separator, end_text = datetime_range.partition("/")
+        if not separator:
+            end_text = start_text
+        start = _parse_datetime(start_text)
+        end = _parse_datetime(end_text, end=True)
+        item_datetime = item.datetime
+        if item_datetime.tzinfo is None:
+            item_datetime = item_datetime.replace(tzinfo=timezone.utc)
+        if start is not None and item_datetime < start:
+            return False
+        if end is not None and item_datetime > end:
+            return False
+
+    return _matches_filter(item.properties, query_filter)
+
+
+class SnapshotCatalog:
+    """
+    A catalog backed by a fixed list of items, such as a prefetched snapshot.
+
+    It has the same interface as `CachedCatalog`, but evaluates searches
+    locally, so it never makes STAC API calls.
+    """
+
+    def __init__(self, items: list[Item]):
+        self.items = list(items)
+
+    def matched(self, query_filter: dict, **query) -> int:
+        """Return the number of items matching a search"""
+        return len(self.item_collection(query_filter, **query))
+
+    def item_collection(self, query_filter: dict, **query) -> ItemCollection:
+        """Return all the items matching a search"""
+        return ItemCollection(
+            [i for i in self.items if item_matches(i, query_filter, **query)]
+        )
+
+
+def _is_ndjson(path: str) -> bool:
+    return str(path).endswith((".ndjson", ".jsonl"))
+
+
+def write_item_snapshot(items: list[Item], path: str) -> None:
+    """Write items to a local or S3 path as ItemCollection JSON, or NDJSON"""
+    with fsspec.open(path, mode="w") as f:
+        if _is_ndjson(path):
+            for item in items:
+                f.write(json.dumps(item.to_dict(transform_hrefs=False)) + "\n")
+        else:
+            json.dump(ItemCollection(items).to_dict(transform_hrefs=False), f)
+
+
+def read_item_snapshot(path: str) -> ItemCollection:
+    """
+    Read items from a local or S3 snapshot file.
+
+    Files ending in `.parquet` or `.geoparquet` are read as stac-geoparquet,
+    which needs the optional `stac-geoparquet` package. Files ending in
+    `.ndjson` or `.jsonl` are read as one item per line. Anything else is
+    read as an ItemCollection (or a plain list of items) in JSON.
+    """
+    if str(path).endswith((".parquet", ".geoparquet")):
+        try:
+            import pyarrow.parquet as pq
+            from stac_geoparquet.arrow import stac_table_to_items
+        except ImportError as e:
+            raise ImportError(
+                "Reading GeoParquet snapshots needs the stac-geoparquet package"
+            ) from e
+
+        with fsspec.open(path, mode="rb") as f:
+            table = pq.read_table(f)
+        return ItemCollection(Item.from_dict(i) for i in stac_table_to_items(table))
+
+    with fsspec.open(path, mode="r") as f:
+        if _is_ndjson(path):
+            return ItemCollection(
+                Item.from_dict(json.loads(line)) for line in f if line.strip()
+            )
+
+        loaded = json.load(f)
+
+    if isinstance(loaded, list):
+        return ItemCollection(Item.from_dict(i) for i in loaded)
+
+    return ItemCollection.from_dict(loaded)
+
+
+def partition_items(
+    items: list[Item], bboxes: dict[str, tuple]
+) -> dict[str, list[Item]]:
+    """
+    Assign items to each of a set of bounding boxes that their footprint intersects.
+
+    Parameters:
+    -----------
+    items : list[pystac.Item]
+        Items covering the union of all the bounding boxes.
+    bboxes : dict[str, tuple]
+        Bounding boxes in EPSG:4326, keyed by tile ID.
+
+    Returns:
+    --------
+    dict[str, list[pystac.Item]]
+        The items intersecting each bounding box, keyed by tile ID.
+    """
+    tile_ids = list(bboxes.keys())
+    tree = STRtree([box(*bboxes[tile_id]) for tile_id in tile_ids])
+
+    partitioned = {tile_id: [] for tile_id in tile_ids}
+    for item in items:
+        for index in tree.query(shape(item.geometry), predicate="intersects"):
+            partitioned[tile_ids[index]].append(item)
+
+    return partitioned
+
+
+def solar_day(item: Item) -> date:
+    """The local solar day of an item, as used when grouping by solar day"""
+    longitude = (item.bbox[0] + item.bbox[2]) / 2 if item.bbox else 0
+    return (item.datetime + timedelta(hours=longitude / 15)).date()
+
+
+def footprint_coverage(items: list[Item], area: BaseGeometry) -> list[float]:
+    """
+    Calculate the fraction of an area covered by each item's footprint.
+
+    Parameters:
+    -----------
+    items : list[pystac.Item]
+        Items with footprint geometries in EPSG:4326. Items without a
+        geometry are assumed to cover the whole area.
+    area : shapely.geometry.base.BaseGeometry
+        The area of interest in EPSG:4326.
+
+    Returns:
+    --------
+    list[float]
+        The covered fraction of `area`, from 0 to 1, for each item.
+    """
+    return _coverage([_footprint(i, area) for i in items], area)
+
+
+def solar_day_coverage(items: list[Item], area: BaseGeometry) -> list[float]:
+    """
+    Calculate the fraction of an area covered by all the footprints from
+    each item's solar day, which are merged into one timestep when loading
+    with `group_by="solar_day"`.
+
+    Parameters:
+    -----------
+    items : list[pystac.Item]
+        Items with footprint geometries in EPSG:4326. Items without a
+        geometry are assumed to cover the whole area.
+    area : shapely.geometry.base.BaseGeometry
+        The area of interest in EPSG:4326.
+
+    Returns:
+    --------
+    list[float]
+        The covered fraction of `area`, from 0 to 1, for each item's day.
+    """
+    days = [solar_day(i) for i in items]
+    footprints = defaultdict(list)
+    for day, item in zip(days, items):
+        footprints[day].append(_footprint(item, area))
+
+    day_list = list(footprints)
+    coverage = _coverage([unary_union(footprints[d]) for d in day_list], area)
+    day_coverage = dict(zip(day_list, coverage))
+
+    return [day_coverage[day] for day in days]
+
+
+def _footprint(item: Item, area: BaseGeometry) -> BaseGeometry:
+    return shape(item.geometry) if item.geometry is not None else area
+
+
+def _coverage(footprints: list[BaseGeometry], area: BaseGeometry) -> list[float]:
+    area_series = gpd.GeoSeries([area], crs="EPSG:4326")
+    utm_crs = area_series.estimate_utm_crs()
+    projected_area = area_series.to_crs(utm_crs).iloc[0]
+
+    footprints = gpd.GeoSeries(footprints, crs="EPSG:4326").to_crs(utm_crs)
+    coverage = footprints.intersection(projected_area).area / projected_area.area
+
+    return [min(c, 1.0) for c in coverage]
+
+
+def is_grid_aligned(item: Item, geobox: GeoBox) -> bool:
+    """
+    Check whether an item's pixel grid lines up exactly with a GeoBox.
+
+    Aligned scenes share the CRS and resolution of the GeoBox, and are only
+    offset by a whole number of pixels, so they can be read without
+    resampling. Items without projection metadata are treated as unaligned.
+    """
+    code = item.properties.get("proj:code")
+    transform = item.properties.get("proj:transform")
+    if code is None or transform is None:
+        return False
+
+    if geobox.crs != code:
+        return False
+
+    a, b, c, d, e, f = transform[:6]
+    affine = geobox.affine
+    if b != 0 or d != 0 or abs(a - affine.a) > 1e-6 or abs(e - affine.e) > 1e-6:
+        return False
+
+    x_offset = (c - affine.c) / a
+    y_offset = (f - affine.f) / e
+
+    return (
+        abs(x_offset - round(x_offset)) < 1e-6
+        and abs(y_offset - round(y_offset)) < 1e-6
+    )
@@ -0,0 +1,301 @@
+import hashlib
+import io
+import json
+import uuid
+
+import fsspec
+import numpy as np
+from odc.geo.geobox import GeoBox
+from odc.stac import load
+from pystac_client import Client
+
+from coastlines.morphology import cleanup_masks
+from coastlines.utils import CoastlinesException
+
+DEM_STAC_CATALOG = "https://earth-search.aws.element84.com/v1/"
+DEM_STAC_COLLECTION = "cop-dem-glo-30"
+
+
+class TerrainShadow:
+    """
+    Shadow masks for one DEM under many sun positions.
+
+    Surface normals are calculated from the DEM once, so each sun position
+    only costs a dot product. Values match `dea_tools.spatial.hillshade`,
+    which rescales each hillshade to between 0 and 1.
+
+    Parameters:
+    -----------
+    dem: np.ndarray
+        A 2D elevation array
+    dx, dy: float
+        The x and y spacing of the DEM pixels
+    vert_exag: float
+        How much to exaggerate elevation values by
+    """
+
+    def __init__(
+        self, dem: np.ndarray, dx: float = 30, dy: float = 30, vert_exag: float = 1
+    ):
+        self.shape = dem.shape
+
+        # As in matplotlib, rows run top to bottom so dy is negative
+        e_dy, e_dx = np.gradient(vert_exag * np.asarray(dem, dtype="float64"), -dy, dx)
+        magnitude = np.sqrt(e_dx**2 + e_dy**2 + 1)
+        self.normals = np.stack([-e_dx / magnitude, -e_dy / magnitude, 1 / magnitude])
+        self.normals = self.normals.reshape(3, -1).astype("float32")
+
+        # The steepest slope in degrees, with nodata ignored
+        self.max_slope = float(np.degrees(np.arccos(np.nanmin(self.normals[2]))))
+
+    @staticmethod
+    def direction(elevation: np.ndarray, azimuth: np.ndarray) -> np.ndarray:
+        """Unit vectors pointing towards the sun, one row per sun position"""
+        az = np.radians(90 - np.asarray(azimuth, dtype="float64"))
+        alt = np.radians(np.asarray(elevation, dtype="float64"))
+        return np.stack(
+            [np.cos(az) * np.cos(alt), np.sin(az) * np.cos(alt), np.sin(alt)], axis=-1
+        )
+
+    def can_cast_shadow(self, elevation: np.ndarray) -> np.ndarray:
+        """
+        Whether any slope can face away from a sun at each elevation, which
+        needs the sun to be no higher than the steepest slope. This uses the
+        unscaled illumination, as a rescaled hillshade always has dark pixels.
+        """
+        return np.asarray(elevation) <= self.max_slope
+
+    def hillshade(self, elevation: np.ndarray, azimuth: np.ndarray) -> np.ndarray:
+        """Hillshade for each sun position, with shape (n_positions, y, x)"""
+        intensity = self.direction(elevation, azimuth).astype("float32") @ self.normals
+
+        # Rescale each hillshade to 0-1, as dea_tools.spatial.hillshade does
+        imin = intensity.min(axis=1, keepdims=True)
+        imax = intensity.max(axis=1, keepdims=True)
+        stretch = (imax - imin) > 1e-6
+        intensity -= np.where(stretch, imin, 0)
+        intensity /= np.where(stretch, imax - imin, 1)
+        np.clip(intensity, 0, 1, out=intensity)
+
+        return intensity.reshape(-1, *self.shape)
+
+    def shadow(
+        self,
+        elevation: np.ndarray,
+        azimuth: np.ndarray,
+        threshold: float = 0.25,
+        batch_size: int = 8,
+    ) -> np.ndarray:
+        """Boolean shadow masks for each sun position, evaluated in batches"""
+        shadow = np.empty((len(elevation), *self.shape), dtype=bool)
+        for start in range(0, len(elevation), batch_size):
+            batch = slice(start, start + batch_size)
+            shadow[batch] = self.hillshade(elevation[batch], azimuth[batch]) < threshold
+
+        return shadow
+
+
+def terrain_shadow_masks(
+    dem: np.ndarray,
+    elevation: np.ndarray,
+    azimuth: np.ndarray,
+    threshold: float = 0.25,
+    radius: int = 1,
+    angle_tolerance: float = 0,
+    skip_unshadowed: bool = False,
+    dx: float = 30,
+    dy: float = 30,
+) -> np.ndarray:
+    """
+    Shadow masks for a DEM at each sun elevation and azimuth.
+
+    Sun positions within `angle_tolerance` degrees of each other, like
+    repeat visits to the same path/row, can share one mask.
+
+    Each hillshade is rescaled to 0-1, so pixels below `threshold` are the
+    least lit in that image, and there are always some unless the DEM is
+    flat. With `skip_unshadowed`, sun positions higher than the steepest
+    slope in the DEM aren't masked at all. No slope faces away from such a
+    sun, so these masks only ever hold dimly lit slopes, not shadow. This
+    differs from `dea_tools.spatial.hillshade`, which masks them anyway.
+
+    Parameters:
+    -----------
+    dem: np.ndarray
+        A 2D elevation array
+    elevation, azimuth: np.ndarray
+        The sun elevation and azimuth in degrees, one for each mask
+    threshold: float
+        Hillshade values below this are treated as shadow
+    radius: int
+        The radius of the opening and dilation applied to each mask
+    angle_tolerance: float
+        Sun positions are rounded to this many degrees before masking, so
+        nearby positions share a mask. Defaults to 0, which masks each sun
+        position separately.
+    skip_unshadowed: bool
+        Whether to leave masks empty where no slope faces away from the sun,
+        based on the unscaled illumination rather than the rescaled hillshade
+
+    Returns:
+    --------
+    np.ndarray
+        A boolean array with shape (n_positions, y, x), True for shadow
+    """
+    terrain = TerrainShadow(dem, dx=dx, dy=dy)
+    masks, inverse = _unique_shadow_masks(
+        terrain, elevation, azimuth, threshold, radius, angle_tolerance, skip_unshadowed
+    )
+    return masks[inverse]
+
+
+def iter_terrain_shadow_masks(
+    dem: np.ndarray,
+    elevation: np.ndarray,
+    azimuth: np.ndarray,
+    block_size: int = 256,
+    threshold: float = 0.25,
+    radius: int = 1,
+    angle_tolerance: float = 0,
+    skip_unshadowed: bool = False,
+    dx: float = 30,
+    dy: float = 30,
+):
+    """
+    The same masks as `terrain_shadow_masks`, made `block_size` sun
+    positions at a time, so only one block of masks is held in memory.
+
+    Yields the index of the first position in each block, the block's
+    distinct masks, and the index into them for each position in the block.
+    """
+    terrain = TerrainShadow(dem, dx=dx, dy=dy)
+    for start in range(0, len(elevation), block_size):
+        stop = start + block_size
+        masks, inverse = _unique_shadow_masks(
+            terrain,
+            elevation[start:stop],
+            azimuth[start:stop],
+            threshold,
+            radius,
+            angle_tolerance,
+            skip_unshadowed,
+        )
+        yield start, masks, inverse
+
+
+def _unique_shadow_masks(
+    terrain: TerrainShadow,
+    elevation: np.ndarray,
+    azimuth: np.ndarray,
+    threshold: float,
+    radius: int,
+    angle_tolerance: float,
+    skip_unshadowed: bool,
+) -> tuple[np.ndarray, np.ndarray]:
+    """A shadow mask for each distinct sun position, and the index into them"""
+    elevation = np.asarray(elevation, dtype="float64")
+    azimuth = np.asarray(azimuth, dtype="float64")
+
+    if angle_tolerance > 0:
+        elevation = np.round(elevation / angle_tolerance) * angle_tolerance
+        azimuth = np.round(azimuth / angle_tolerance) * angle_tolerance
+    positions, inverse = np.unique(
+        np.stack([elevation, azimuth], axis=1), axis=0, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+
+    masks = np.zeros((len(positions), *terrain.shape), dtype=bool)
+    to_mask = np.ones(len(positions), dtype=bool)
+    if skip_unshadowed:
+        to_mask = terrain.can_cast_shadow(positions[:, 0])
+
+    if to_mask.any():
+        shadow = terrain.shadow(
+            positions[to_mask, 0], positions[to_mask, 1], threshold=threshold
+        )
+        masks[to_mask] = cleanup_masks(
+            shadow, [("opening", radius), ("dilation", radius)]
+        )
+
+    return masks, inverse
+
+
+class DemCache:
+    """
+    A persistent store of DEMs, already loaded onto a GeoBox.
+
+    Each DEM is one compressed `.npz` file, named by a hash of the GeoBox
+    and the STAC collection it came from, in a local or S3 directory.
+    Tiles on a fixed grid always have the same GeoBox, so the cache can be
+    filled ahead of time with `coastlines-dem-cache`.
+    """
+
+    def __init__(self, location: str):
+        self.fs, self.root = fsspec.core.url_to_fs(location)
+        self.fs.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(geobox: GeoBox, stac_catalog: str, stac_collection: str) -> str:
+        params = {
+            # A dataset's CRS prints as WKT, so use the EPSG code where there is one
+            "crs": geobox.crs.epsg or geobox.crs.to_wkt(),
+            "affine": list(geobox.affine)[:6],
+            "shape": list(geobox.shape.yx),
+            "stac_catalog": stac_catalog,
+            "stac_collection": stac_collection,
+        }
+        as_json = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(as_json.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return f"{self.root}/{key}.npz"
+
+    def get(self, key: str) -> np.ndarray | None:
+        try:
+            with self.fs.open(self._path(key), "rb") as f:
+                with np.load(io.BytesIO(f.read())) as loaded:
+                    return loaded["dem"]
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, dem: np.ndarray) -> None:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, dem=dem)
+
+        # Write then move, so that concurrent readers never see part of a file
+        tmp_path = f"{self.root}/{key}.{uuid.uuid4().hex}.tmp"
+        with self.fs.open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        self.fs.mv(tmp_path, self._path(key))
+
+
+def load_dem(
+    geobox: GeoBox,
+    stac_catalog: str = DEM_STAC_CATALOG,
+    stac_collection: str = DEM_STAC_COLLECTION,
+    dem_cache: DemCache | None = None,
+) -> np.ndarray:
+    """
+    Load a DEM onto `geobox` from a STAC collection, reading it from
+    `dem_cache` instead if it is there.
+    """
+    key = None
+    if dem_cache is not None:
+        key = dem_cache.key(geobox, stac_catalog, stac_collection)
+        dem = dem_cache.get(key)
+        if dem is not None:
+            return dem
+
+    client = Client.open(stac_catalog)
+    bbox = list(geobox.extent.to_crs("epsg:4326").boundingbox)
+    dem_items = list(client.search(collections=[stac_collection], bbox=bbox).items())
+
+    if len(dem_items) == 0:
+        raise CoastlinesException("No DEM items found.")
+
+    dem = load(dem_items, geobox=geobox, measurements=["data"]).squeeze().data.values
+
+    if dem_cache is not None:
+        dem_cache.put(key, dem)
+
+    return dem
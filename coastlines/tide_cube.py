@@ -0,0 +1,92 @@
+from typing import Optional
+
+import click
+
+from coastlines.tides import build_tide_cube
+from coastlines.utils import (
+    click_config_path,
+    configure_logging,
+    load_config,
+    load_json,
+    subset_tiles,
+)
+
+
+@click.command("coastlines-tide-cube")
+@click_config_path
+@click.option("--tide-data-location", type=str, required=True)
+@click.option(
+    "--output-location",
+    type=str,
+    default=None,
+    help="The local or S3 Zarr store to write the tide cube to. "
+    "Defaults to `options.tide_cube_location` in the config file.",
+)
+@click.option("--tiles-subset", type=str, default="[]")
+@click.option(
+    "--resolution",
+    type=float,
+    default=0.05,
+    help="The resolution of the tide cube in degrees. Defaults to 0.05.",
+)
+@click.option(
+    "--buffer",
+    type=float,
+    default=0.25,
+    help="How far around the tiles to model tides, in degrees. This needs to "
+    "cover the buffer `pixel_tides` adds around each tile. Defaults to 0.25.",
+)
+@click.option(
+    "--freq",
+    type=str,
+    default="1h",
+    help="The time step to model tides at, which needs to divide a day "
+    "evenly. Defaults to '1h'.",
+)
+def cli(
+    config_path: str,
+    tide_data_location: str,
+    output_location: Optional[str],
+    tiles_subset: str,
+    resolution: float,
+    buffer: float,
+    freq: str,
+) -> None:
+    config = load_config(config_path, "coastlines")
+    log = configure_logging("Coastlines tide cube")
+
+    if output_location is None:
+        output_location = config.options.tide_cube_location
+    if output_location is None:
+        raise ValueError("An output location must be provided")
+
+    tiles = load_json(config.input.grid_path)
+
+    tiles = subset_tiles(tiles, tiles_subset)
+
+    # Cover the extra years loaded for gapfilling
+    start_year = config.options.start_year - 1
+    end_year = config.options.end_year + 1
+    log.info(
+        f"Building a tide cube for {len(tiles)} tiles from {start_year} to {end_year}"
+    )
+
+    build_tide_cube(
+        tiles,
+        output_location,
+        start_year,
+        end_year,
+        model=config.options.tide_model,
+        directory=tide_data_location,
+        resolution=resolution,
+        buffer=buffer,
+        freq=freq,
+        ensemble_models=config.options.ensemble_model_list,
+        ranking_points=config.options.ensemble_model_rankings,
+    )
+
+    log.info(f"Wrote tide cube to {output_location}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,218 @@
+import os
+import secrets
+import threading
+from multiprocessing.connection import Client, Listener
+
+import click
+import numpy as np
+import pandas as pd
+from eo_tides.model import model_tides
+
+from coastlines.utils import (
+    click_config_path,
+    configure_logging,
+    load_config,
+)
+
+DEFAULT_ADDRESS = "/tmp/coastlines-tides.sock"
+AUTHKEY_VARIABLE = "COASTLINES_TIDE_SERVICE_KEY"
+
+
+def get_authkey(address: str) -> bytes:
+    """
+    The key that clients use to connect to the service at `address`.
+
+    This is `COASTLINES_TIDE_SERVICE_KEY` if it is set, otherwise the key
+    that `serve` wrote next to the socket.
+    """
+    if os.environ.get(AUTHKEY_VARIABLE):
+        return os.environ[AUTHKEY_VARIABLE].encode()
+
+    with open(f"{address}.key", "rb") as f:
+        return f.read()
+
+
+def write_authkey(address: str) -> bytes:
+    """Write a new random key next to the socket, readable only by this user"""
+    path = f"{address}.key"
+    if os.path.exists(path):
+        os.remove(path)
+
+    authkey = secrets.token_hex(32).encode()
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+        f.write(authkey)
+
+    return authkey
+
+
+class TideModels:
+    """
+    Runs `eo_tides.model.model_tides` for the tide models in `directory`.
+
+    Requests are modelled with the same arguments as `pixel_tides` and
+    `stored_model_tides` pass to `eo_tides`, so the service returns exactly
+    what each tile would have modelled itself.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        model: str,
+        ensemble_models: list[str] | None = None,
+        ranking_points: str | None = None,
+    ):
+        self.directory = directory
+        self.model = model
+        self.ensemble_models = ensemble_models
+        self.ranking_points = ranking_points
+
+    def config(self) -> dict:
+        return {
+            "model": self.model,
+            "ensemble_models": self.ensemble_models,
+            "ranking_points": self.ranking_points,
+        }
+
+    def model_tides(
+        self, x: np.ndarray, y: np.ndarray, time: np.ndarray, crs: str, mode: str = "one-to-many"
+    ) -> pd.DataFrame:
+        """Tides in the long format returned by `eo_tides.model.model_tides`"""
+        return model_tides(
+            x,
+            y,
+            time,
+            model=self.model,
+            directory=self.directory,
+            crs=crs,
+            mode=mode,
+            ensemble_models=self.ensemble_models,
+            ranking_points=self.ranking_points,
+        )
+
+
+class TideServiceClient:
+    """
+    Sends tide predictions to a `coastlines-tide-service` running on this
+    machine, with the same call signature as `eo_tides.model.model_tides`.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        self.address = address
+
+    def _request(self, request: dict):
+        with Client(
+            self.address, family="AF_UNIX", authkey=get_authkey(self.address)
+        ) as connection:
+            connection.send(request)
+            status, result = connection.recv()
+
+        if status == "error":
+            raise RuntimeError(f"Tide service failed: {result}")
+
+        return result
+
+    def model_tides(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        time: np.ndarray,
+        crs: str,
+        model: str,
+        directory: str | None = None,
+        mode: str = "one-to-many",
+        ensemble_models: list[str] | None = None,
+        ranking_points: str | None = None,
+    ) -> pd.DataFrame:
+        # The service has its own model files, so only check it runs the same models
+        config = {
+            "model": model,
+            "ensemble_models": ensemble_models,
+            "ranking_points": ranking_points,
+        }
+        service_config = self._request({"action": "config"})
+        if service_config != config:
+            raise ValueError(
+                f"The tide service is running {service_config}, not {config}"
+            )
+
+        return self._request(
+            {
+                "action": "model_tides",
+                "x": np.asarray(x),
+                "y": np.asarray(y),
+                "time": pd.DatetimeIndex(time).to_numpy(),
+                "crs": crs,
+                "mode": mode,
+            }
+        )
+
+
+def _handle(connection, tide_models: TideModels, log) -> None:
+    with connection:
+        try:
+            request = connection.recv()
+            if request["action"] == "config":
+                result = tide_models.config()
+            else:
+                result = tide_models.model_tides(
+                    request["x"],
+                    request["y"],
+                    request["time"],
+                    request["crs"],
+                    mode=request["mode"],
+                )
+                log.info(f"Modelled {len(result)} tide heights")
+            connection.send(("ok", result))
+        except Exception as e:
+            log.exception("Tide service request failed")
+            connection.send(("error", repr(e)))
+
+
+def serve(tide_models: TideModels, address: str, log) -> None:
+    """Answer requests from `TideServiceClient`s until interrupted"""
+    if os.path.exists(address):
+        os.remove(address)
+
+    # Clients on this machine read a generated key unless one is provided
+    if os.environ.get(AUTHKEY_VARIABLE):
+        authkey = os.environ[AUTHKEY_VARIABLE].encode()
+    else:
+        authkey = write_authkey(address)
+
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        os.chmod(address, 0o600)
+        log.info(f"Tide service listening on {address}")
+        while True:
+            connection = listener.accept()
+            threading.Thread(
+                target=_handle, args=(connection, tide_models, log), daemon=True
+            ).start()
+
+
+@click.command("coastlines-tide-service")
+@click_config_path
+@click.option("--tide-data-location", type=str, required=True)
+@click.option(
+    "--address",
+    type=str,
+    default=DEFAULT_ADDRESS,
+    help="The Unix socket to listen on. Defaults to "
+    f"'{DEFAULT_ADDRESS}'. Set `options.tide_service_address` in the "
+    "config file to use the service.",
+)
+def cli(config_path: str, tide_data_location: str, address: str) -> None:
+    config = load_config(config_path, "coastlines")
+    log = configure_logging("Coastlines tide service")
+
+    tide_models = TideModels(
+        tide_data_location,
+        config.options.tide_model,
+        ensemble_models=config.options.ensemble_model_list,
+        ranking_points=config.options.ensemble_model_rankings,
+    )
+
+    serve(tide_models, address, log)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,521 @@
+import hashlib
+import json
+import uuid
+from typing import Callable
+
+import dask.array as da
+import fsspec
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import xarray as xr
+from eo_tides.eo import pixel_tides
+from eo_tides.model import model_tides
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_zeros
+from pyproj import Transformer
+
+from coastlines.tide_service import TideServiceClient
+from coastlines.utils import tide_cutoffs
+
+# The low resolution grid used by `pixel_tides` for projected data
+LOWRES_RESOLUTION = 5000
+LOWRES_BUFFER = 12000
+
+
+def get_lowres_geobox(
+    geobox: GeoBox,
+    resolution: float = LOWRES_RESOLUTION,
+    buffer: float = LOWRES_BUFFER,
+) -> GeoBox:
+    """The low resolution tide modelling grid `pixel_tides` uses for `geobox`"""
+    return GeoBox.from_bbox(
+        bbox=geobox.buffered(buffer).boundingbox, resolution=resolution
+    )
+
+
+class TideStore:
+    """
+    A persistent store of modelled tide heights, as Parquet files.
+
+    Heights are stored per tide model configuration, for each point and
+    time that has been modelled, so that reruns and overlapping tiles read
+    them back instead of running the tide models again. Files are split
+    into square blocks of `block_size` CRS units, so that a tile only
+    reads the blocks around it.
+
+    Each write adds a new file to a block, and once a block holds more
+    than `max_files` files they are compacted into one.
+    """
+
+    def __init__(
+        self, location: str, block_size: float = 100_000, max_files: int = 16
+    ):
+        self.fs, self.root = fsspec.core.url_to_fs(location)
+        self.block_size = block_size
+        self.max_files = max_files
+
+    @staticmethod
+    def key(**model_config) -> str:
+        as_json = json.dumps(model_config, sort_keys=True, default=str)
+        return hashlib.sha256(as_json.encode("utf-8")).hexdigest()
+
+    def _blocks(self, x: np.ndarray, y: np.ndarray) -> pd.Series:
+        bx = np.floor(np.asarray(x) / self.block_size).astype(int)
+        by = np.floor(np.asarray(y) / self.block_size).astype(int)
+        return pd.Series(bx).astype(str) + "_" + pd.Series(by).astype(str)
+
+    def _read(self, paths: list[str]) -> list[pd.DataFrame]:
+        tide_dfs = []
+        for path in paths:
+            try:
+                with self.fs.open(path, "rb") as f:
+                    tide_dfs.append(pd.read_parquet(f))
+            except FileNotFoundError:
+                # Removed by a concurrent compaction, which keeps its rows
+                continue
+
+        return tide_dfs
+
+    def _write(self, directory: str, tide_df: pd.DataFrame) -> None:
+        # New files rather than appends, so concurrent runs can't collide
+        with self.fs.open(f"{directory}/{uuid.uuid4().hex}.parquet", "wb") as f:
+            tide_df.to_parquet(f, index=False)
+
+    def get(self, key: str, x: np.ndarray, y: np.ndarray) -> pd.DataFrame:
+        """Stored tide heights for the blocks covering points `x`, `y`"""
+        tide_dfs = []
+        for block in self._blocks(x, y).unique():
+            tide_dfs += self._read(self.fs.glob(f"{self.root}/{key}/{block}/*.parquet"))
+
+        if len(tide_dfs) == 0:
+            return pd.DataFrame(
+                columns=["tide_model", "tide_height"],
+                index=pd.MultiIndex.from_arrays(
+                    [pd.DatetimeIndex([]), [], []], names=["time", "x", "y"]
+                ),
+            )
+
+        # Concurrent compactions can leave the same rows in more than one file
+        tide_df = pd.concat(tide_dfs).drop_duplicates(["time", "x", "y", "tide_model"])
+        return tide_df.set_index(["time", "x", "y"])
+
+    def compact(self, key: str, block: str) -> None:
+        """Merge the files in a block into one, if there are more than `max_files`"""
+        directory = f"{self.root}/{key}/{block}"
+        paths = self.fs.glob(f"{directory}/*.parquet")
+        if len(paths) <= self.max_files:
+            return
+
+        tide_dfs = self._read(paths)
+        tide_df = pd.concat(tide_dfs).drop_duplicates(["time", "x", "y", "tide_model"])
+        self._write(directory, tide_df)
+
+        # Only remove files that were merged, not any written since
+        self.fs.rm(paths)
+
+    def put(self, key: str, tide_df: pd.DataFrame) -> None:
+        tide_df = tide_df.reset_index()
+        blocks = self._blocks(tide_df["x"], tide_df["y"])
+        for block, block_df in tide_df.groupby(blocks.values):
+            directory = f"{self.root}/{key}/{block}"
+            self.fs.makedirs(directory, exist_ok=True)
+            self._write(directory, block_df)
+            self.compact(key, block)
+
+
+def stored_model_tides(
+    x: np.ndarray,
+    y: np.ndarray,
+    time: np.ndarray,
+    tide_store: TideStore,
+    crs: str,
+    model: str,
+    directory: str,
+    model_func: Callable = model_tides,
+    **model_tides_kwargs,
+) -> pd.DataFrame:
+    """
+    Model tides at every point in `x`, `y` for every `time`, like
+    `eo_tides.model.model_tides`, reading what it can from `tide_store`.
+
+    Only the points and times missing from the store are modelled, in a
+    single call to `model_func`, and these are then added to the store.
+    """
+    key = tide_store.key(crs=crs, model=model, **model_tides_kwargs)
+
+    x, y, time = np.asarray(x), np.asarray(y), pd.DatetimeIndex(time)
+    wanted = pd.MultiIndex.from_arrays(
+        [np.repeat(time, len(x)), np.tile(x, len(time)), np.tile(y, len(time))],
+        names=["time", "x", "y"],
+    )
+
+    stored = tide_store.get(key, x, y)
+    missing = wanted[~wanted.isin(stored.index)]
+
+    if len(missing) > 0:
+        print(f"Modelling {len(missing)} of {len(wanted)} tide heights not in the store")
+        modelled = model_func(
+            x=missing.get_level_values("x").to_numpy(),
+            y=missing.get_level_values("y").to_numpy(),
+            time=missing.get_level_values("time"),
+            mode="one-to-one",
+            crs=crs,
+            model=model,
+            directory=directory,
+            **model_tides_kwargs,
+        )
+        tide_store.put(key, modelled)
+        stored = pd.concat([stored, modelled])
+
+    return stored[stored.index.isin(wanted)]
+
+
+def lowres_pixel_tides(
+    ds: xr.Dataset,
+    model: str,
+    directory: str,
+    tide_store: TideStore | None = None,
+    model_func: Callable = model_tides,
+    resolution: float = LOWRES_RESOLUTION,
+    buffer: float = LOWRES_BUFFER,
+    **model_tides_kwargs,
+) -> xr.DataArray:
+    """
+    Low resolution tides for `ds`, on the same grid as
+    `pixel_tides(ds, resample=False)`, modelled by `model_func` and
+    optionally read from and written to a `TideStore`.
+    """
+    geobox = ds.odc.geobox
+    y_dim, x_dim = geobox.dimensions
+
+    lowres = xr_zeros(get_lowres_geobox(geobox, resolution, buffer))
+    flattened = lowres.stack(z=(x_dim, y_dim))
+
+    points = dict(
+        x=flattened[x_dim].values,
+        y=flattened[y_dim].values,
+        time=ds.time.values,
+        crs=f"EPSG:{geobox.crs.epsg}",
+        model=model,
+        directory=directory,
+    )
+    if tide_store is not None:
+        tide_df = stored_model_tides(
+            tide_store=tide_store,
+            model_func=model_func,
+            **points,
+            **model_tides_kwargs,
+        )
+    else:
+        tide_df = model_func(**points, **model_tides_kwargs)
+
+    # Overlapping runs can both store the same heights
+    tide_df = tide_df.rename_axis(["time", x_dim, y_dim]).set_index(
+        "tide_model", append=True
+    )
+    tide_df = tide_df[~tide_df.index.duplicated()]
+
+    tides_lowres = (
+        tide_df.to_xarray()
+        .tide_height.reindex_like(lowres)
+        .transpose("tide_model", "time", y_dim, x_dim)
+    )
+    if len(tides_lowres.tide_model) == 1:
+        tides_lowres = tides_lowres.squeeze("tide_model")
+
+    return tides_lowres.odc.assign_crs(geobox.crs)
+
+def get_cube_cells(
+    areas: gpd.GeoDataFrame, resolution: float, buffer: float
+) -> xr.DataArray:
+    """
+    A boolean EPSG:4326 grid of `resolution` degrees, which is True for
+    the cells within `buffer` degrees of `areas`, which are modelled.
+    """
+    areas = areas.to_crs("EPSG:4326")
+    geobox = GeoBox.from_bbox(
+        areas.total_bounds, crs="EPSG:4326", resolution=resolution
+    ).buffered(buffer + resolution)
+
+    cells = xr_zeros(geobox, dtype=bool)
+    cells = cells.rename(dict(zip(geobox.dimensions, ["y", "x"])))
+    xx, yy = np.meshgrid(cells.x.values, cells.y.values)
+    centres = gpd.GeoSeries(gpd.points_from_xy(xx.ravel(), yy.ravel()), crs=4326)
+    near = centres.sindex.query(areas.geometry.buffer(buffer).union_all(), "intersects")
+    cells.values.flat[near] = True
+
+    return cells
+
+
+def build_tide_cube(
+    areas: gpd.GeoDataFrame,
+    path: str,
+    start_year: int,
+    end_year: int,
+    model: str,
+    directory: str,
+    resolution: float = 0.05,
+    buffer: float = 0.25,
+    freq: str = "1h",
+    **model_tides_kwargs,
+) -> None:
+    """
+    Model tides every `freq` from the start of `start_year` to the end of
+    `end_year` on a low resolution grid around `areas`, and write them to
+    a Zarr store at `path` for `cube_pixel_tides` to interpolate from.
+
+    Tides are modelled and written a month at a time, to bound memory use.
+    Cells further than `buffer` degrees from every area are left as `nan`.
+    """
+    cells = get_cube_cells(areas, resolution, buffer)
+    y_index, x_index = np.nonzero(cells.values)
+    x = cells.x.values[x_index]
+    y = cells.y.values[y_index]
+    print(f"Modelling tides for {len(x)} of {cells.size} cells")
+
+    # One chunk holds a day of tides for a block of cells
+    steps_per_day = int(pd.Timedelta("1D") / pd.Timedelta(freq))
+    chunks = {"time": steps_per_day, "y": 32, "x": 32}
+
+    # Identifies this build, so a cube rebuilt at the same path can be told apart
+    build_id = uuid.uuid4().hex
+
+    times = pd.date_range(f"{start_year}-01-01", f"{end_year + 1}-01-01", freq=freq)
+    for i, (month, month_times) in enumerate(
+        pd.Series(times).groupby(times.to_period("M"))
+    ):
+        print(f"Modelling tides for {month}")
+        tide_df = model_tides(
+            x=x,
+            y=y,
+            time=month_times.values,
+            crs="EPSG:4326",
+            model=model,
+            directory=directory,
+            output_format="wide",
+            **model_tides_kwargs,
+        )
+
+        # Put the modelled heights back in the order of the cells
+        order = pd.MultiIndex.from_arrays(
+            [
+                np.repeat(month_times.values, len(x)),
+                np.tile(x, len(month_times)),
+                np.tile(y, len(month_times)),
+            ]
+        )
+        modelled = tide_df[model].reindex(order).to_numpy()
+
+        heights = np.full((len(month_times), *cells.shape), np.nan, dtype="float32")
+        heights[:, y_index, x_index] = modelled.reshape(len(month_times), len(x))
+
+        cube = xr.Dataset(
+            {"tide_height": (("time", "y", "x"), heights)},
+            coords={"time": month_times.values, "y": cells.y.values, "x": cells.x.values},
+        ).chunk(chunks)
+        cube.attrs = {
+            "tide_model": model,
+            "model_config": json.dumps(model_tides_kwargs, default=str),
+            "build_id": build_id,
+        }
+
+        if i == 0:
+            cube.to_zarr(path, mode="w")
+        else:
+            cube.to_zarr(path, append_dim="time")
+
+
+def cube_pixel_tides(
+    ds: xr.Dataset,
+    cube: xr.Dataset,
+    resolution: float = LOWRES_RESOLUTION,
+    buffer: float = LOWRES_BUFFER,
+) -> xr.DataArray:
+    """
+    Low resolution tides for `ds`, on the same grid as
+    `pixel_tides(ds, resample=False)`, interpolated from a tide cube
+    written by `build_tide_cube`.
+
+    Tides are linearly interpolated in time, then bilinearly in space.
+    """
+    geobox = ds.odc.geobox
+    y_dim, x_dim = geobox.dimensions
+    lowres = xr_zeros(get_lowres_geobox(geobox, resolution, buffer))
+
+    # The centres of the low resolution cells, in the cube's CRS
+    xx, yy = np.meshgrid(lowres[x_dim].values, lowres[y_dim].values)
+    lon, lat = Transformer.from_crs(
+        geobox.crs, "EPSG:4326", always_xy=True
+    ).transform(xx, yy)
+
+    # Only read the part of the cube around this area
+    margin = 2 * abs(float(cube.x[1] - cube.x[0]))
+    window = cube.tide_height.sel(
+        x=slice(lon.min() - margin, lon.max() + margin),
+        y=slice(lat.max() + margin, lat.min() - margin),
+    )
+
+    times = pd.DatetimeIndex(ds.time.values)
+    cube_times = pd.DatetimeIndex(cube.time.values)
+    after = cube_times.searchsorted(times)
+    if times.min() < cube_times[0] or times.max() > cube_times[-1]:
+        raise ValueError(
+            f"The tide cube covers {cube_times[0]} to {cube_times[-1]}, "
+            f"which doesn't include {times.min()} to {times.max()}"
+        )
+
+    # Linear interpolation between the cube timesteps either side of each time
+    after = np.clip(after, 1, len(cube_times) - 1)
+    before = after - 1
+    weight = (times - cube_times[before]) / (cube_times[after] - cube_times[before])
+    weight = xr.DataArray(weight.to_numpy(), dims="time")
+    tides = (
+        window.isel(time=before).drop_vars("time").load() * (1 - weight)
+        + window.isel(time=after).drop_vars("time").load() * weight
+    )
+
+    tides = tides.interp(
+        x=xr.DataArray(lon, dims=(y_dim, x_dim)),
+        y=xr.DataArray(lat, dims=(y_dim, x_dim)),
+    )
+    if tides.isnull().any():
+        raise ValueError("The tide cube doesn't cover all of this area")
+
+    tides = tides.drop_vars(["x", "y"]).assign_coords(
+        time=ds.time.values,
+        **{y_dim: lowres[y_dim], x_dim: lowres[x_dim]},
+    )
+
+    return tides.astype("float32").odc.assign_crs(geobox.crs)
+
+
+class TideContext:
+    """
+    Low resolution tide heights for one study area, modelled once and
+    shared between the tide filtering and per-pixel tide masking steps.
+
+    Tides are modelled for every timestep of the dataset the context is
+    created from. Later steps select the timesteps they still have, so
+    dropping timesteps never means modelling tides again.
+    """
+
+    def __init__(self, tides_lowres: xr.DataArray):
+        self.tides_lowres = tides_lowres
+
+    @classmethod
+    def from_dataset(
+        cls,
+        ds: xr.Dataset,
+        tide_data_location: str,
+        tide_model: str,
+        ensemble_model_list: list[str] | None = None,
+        ensemble_model_rankings: str | None = None,
+        tide_store: TideStore | None = None,
+        tide_cube: xr.Dataset | None = None,
+        tide_service: TideServiceClient | None = None,
+    ) -> "TideContext":
+        if tide_cube is not None:
+            if tide_cube.attrs.get("tide_model") != tide_model:
+                raise ValueError(
+                    f"The tide cube was built with {tide_cube.attrs.get('tide_model')}, "
+                    f"not {tide_model}"
+                )
+            # Ensemble members and ranking points, as written by build_tide_cube
+            model_config = {
+                "ensemble_models": ensemble_model_list,
+                "ranking_points": ensemble_model_rankings,
+            }
+            cube_config = json.loads(tide_cube.attrs.get("model_config", "{}"))
+            if cube_config != json.loads(json.dumps(model_config, default=str)):
+                raise ValueError(
+                    f"The tide cube was built with {cube_config}, not {model_config}"
+                )
+            tides_lowres = cube_pixel_tides(ds, tide_cube)
+        elif tide_store is not None or tide_service is not None:
+            tides_lowres = lowres_pixel_tides(
+                ds,
+                model=tide_model,
+                directory=tide_data_location,
+                tide_store=tide_store,
+                model_func=(
+                    model_tides if tide_service is None else tide_service.model_tides
+                ),
+                ensemble_models=ensemble_model_list,
+                ranking_points=ensemble_model_rankings,
+            )
+        else:
+            tides_lowres = pixel_tides(
+                ds,
+                resample=False,
+                directory=tide_data_location,
+                model=tide_model,
+                ensemble_models=ensemble_model_list,
+                ranking_points=ensemble_model_rankings,
+            )
+
+        return cls(tides_lowres)
+
+    def lowres(self, ds: xr.Dataset) -> xr.DataArray:
+        """Low resolution tides for the timesteps in `ds`"""
+        return self.tides_lowres.sel(time=ds.time)
+
+    def highres(
+        self, ds: xr.Dataset, resampling: str = "bilinear", compute: bool = True
+    ) -> xr.DataArray:
+        """
+        Tides for the timesteps in `ds`, reprojected into its pixel grid.
+
+        This matches what `pixel_tides` returns when resampling, without
+        running the tide models again.
+        """
+        tides_lowres = self.lowres(ds)
+        if not compute:
+            tides_lowres = tides_lowres.chunk({"time": 1})
+
+        tides = tides_lowres.odc.reproject(ds.odc.geobox, resampling=resampling)
+
+        return tides.rename("tide_height")
+
+    def extreme_tide_mask(
+        self,
+        ds: xr.Dataset,
+        tide_centre: float = 0.0,
+        resampling: str = "bilinear",
+    ) -> xr.DataArray:
+        """
+        A lazy boolean mask of the pixels in `ds` observed at extreme tides.
+
+        Tides and tide cutoffs are reprojected from low resolution and
+        compared one chunk at a time, following the chunks of `ds`, so the
+        full resolution tides are never held in memory. Data that isn't
+        chunked gets a chunk per timestep.
+        """
+        tides_lowres = self.lowres(ds)
+        cutoff_min, cutoff_max = tide_cutoffs(
+            ds, tides_lowres, tide_centre=tide_centre, reproject=False
+        )
+
+        geobox = ds.odc.geobox
+        template = ds[list(ds.data_vars)[0]]
+        chunks = template.chunks
+        if chunks is None:
+            chunks = template.chunk({"time": 1}).chunks
+
+        def _mask_block(block_info=None):
+            (t0, t1), (y0, y1), (x0, x1) = block_info[None]["array-location"]
+            block_geobox = geobox[y0:y1, x0:x1]
+
+            tides = tides_lowres.isel(time=slice(t0, t1)).odc.reproject(
+                block_geobox, resampling=resampling
+            )
+            block_min = cutoff_min.odc.reproject(block_geobox, resampling=resampling)
+            block_max = cutoff_max.odc.reproject(block_geobox, resampling=resampling)
+
+            return ((tides <= block_min) | (tides >= block_max)).values
+
+        mask = da.map_blocks(_mask_block, dtype=bool, chunks=chunks)
+
+        return xr.DataArray(
+            mask, dims=template.dims, coords=template.coords, name="extreme_tides"
+        )
@@ -1,4 +1,7 @@
+import json
 import logging
+import time
+from json.decoder import JSONDecodeError
 from pathlib import Path
 from typing import Union
 
@@ -34,6 +37,37 @@ def is_s3(path: Union[Path, S3Path]) -> bool:
     return isinstance(path, S3Path)
 
 
+def evict_least_recently_used(
+    location: Path,
+    pattern: str,
+    max_size_bytes: float,
+    ttl_seconds: float | None = None,
+) -> None:
+    """
+    Remove cache files matching `pattern` in `location` that are older than
+    `ttl_seconds`, then the least recently accessed files until the total
+    size is under `max_size_bytes`.
+    """
+    now = time.time()
+    entries = []
+    for path in location.glob(pattern):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if ttl_seconds is not None and now - stat.st_mtime > ttl_seconds:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_atime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_size -= size
+
+
 def configure_logging(name: str = "Coastlines") -> logging.Logger:
     """
     Configure logging for the application.
@@ -80,6 +114,28 @@ def load_json(grid_path: str) -> GeoDataFrame:
     return gridcell_gdf
 
 
+def subset_tiles(tiles: GeoDataFrame, tiles_subset: str) -> GeoDataFrame:
+    """Select tiles by a JSON list of tile IDs, or keep all tiles if it is empty"""
+    try:
+        subset_list = json.loads(tiles_subset)
+    except JSONDecodeError:
+        raise click.BadParameter(
+            f"'{tiles_subset}' is not a valid JSON string", param_hint="'--tiles-subset'"
+        )
+
+    if len(subset_list) != 0:
+        try:
+            tiles = tiles.loc[subset_list]
+        except KeyError:
+            missing = [t for t in subset_list if t not in tiles.index]
+            raise click.BadParameter(
+                f"Tiles {missing} were not found in the grid file",
+                param_hint="'--tiles-subset'",
+            )
+
+    return tiles
+
+
 def get_study_site_geometry(grid_path: str, study_area: str) -> gpd.GeoDataFrame:
     # Grid cells used to process the analysis
     gridcell_gdf = load_json(grid_path)
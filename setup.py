@@ -10,6 +10,7 @@ tests_require = [
 
 extras = {
     "test": tests_require,
+    "geoparquet": ["stac-geoparquet"],
 }
 
 # What packages are required for this module to be executed?
@@ -26,6 +27,7 @@ REQUIRED = [
     "geopandas",
     "matplotlib",
     "mapclassify",
+    "numba",
     "numpy",
     "odc-geo",
     "odc-stac",
@@ -49,6 +51,7 @@ REQUIRED = [
     "tqdm>=4.66.3",
     "xarray",
     "pyyaml",
+    "zarr",
     "dea_intertidal @ git+https://github.com/GeoscienceAustralia/dea-intertidal.git",
     "dep-tools @ git+https://github.com/digitalearthpacific/dep-tools.git",
 ]
@@ -81,7 +84,12 @@ setup_kwargs = {
         "console_scripts": [
             "coastlines-print-tiles = coastlines.print_tiles:cli",
             "coastlines-combined = coastlines.combined:cli",
+            "coastlines-prefetch = coastlines.prefetch:cli",
             "coastlines-merge = coastlines.merge_tiles:cli",
+            "coastlines-clip-tide-models = coastlines.clip_tide_models:cli",
+            "coastlines-dem-cache = coastlines.dem_cache:cli",
+            "coastlines-tide-cube = coastlines.tide_cube:cli",
+            "coastlines-tide-service = coastlines.tide_service:cli",
             "intertidal = coastlines.intertidal:cli",
         ]
     },
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pydantic_yaml import parse_yaml_file_as
+
+from coastlines.combined import generate_yearly_composites, get_one_year_composite
+from coastlines.composites import CompositeStore, sliding_yearly_composites
+from coastlines.config import CoastlinesConfig
+
+
+@pytest.fixture()
+def ds():
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2018-01-01", "2022-12-31", freq="8D")
+    # Leave out 2020 entirely, to check years without data
+    times = times[times.year != 2020]
+    mndwi = rng.uniform(-1, 1, (len(times), 20, 30)).astype("float32")
+    mndwi[rng.random(mndwi.shape) > 0.6] = np.nan
+    mndwi[:, :2, :2] = np.nan
+    return xr.Dataset(
+        {"mndwi": (("time", "y", "x"), mndwi), "nir08": (("time", "y", "x"), mndwi / 2 + 0.5)},
+        coords={"time": times, "y": np.arange(20), "x": np.arange(30)},
+    )
+
+
+def test_sliding_composites_match_one_year_composites(ds):
+    composites = sliding_yearly_composites(ds, 2019, 2021, include_nir=True)
+
+    assert [year for year, _ in composites] == [2019, 2020, 2021]
+    for year, year_summary in composites:
+        _, expected = get_one_year_composite(ds, year, include_nir=True)
+        assert list(year_summary.data_vars) == list(expected.data_vars)
+        for name in expected.data_vars:
+            assert year_summary[name].dtype == expected[name].dtype
+        xr.testing.assert_allclose(year_summary, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_generate_yearly_composites_in_memory_and_lazy(ds):
+    # Dask's nanmedian fails on all-nan pixels and empty years, so avoid them
+    ds = ds.fillna(0.5)
+    in_memory = generate_yearly_composites(ds, 2021, 2022)
+    lazy = generate_yearly_composites(ds.chunk({"time": 10}), 2021, 2022)
+
+    xr.testing.assert_allclose(in_memory, lazy.compute(), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("max_error", [0.01, 0.05])
+def test_streaming_composites_within_error(ds, max_error):
+    exact = sliding_yearly_composites(ds, 2019, 2021, include_nir=True)
+    streamed = sliding_yearly_composites(
+        ds.chunk({"time": 1}), 2019, 2021, include_nir=True, max_error=max_error
+    )
+
+    assert [year for year, _ in streamed] == [year for year, _ in exact]
+    for (_, expected), (_, result) in zip(exact, streamed):
+        assert list(result.data_vars) == list(expected.data_vars)
+        for name in ["mndwi", "gapfill_mndwi", "nir", "gapfill_nir"]:
+            error = np.abs(result[name] - expected[name])
+            assert not (error > max_error + 1e-6).any()
+            assert (result[name].isnull() == expected[name].isnull()).all()
+        for name in ["count", "gapfill_count"]:
+            xr.testing.assert_equal(result[name], expected[name])
+        for name in ["stdev", "gapfill_stdev"]:
+            xr.testing.assert_allclose(result[name], expected[name], atol=1e-5)
+
+
+def test_composite_store_round_trip(ds, tmp_path):
+    config = parse_yaml_file_as(CoastlinesConfig, "tests/test_config.yaml")
+    composites = generate_yearly_composites(ds, 2019, 2021, include_nir=True)
+    store = CompositeStore(str(tmp_path / "composites"))
+    snapshot = tmp_path / "items.json"
+    snapshot.write_text('{"features": []}')
+    grid = tmp_path / "grid.geojson"
+    grid.write_text('{"features": []}')
+    config.input.grid_path = str(grid)
+    cube = xr.Dataset({"tide_height": ("time", np.zeros(2))}, attrs={"build_id": "a"})
+    cube.to_zarr(tmp_path / "cube.zarr")
+    config.options.tide_cube_location = str(tmp_path / "cube.zarr")
+
+    def params(study_area="tile", tide_data_location="tides"):
+        return CompositeStore.params(
+            study_area, config, tide_data_location, snapshot_path=str(snapshot)
+        )
+
+    assert store.get(params()) is None
+    store.put(params(), composites)
+    xr.testing.assert_identical(store.get(params()), composites)
+    assert store.get(params(study_area="other_tile")) is None
+
+    # Later steps don't change the composites, but their inputs do
+    config.options.index_threshold += 0.1
+    xr.testing.assert_identical(store.get(params()), composites)
+    assert store.get(params(tide_data_location="new_tides")) is None
+    snapshot.write_text('{"features": [], "refreshed": true}')
+    assert store.get(params()) is None
+    snapshot.write_text('{"features": []}')
+    xr.testing.assert_identical(store.get(params()), composites)
+
+    # Inputs rebuilt at the same paths make new composites too
+    grid.write_text('{"features": [], "rebuilt": true}')
+    assert store.get(params()) is None
+    grid.write_text('{"features": []}')
+    cube.attrs["build_id"] = "b"
+    cube.to_zarr(tmp_path / "cube.zarr", mode="w")
+    assert store.get(params()) is None
+    cube.attrs["build_id"] = "a"
+    cube.to_zarr(tmp_path / "cube.zarr", mode="w")
+    xr.testing.assert_identical(store.get(params()), composites)
+
+    config.options.end_year += 1
+    assert store.get(params()) is None
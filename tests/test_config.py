@@ -1,4 +1,7 @@
-from coastlines.config import CoastlinesConfig
+import pytest
+from pydantic import ValidationError
+
+from coastlines.config import CoastlinesConfig, CoastlinesOptions
 from pydantic_yaml import parse_yaml_file_as
 
 
@@ -14,3 +17,9 @@ def test_load_config_file():
     assert config.aws is None
 
     assert config.options.use_combined_index is True
+
+
+@pytest.mark.parametrize("error", [0, -0.01])
+def test_streaming_composite_error_must_be_positive(error):
+    with pytest.raises(ValidationError):
+        CoastlinesOptions(streaming_composite_error=error)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import xarray as xr
+from odc.algo import mask_cleanup, to_f32
+
+from coastlines.combined import CLOUD_BITMASK, CLOUD_MASK_FILTERS
+from coastlines.kernels import fused_water_index, median_count_std
+
+
+@pytest.fixture()
+def raw_ds():
+    rng = np.random.default_rng(42)
+    shape = (2, 60, 70)
+
+    coords = {"time": np.arange(2), "y": np.arange(60), "x": np.arange(70)}
+    ds = xr.Dataset(coords=coords)
+    for band in ["green", "swir16", "nir08"]:
+        data = rng.integers(6000, 30000, shape).astype("uint16")
+        data[rng.random(shape) < 0.05] = 0
+        ds[band] = (("time", "y", "x"), data)
+        ds[band].attrs["nodata"] = 0
+
+    qa = np.full(shape, 21824, dtype="uint16")
+    qa[:, 10:25, 20:40] |= 1 << 3
+    ds["qa_pixel"] = (("time", "y", "x"), qa)
+
+    return ds.chunk({"time": 1})
+
+
+def test_fused_water_index_matches_unfused(raw_ds):
+    ds = raw_ds.copy()
+    nodata_mask = (ds.green == 0) | (ds.swir16 == 0)
+    cloud_mask = mask_cleanup(
+        ds.qa_pixel.astype(int) & CLOUD_BITMASK != 0, CLOUD_MASK_FILTERS
+    )
+    for band in ["green", "swir16", "nir08"]:
+        ds[band] = to_f32(ds[band], scale=0.0000275, offset=-0.2)
+    invalid = (ds.green < 0) | (ds.green > 1) | (ds.swir16 < 0) | (ds.swir16 > 1)
+    ds["mndwi"] = (ds.green - ds.swir16) / (ds.green + ds.swir16)
+    expected = ds.where(~(nodata_mask | cloud_mask | invalid))
+
+    fused = fused_water_index(
+        raw_ds, "mndwi", CLOUD_BITMASK, CLOUD_MASK_FILTERS, include_nir=True
+    ).compute()
+
+    assert fused.mndwi.dtype == "float32"
+    np.testing.assert_array_equal(fused.mndwi.values, expected.mndwi.values)
+    np.testing.assert_array_equal(fused.nir08.values, expected.nir08.values)
+
+
+@pytest.mark.parametrize("chunks", [None, {"time": 1, "x": 16}])
+def test_median_count_std_matches_xarray(chunks):
+    rng = np.random.default_rng(7)
+    values = rng.uniform(-1, 1, (25, 30, 40)).astype("float32")
+    values[rng.random(values.shape) > 0.6] = np.nan
+    values[:, :2, :2] = np.nan
+    values[:6, 5, 5] = 0.25
+    da = xr.DataArray(values, dims=["time", "y", "x"])
+    if chunks is not None:
+        da = da.chunk(chunks)
+
+    median, count, std = median_count_std(da)
+
+    assert count.dtype == "int16"
+    xr.testing.assert_identical(median.compute(), da.median("time").compute())
+    np.testing.assert_array_equal(count.values, da.count("time").values)
+    xr.testing.assert_allclose(std.compute(), da.std("time").compute(), rtol=1e-5)
+
+
+def test_median_count_std_keeps_dask_graphs_small():
+    values = np.zeros((60, 40, 40), dtype="float32")
+    da = xr.DataArray(values, dims=["time", "y", "x"]).chunk({"time": 1, "x": 10})
+    n_chunks = da.data.npartitions
+
+    median, count, std = median_count_std(da)
+
+    # One task per output chunk on top of loading and rechunking the input
+    assert len(median.data.__dask_graph__()) < 3 * n_chunks
+    assert median.data.npartitions == 4
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from coastlines.combined import generate_yearly_composites
+from coastlines.masks import ObservationMask
+
+
+@pytest.fixture()
+def ds():
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2019-01-01", "2021-12-31", freq="8D")
+    mndwi = rng.uniform(-1, 1, (len(times), 30, 40)).astype("float32")
+    return xr.Dataset(
+        {"mndwi": (("time", "y", "x"), mndwi)},
+        coords={"time": times, "y": np.arange(30), "x": np.arange(40)},
+    )
+
+
+def test_observation_mask_matches_where(ds):
+    rng = np.random.default_rng(1)
+    first = xr.DataArray(rng.random(ds.mndwi.shape) > 0.8, coords=ds.mndwi.coords)
+    second = rng.random(ds.mndwi.shape) > 0.9
+
+    observation_mask = ObservationMask(ds)
+    observation_mask.mask(first)
+    observation_mask.mask(second)
+
+    expected = ds.where(~first).where(~second)
+    xr.testing.assert_identical(observation_mask.where(ds), expected)
+
+    one_year = ds.sel(time="2020")
+    xr.testing.assert_identical(
+        observation_mask.where(one_year), expected.sel(time="2020")
+    )
+
+
+def test_yearly_composites_with_observation_mask(ds):
+    rng = np.random.default_rng(2)
+    invalid = rng.random(ds.mndwi.shape) > 0.7
+
+    observation_mask = ObservationMask(ds)
+    observation_mask.mask(invalid)
+
+    expected = generate_yearly_composites(ds.where(~invalid), 2020, 2020)
+    result = generate_yearly_composites(
+        ds, 2020, 2020, observation_mask=observation_mask
+    )
+
+    xr.testing.assert_allclose(result, expected)
+
+
+def test_observation_mask_from_dask_blocks(ds):
+    rng = np.random.default_rng(3)
+    invalid = xr.DataArray(rng.random(ds.mndwi.shape) > 0.8, coords=ds.mndwi.coords)
+
+    in_memory = ObservationMask(ds)
+    in_memory.mask(invalid)
+    blocked = ObservationMask(ds)
+    blocked.mask(invalid.chunk({"time": 7}), block_size=40)
+
+    assert (blocked.words == in_memory.words).all()
+
+
+def test_observation_mask_by_index(ds):
+    rng = np.random.default_rng(4)
+    masks = rng.random((3, *ds.mndwi.shape[1:])) > 0.5
+    index = rng.integers(0, 3, len(ds.time))
+
+    expected = ObservationMask(ds)
+    expected.mask(masks[index])
+
+    # Word aligned blocks of timesteps, each packed in smaller blocks
+    observation_mask = ObservationMask(ds)
+    observation_mask.mask_by_index(masks, index[:64], block_size=8)
+    observation_mask.mask_by_index(masks, index[64:], start=64, block_size=8)
+
+    assert (observation_mask.words == expected.words).all()
+    with pytest.raises(ValueError):
+        observation_mask.mask_by_index(masks, index[1:], start=1)
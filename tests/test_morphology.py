@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import xarray as xr
+from odc.algo import mask_cleanup_np
+from scipy.ndimage import gaussian_filter
+
+from coastlines.morphology import (
+    cleanup_masks,
+    pack_masks,
+    packed_ones,
+    unpack_masks,
+    xr_cleanup_masks,
+)
+
+FILTERS = [("opening", 3), ("dilation", 4)]
+
+
+@pytest.fixture()
+def masks():
+    rng = np.random.default_rng(42)
+    return gaussian_filter(rng.random((70, 120, 100)), (0, 3, 3)) > 0.52
+
+
+@pytest.mark.parametrize("n", [1, 8, 9, 64, 70])
+def test_pack_masks_round_trip(masks, n):
+    assert (unpack_masks(pack_masks(masks[:n]), n) == masks[:n]).all()
+
+
+@pytest.mark.parametrize("n", [0, 1, 8, 9, 64, 70])
+def test_packed_ones_matches_pack_masks(n):
+    expected = pack_masks(np.ones((n, 3, 4), dtype=bool))
+    result = packed_ones(n, 3, 4)
+    assert result.dtype == expected.dtype
+    assert (result == expected).all()
+
+
+@pytest.mark.parametrize(
+    "mask_filters", [FILTERS, [("closing", 2)], [("erosion", 2.5)], [("dilation", 10)]]
+)
+def test_cleanup_masks_matches_odc(masks, mask_filters):
+    expected = np.stack([mask_cleanup_np(m, mask_filters) for m in masks])
+    assert (cleanup_masks(masks, mask_filters) == expected).all()
+
+
+def test_cleanup_masks_keeps_empty_masks_empty():
+    # odc's distance transform adds pixels in the corner when dilating nothing
+    empty = np.zeros((2, 20, 20), dtype=bool)
+    assert not cleanup_masks(empty, FILTERS).any()
+
+
+def test_xr_cleanup_masks_chunked(masks):
+    da = xr.DataArray(masks, dims=["time", "y", "x"])
+    chunked = da.chunk({"time": 1, "y": 50, "x": 50})
+
+    result = xr_cleanup_masks(chunked, FILTERS)
+
+    assert result.chunks == chunked.chunks
+    assert (result.values == cleanup_masks(masks, FILTERS)).all()
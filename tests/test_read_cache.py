@@ -0,0 +1,42 @@
+import numpy as np
+
+from coastlines.read_cache import ChunkCache
+
+
+def test_chunk_cache_round_trip_and_stats(tmp_path):
+    cache = ChunkCache(tmp_path / "read_cache")
+    data = np.arange(12, dtype="float32").reshape(3, 4)
+
+    assert cache.get("abc") is None
+    cache.put("abc", (slice(2, 5), slice(None, 4)), data)
+
+    roi, cached = cache.get("abc")
+    assert roi == (slice(2, 5), slice(0, 4))
+    np.testing.assert_array_equal(cached, data)
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_bytes"] == data.nbytes
+
+    cache.reset_stats()
+    assert cache.stats()["hits"] == 0
+
+
+def test_chunk_cache_survives_eviction_and_corruption(tmp_path, monkeypatch):
+    cache = ChunkCache(tmp_path / "read_cache")
+    data = np.ones((2, 2), dtype="float32")
+    cache.put("abc", (slice(0, 2), slice(0, 2)), data)
+
+    # Another process evicts the entry between loading it and touching it
+    def evicted(path, times):
+        raise FileNotFoundError(path)
+
+    with monkeypatch.context() as m:
+        m.setattr("coastlines.read_cache.os.utime", evicted)
+        roi, cached = cache.get("abc")
+    np.testing.assert_array_equal(cached, data)
+
+    # A truncated entry is a miss
+    (tmp_path / "read_cache" / "def.npz").write_bytes(b"PK\x03\x04")
+    assert cache.get("def") is None
@@ -0,0 +1,318 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+import rasterio
+from odc.geo.geobox import GeoBox
+from pydantic_yaml import parse_yaml_file_as
+from pystac import Asset, Item
+from shapely.geometry import box, mapping
+
+from coastlines.combined import (
+    CLOUD_BITMASK,
+    STAC_CFG,
+    filter_items_by_clear_fraction,
+    get_stac_catalog,
+    load_and_mask_data_with_stac,
+)
+from coastlines.config import CoastlinesConfig, STACCache
+from coastlines.grids import get_tile_geobox
+from coastlines.utils import CoastlinesException
+from coastlines.stac import (
+    CachedCatalog,
+    SceneRecord,
+    SnapshotCatalog,
+    StacSearchCache,
+    footprint_coverage,
+    is_grid_aligned,
+    partition_items,
+    read_item_snapshot,
+    select_scenes,
+    slim_item,
+    solar_day_coverage,
+    write_item_snapshot,
+)
+
+
+@pytest.fixture()
+def cache(tmp_path):
+    return StacSearchCache(tmp_path / "stac_cache", ttl_hours=1, max_size_mb=1)
+
+
+def test_cache_key_is_order_independent():
+    key_a = StacSearchCache.key(bbox=[1, 2, 3, 4], query={"a": 1, "b": 2})
+    key_b = StacSearchCache.key(query={"b": 2, "a": 1}, bbox=[1, 2, 3, 4])
+    assert key_a == key_b
+
+
+def test_cache_round_trip(cache):
+    cache.put("abc", {"matched": 10})
+    assert cache.get("abc") == {"matched": 10}
+    assert cache.get("def") is None
+
+
+def test_cache_expires(cache):
+    cache.put("abc", {"matched": 10})
+    old = time.time() - 2 * 60 * 60
+    os.utime(cache.location / "abc.json", (old, old))
+    assert cache.get("abc") is None
+
+
+def test_cache_evicts_least_recently_used(cache):
+    cache.max_size_bytes = 100
+    cache.put("first", {"data": "x" * 40})
+    os.utime(cache.location / "first.json", (time.time() - 60, time.time()))
+    cache.put("second", {"data": "x" * 40})
+    cache.put("third", {"data": "x" * 40})
+
+    assert cache.get("first") is None
+    assert cache.get("third") is not None
+
+
+def test_cached_catalog_makes_no_calls_when_cached(cache):
+    catalog = CachedCatalog("https://example.com/stac", cache=cache)
+    query = {"bbox": (1.0, 2.0, 3.0, 4.0), "datetime": "2020/2021"}
+    cache.put(catalog._key("matched", {}, query), {"matched": 5})
+
+    # The client would fail to open, so this proves we never touched it
+    assert catalog.matched({}, **query) == 5
+    assert catalog._client is None
+
+
+def make_item(i, category="T1", cloud_cover=10.0):
+    return Item(
+        id=f"item_{i}",
+        geometry=None,
+        bbox=None,
+        datetime=datetime(2020, 1, 1),
+        properties={
+            "landsat:collection_category": category,
+            "eo:cloud_cover": cloud_cover,
+        },
+    )
+
+
+def test_stac_catalog_uses_configured_cache(tmp_path):
+    config = parse_yaml_file_as(CoastlinesConfig, "tests/test_config.yaml")
+    config.stac.cache = STACCache(location=str(tmp_path))
+
+    catalog = get_stac_catalog(config)
+
+    assert catalog.cache is not None
+    assert catalog.cache.location == tmp_path
+
+
+def test_dropping_partial_footprints_rechecks_scene_limit():
+    config = parse_yaml_file_as(CoastlinesConfig, "tests/test_config.yaml")
+    config.stac.scene_selection = "local"
+    config.stac.lower_scene_limit = 2
+    config.stac.min_footprint_coverage = 0.5
+
+    footprints = [box(115, -8, 117, -6), box(116.9, -6.1, 118, -5), box(114, -9, 115.1, -7.9)]
+    items = []
+    for i, footprint in enumerate(footprints):
+        item = make_item(i)
+        item.geometry = mapping(footprint)
+        item.bbox = list(footprint.bounds)
+        item.collection_id = "landsat-c2l2-sr"
+        item.datetime = datetime(2020, 1, i + 1)
+        items.append(item)
+
+    # All three days intersect the area, but two only clip its corners
+    query = {"bbox": (115, -8, 117, -6), "datetime": "2020"}
+    with pytest.raises(CoastlinesException, match="Only 1 items"):
+        load_and_mask_data_with_stac(config, query, catalog=SnapshotCatalog(items))
+
+
+def test_select_scenes_prefers_t1():
+    items = [make_item(i) for i in range(5)] + [make_item(5, category="T2")]
+    selected = select_scenes(items, lower_limit=5, upper_limit=10)
+    assert len(selected) == 5
+
+
+def test_select_scenes_falls_back_to_t2():
+    items = [make_item(i) for i in range(3)] + [make_item(3, category="T2")]
+    selected = select_scenes(items, lower_limit=5, upper_limit=10)
+    assert len(selected) == 4
+
+
+def test_select_scenes_steps_down_cloud_cover():
+    items = [make_item(i, cloud_cover=i * 10.0) for i in range(10)]
+    # Items with 90% and 80% clouds are dropped, at the 85% step
+    selected = select_scenes(items, lower_limit=1, upper_limit=8)
+    assert len(selected) == 8
+
+    # Never filters below 50% clouds
+    selected = select_scenes(items, lower_limit=1, upper_limit=2)
+    assert len(selected) == 5
+
+
+def test_snapshot_catalog_filters_locally():
+    items = [make_item(0), make_item(1, category="T2", cloud_cover=80.0)]
+    catalog = SnapshotCatalog(items)
+
+    t1_filter = {"landsat:collection_category": {"in": ["T1"]}}
+    assert catalog.matched(t1_filter, datetime="2019/2021") == 1
+    assert catalog.matched({}, datetime="2021/2022") == 0
+    assert catalog.matched({"eo:cloud_cover": {"lt": 50}}) == 1
+
+
+def test_partition_items():
+    item = make_item(0)
+    item.geometry = mapping(box(0, 0, 1, 1))
+    partitioned = partition_items(
+        [item], {"inside": (0.5, 0.5, 2, 2), "outside": (3, 3, 4, 4)}
+    )
+
+    assert len(partitioned["inside"]) == 1
+    assert len(partitioned["outside"]) == 0
+
+
+@pytest.mark.parametrize("file_name", ["items.json", "items.ndjson"])
+def test_item_snapshot_round_trip(tmp_path, file_name):
+    items = [make_item(0), make_item(1)]
+    path = str(tmp_path / file_name)
+    write_item_snapshot(items, path)
+
+    loaded = read_item_snapshot(path)
+    assert [i.id for i in loaded] == ["item_0", "item_1"]
+
+
+def test_slim_item_and_scene_record():
+    item = make_item(0)
+    item.properties["view:sun_elevation"] = 45.0
+    item.properties["unused"] = "value"
+    item.add_asset("green", Asset("green.tif"))
+    item.add_asset("thumbnail", Asset("thumbnail.jpg"))
+
+    item = slim_item(item, ["green", "swir16"])
+    assert "unused" not in item.properties
+    assert list(item.assets) == ["green"]
+
+    record = SceneRecord.from_item(item)
+    assert record.id == "item_0"
+    assert record.sun_elevation == 45.0
+    assert record.sun_azimuth is None
+
+
+def test_footprint_coverage():
+    full = make_item(0)
+    full.geometry = mapping(box(0, 0, 1, 1))
+    quarter = make_item(1)
+    quarter.geometry = mapping(box(0.5, 0.5, 1.5, 1.5))
+
+    coverage = footprint_coverage([full, quarter], box(0, 0, 1, 1))
+    assert coverage[0] == pytest.approx(1.0)
+    assert coverage[1] == pytest.approx(0.25, abs=0.01)
+
+
+def test_solar_day_coverage_merges_adjacent_rows():
+    # Two scenes from adjacent rows on the same day, each covering half the area
+    north = make_item(0)
+    north.geometry = mapping(box(0, 0.5, 1, 1.5))
+    south = make_item(1)
+    south.geometry = mapping(box(0, -0.5, 1, 0.5))
+    other_day = make_item(2)
+    other_day.geometry = mapping(box(0, 0.5, 1, 1.5))
+    other_day.datetime = datetime(2020, 1, 2)
+
+    items = [north, south, other_day]
+    assert footprint_coverage(items, box(0, 0, 1, 1)) == pytest.approx(
+        [0.5, 0.5, 0.5], abs=0.01
+    )
+    assert solar_day_coverage(items, box(0, 0, 1, 1)) == pytest.approx(
+        [1.0, 1.0, 0.5], abs=0.01
+    )
+
+
+def test_is_grid_aligned():
+    geobox = GeoBox.from_bbox(
+        (399000, -900000, 420000, -880020), crs="EPSG:32750", resolution=30
+    )
+    item = make_item(0)
+    item.properties["proj:code"] = "EPSG:32750"
+    item.properties["proj:transform"] = [30, 0, 300000, 0, -30, -800010]
+    assert is_grid_aligned(item, geobox)
+
+    item.properties["proj:transform"] = [30, 0, 300015, 0, -30, -800010]
+    assert not is_grid_aligned(item, geobox)
+
+    item.properties["proj:code"] = "EPSG:32650"
+    assert not is_grid_aligned(item, geobox)
+
+
+def test_landsat_scene_aligned_with_30m_tile():
+    # A Landsat Collection 2 scene in UTM zone 51N
+    item = make_item(0)
+    item.properties["proj:code"] = "EPSG:32651"
+    item.properties["proj:transform"] = [30.0, 0.0, 199785.0, 0.0, -30.0, 1633215.0]
+
+    geobox = get_tile_geobox("PHILIPPINES_25", "203,232", buffer=5000, resolution=30)
+    assert is_grid_aligned(item, geobox)
+
+    geobox = get_tile_geobox("PHILIPPINES_25", "203,232", buffer=5000)
+    assert not is_grid_aligned(item, geobox)
+
+
+def test_filter_items_by_clear_fraction(tmp_path):
+    geobox = GeoBox.from_bbox(
+        (400000, 9190000, 403000, 9193000), crs="EPSG:32750", resolution=30
+    )
+    clear = 21824
+
+    def make_qa_item(day: int, qa: np.ndarray) -> Item:
+        path = tmp_path / f"qa_{day}.tif"
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            height=qa.shape[0],
+            width=qa.shape[1],
+            count=1,
+            dtype="uint16",
+            crs=str(geobox.crs),
+            transform=geobox.affine,
+            nodata=0,
+        ) as f:
+            f.write(qa, 1)
+
+        item = Item(
+            id=f"item_{day}",
+            geometry=mapping(box(115.5, -8, 116.5, -7)),
+            bbox=[115.5, -8, 116.5, -7],
+            datetime=datetime(2020, 1, day, 2),
+            properties={},
+            collection="landsat-c2l2-sr",
+        )
+        item.add_asset(
+            "qa_pixel",
+            Asset(
+                href=str(path),
+                media_type="image/tiff; application=geotiff",
+                extra_fields={
+                    "proj:shape": list(qa.shape),
+                    "proj:transform": list(geobox.affine)[:6],
+                    "proj:code": "EPSG:32750",
+                },
+            ),
+        )
+        return item
+
+    # A clear day whose footprint only covers a strip of the area
+    partial = np.zeros(geobox.shape.yx, dtype="uint16")
+    partial[:, :30] = clear
+    cloudy = np.full(geobox.shape.yx, clear | CLOUD_BITMASK, dtype="uint16")
+    # A mostly cloudy day whose remaining pixels are fill, like SLC-off gaps
+    fill_heavy = np.full(geobox.shape.yx, 1, dtype="uint16")
+    fill_heavy[:, :30] = clear | CLOUD_BITMASK
+    fill_heavy[:, 30:40] = clear
+    items = [make_qa_item(1, partial), make_qa_item(2, cloudy), make_qa_item(3, fill_heavy)]
+
+    load_kwargs = dict(
+        geobox=geobox, group_by="solar_day", resampling="nearest", stac_cfg=STAC_CFG
+    )
+    kept = filter_items_by_clear_fraction(items, load_kwargs, 0.5, (115.5, -8, 116.5, -7))
+
+    assert [item.id for item in kept] == ["item_1"]
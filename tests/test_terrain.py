@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from dea_tools.spatial import hillshade
+from odc.algo import mask_cleanup
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_zeros
+
+from coastlines.combined import mask_pixels_by_hillshadow
+from coastlines.masks import ObservationMask
+from coastlines.stac import SceneRecord
+from coastlines.terrain import (
+    DemCache,
+    TerrainShadow,
+    iter_terrain_shadow_masks,
+    load_dem,
+    terrain_shadow_masks,
+)
+
+
+@pytest.fixture()
+def dem():
+    y, x = np.mgrid[0:200, 0:200]
+    return (300 * np.sin(x / 15) * np.cos(y / 20)).astype("float32")
+
+
+def test_hillshade_matches_dea_tools(dem):
+    elevation = np.array([40.0, 55.0, 70.0])
+    azimuth = np.array([60.0, 90.0, 135.0])
+
+    hs = TerrainShadow(dem).hillshade(elevation, azimuth)
+
+    for i in range(len(elevation)):
+        expected = hillshade(dem, elevation[i], azimuth[i])
+        np.testing.assert_allclose(hs[i], expected, atol=1e-5)
+
+
+def test_terrain_shadow_masks_match_per_timestep(dem):
+    elevation = np.array([40.0, 55.0, 70.0])
+    azimuth = np.array([60.0, 90.0, 135.0])
+
+    masks = terrain_shadow_masks(dem, elevation, azimuth, angle_tolerance=0)
+
+    for i in range(len(elevation)):
+        expected = mask_cleanup(
+            xr.DataArray(hillshade(dem, elevation[i], azimuth[i]) < 0.25, dims=["y", "x"]),
+            [("opening", 1), ("dilation", 1)],
+        )
+        assert (masks[i] == expected.values).all()
+
+
+def test_terrain_shadow_masks_share_and_skip(dem):
+    max_slope = TerrainShadow(dem).max_slope
+    elevation = np.array([max_slope - 5, max_slope - 4.96, max_slope + 5])
+    azimuth = np.array([90.0, 89.98, 90.0])
+
+    masks = terrain_shadow_masks(
+        dem, elevation, azimuth, angle_tolerance=0.1, skip_unshadowed=True
+    )
+
+    assert masks[0].any()
+    assert (masks[0] == masks[1]).all()
+    assert not masks[2].any()
+
+    # Without skipping, the rescaled hillshade still masks the dimmest slopes
+    assert terrain_shadow_masks(dem, elevation[2:], azimuth[2:]).any()
+
+
+def test_iter_terrain_shadow_masks_in_blocks(dem):
+    elevation = np.array([40.0, 40.0, 55.0, 70.0, 40.0])
+    azimuth = np.array([60.0, 60.0, 90.0, 135.0, 60.0])
+    expected = terrain_shadow_masks(dem, elevation, azimuth)
+
+    blocks = list(iter_terrain_shadow_masks(dem, elevation, azimuth, block_size=2))
+
+    assert [start for start, _, _ in blocks] == [0, 2, 4]
+    result = np.concatenate([masks[inverse] for _, masks, inverse in blocks])
+    assert (result == expected).all()
+
+
+def test_load_dem_reads_from_cache(tmp_path, dem):
+    geobox = GeoBox.from_bbox(
+        (400000, 9190000, 406000, 9196000), crs="EPSG:32750", resolution=30
+    )
+    dem_cache = DemCache(str(tmp_path))
+    key = dem_cache.key(geobox, "https://example.com/stac", "dem")
+    assert dem_cache.get(key) is None
+
+    dem_cache.put(key, dem)
+
+    # A cache hit doesn't search the (unreachable) catalog
+    cached = load_dem(geobox, "https://example.com/stac", "dem", dem_cache=dem_cache)
+    assert (cached == dem).all()
+    assert dem_cache.key(geobox.pad(1), "https://example.com/stac", "dem") != key
+
+    # Loading onto a dataset's geobox finds the same DEM
+    ds_geobox = xr_zeros(geobox).odc.geobox
+    assert dem_cache.key(ds_geobox, "https://example.com/stac", "dem") == key
+
+
+def test_hillshadow_into_observation_mask(tmp_path):
+    geobox = GeoBox.from_bbox(
+        (400000, 9190000, 406000, 9196000), crs="EPSG:32750", resolution=30
+    )
+    times = pd.to_datetime(["2020-01-01T01:00:00", "2020-01-17T01:00:00"])
+    ds = xr.Dataset({"mndwi": xr_zeros(geobox, dtype="float32").expand_dims(time=times)})
+    items = [
+        SceneRecord(f"scene_{i}", time.to_pydatetime(), None, None, None, 30.0, azimuth)
+        for i, (time, azimuth) in enumerate(zip(times, [60.0, 135.0]))
+    ]
+
+    # The DEM comes from the cache, so the (unreachable) catalog isn't searched
+    y, x = np.mgrid[0 : geobox.shape.y, 0 : geobox.shape.x]
+    dem = (300 * np.sin(x / 15) * np.cos(y / 20)).astype("float32")
+    dem_cache = DemCache(str(tmp_path))
+    dem_cache.put(dem_cache.key(geobox, "https://example.com/stac", "dem"), dem)
+    kwargs = dict(
+        stac_catalog="https://example.com/stac", stac_collection="dem", dem_cache=dem_cache
+    )
+
+    expected = mask_pixels_by_hillshadow(ds, items, **kwargs)
+    assert expected.mndwi.isnull().any()
+
+    observation_mask = ObservationMask(ds)
+    unmasked = mask_pixels_by_hillshadow(
+        ds, items, observation_mask=observation_mask, **kwargs
+    )
+
+    assert unmasked.mndwi.notnull().all()
+    xr.testing.assert_identical(observation_mask.where(ds), expected)
@@ -0,0 +1,284 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from pydantic_yaml import parse_yaml_file_as
+from pyproj import Transformer
+import pytest
+import xarray as xr
+from eo_tides.eo import _pixel_tides_resample
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_zeros
+
+from coastlines.clip_tide_models import compress_netcdf
+from coastlines.combined import (
+    filter_by_tides,
+    generate_yearly_composites,
+    get_year_loader,
+    mask_pixels_by_tide,
+)
+from coastlines.config import CoastlinesConfig
+from coastlines.masks import ObservationMask
+from coastlines.tide_service import TideServiceClient, serve
+from coastlines.tides import (
+    TideContext,
+    TideStore,
+    cube_pixel_tides,
+    get_lowres_geobox,
+    stored_model_tides,
+)
+
+
+@pytest.fixture()
+def ds():
+    geobox = GeoBox.from_bbox(
+        (400000, 9190000, 406000, 9196000), crs="EPSG:32750", resolution=30
+    )
+    times = pd.date_range("2020-01-01", periods=4, freq="16D")
+    water = xr_zeros(geobox, dtype="float32").expand_dims(time=times)
+    return xr.Dataset({"mndwi": water})
+
+
+@pytest.fixture()
+def tide_context(ds):
+    lowres_geobox = GeoBox.from_bbox(
+        (388000, 9178000, 418000, 9208000), crs="EPSG:32750", resolution=5000
+    )
+    tides = xr_zeros(lowres_geobox, dtype="float32").expand_dims(time=ds.time)
+    heights = np.array([-2.0, -0.1, 0.1, 2.0])[:, None, None]
+    gradient = np.linspace(0, 0.2, tides.sizes["x"])[None, None, :]
+    return TideContext(tides + heights + gradient)
+
+
+def test_highres_matches_pixel_tides_resampling(ds, tide_context):
+    expected = _pixel_tides_resample(tide_context.tides_lowres, ds.odc.geobox)
+    np.testing.assert_allclose(tide_context.highres(ds).values, expected.values)
+
+
+def test_tide_context_is_shared_after_filtering(ds, tide_context):
+    # Neither step needs the tide models, as the context already has the tides
+    filtered = filter_by_tides(
+        ds, None, 0.0, None, None, None, tide_context=tide_context
+    )
+    assert len(filtered.time) == 2
+
+    masked = mask_pixels_by_tide(
+        filtered, None, 0.0, None, None, None, tide_context=tide_context
+    )
+    assert masked.mndwi.notnull().any()
+    assert tide_context.highres(filtered).sizes["time"] == 2
+
+
+def test_chunked_tide_mask_matches_full_resolution(ds, tide_context):
+    ds = ds.chunk({"time": 1, "x": 64, "y": 64})
+    _, _, _, expected = mask_pixels_by_tide(
+        ds, None, 0.0, None, None, None, debug=True, tide_context=tide_context
+    )
+    _, tides, _, chunked = mask_pixels_by_tide(
+        ds,
+        None,
+        0.0,
+        None,
+        None,
+        None,
+        debug=True,
+        tide_context=tide_context,
+        chunked=True,
+    )
+
+    assert tides is None
+    assert chunked.chunks == ds.mndwi.chunks
+    np.testing.assert_array_equal(chunked.values, expected.values)
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_tide_mask_into_observation_mask(ds, tide_context, chunked):
+    expected = mask_pixels_by_tide(
+        ds, None, 0.0, None, None, None, tide_context=tide_context
+    )
+
+    observation_mask = ObservationMask(ds)
+    unmasked = mask_pixels_by_tide(
+        ds,
+        None,
+        0.0,
+        None,
+        None,
+        None,
+        tide_context=tide_context,
+        chunked=chunked,
+        observation_mask=observation_mask,
+    )
+
+    assert unmasked.mndwi.notnull().all()
+    xr.testing.assert_identical(observation_mask.where(ds), expected)
+
+
+def test_year_loader_masks_each_year(ds, tide_context):
+    # Put the last timestep in the next year, with the tide cutoffs unchanged
+    times = ds.time.values.copy()
+    times[-1] = np.datetime64("2021-01-05")
+    ds = ds.assign_coords(time=times)
+    ds["mndwi"] = ds.mndwi + np.arange(4, dtype="float32")[:, None, None] / 10
+    tide_context = TideContext(tide_context.tides_lowres.assign_coords(time=times))
+
+    config = parse_yaml_file_as(CoastlinesConfig, "tests/test_config.yaml")
+    config.options.mask_with_hillshade = False
+    config.options.tide_centre = 0.0
+    load_year = get_year_loader(
+        ds.chunk({"time": 1}), [], config, tide_context, logging.getLogger()
+    )
+
+    expected = mask_pixels_by_tide(
+        ds, None, 0.0, None, None, None, tide_context=tide_context
+    )
+    for year in [2020, 2021]:
+        one_year, observation_mask = load_year(year)
+        assert len(one_year.chunks) == 0
+        xr.testing.assert_identical(
+            observation_mask.where(one_year), expected.sel(time=str(year))
+        )
+
+    by_year = generate_yearly_composites(ds, 2020, 2021, load_year=load_year)
+    xr.testing.assert_allclose(by_year, generate_yearly_composites(expected, 2020, 2021))
+
+
+def test_stored_model_tides_reads_from_store(tmp_path):
+    store = TideStore(str(tmp_path / "tide_store"))
+    times = pd.date_range("2020-01-01", periods=3)
+    x, y = np.array([402500.0, 407500.0]), np.array([-807500.0, -807500.0])
+
+    config = {"crs": "EPSG:32750", "model": "EOT20"}
+    stored = pd.DataFrame(
+        {"tide_model": "EOT20", "tide_height": np.arange(6, dtype="float32")},
+        index=pd.MultiIndex.from_arrays(
+            [np.repeat(times, 2), np.tile(x, 3), np.tile(y, 3)],
+            names=["time", "x", "y"],
+        ),
+    )
+    store.put(store.key(**config), stored)
+
+    # No tide model files are needed, as every height is in the store
+    tides = stored_model_tides(x, y, times[1:], store, directory=None, **config)
+    assert len(tides) == 4
+    assert sorted(tides.tide_height) == [2, 3, 4, 5]
+
+
+def test_tide_store_compacts_blocks(tmp_path):
+    store = TideStore(str(tmp_path / "tide_store"), max_files=2)
+    key = store.key(crs="EPSG:32750", model="EOT20")
+    times = pd.date_range("2020-01-01", periods=5)
+
+    for i, time in enumerate(times):
+        store.put(
+            key,
+            pd.DataFrame(
+                {"tide_model": "EOT20", "tide_height": [float(i)]},
+                index=pd.MultiIndex.from_arrays(
+                    [[time], [402500.0], [-807500.0]], names=["time", "x", "y"]
+                ),
+            ),
+        )
+
+    assert len(list((tmp_path / "tide_store" / key).glob("*/*.parquet"))) <= 2
+    stored = store.get(key, [402500.0], [-807500.0])
+    assert sorted(stored.tide_height) == [0, 1, 2, 3, 4]
+
+
+def test_cube_pixel_tides_interpolates(ds):
+    # Tides that change linearly in space and time interpolate exactly
+    times = pd.date_range("2019-12-31", "2020-03-01", freq="1h")
+    lon = np.arange(115, 118, 0.05)
+    lat = np.arange(-6, -9, -0.05)
+    hours = (times - times[0]) / pd.Timedelta("1h")
+    heights = (
+        hours.to_numpy()[:, None, None] * 0.01
+        + lat[None, :, None] * 0.1
+        + lon[None, None, :] * 0.2
+    )
+    cube = xr.Dataset(
+        {"tide_height": (("time", "y", "x"), heights)},
+        coords={"time": times, "y": lat, "x": lon},
+    )
+
+    ds = ds.assign_coords(time=ds.time + pd.Timedelta("2h17min"))
+    tides = cube_pixel_tides(ds, cube)
+
+    lowres = get_lowres_geobox(ds.odc.geobox)
+    assert tides.odc.geobox == lowres
+
+    xx, yy = np.meshgrid(tides.x, tides.y)
+    x, y = Transformer.from_crs(lowres.crs, 4326, always_xy=True).transform(xx, yy)
+    hours = (ds.time.to_index() - times[0]) / pd.Timedelta("1h")
+    expected = hours.to_numpy()[:, None, None] * 0.01 + y * 0.1 + x * 0.2
+    np.testing.assert_allclose(tides.values, expected, rtol=1e-5)
+
+
+class ConstantTides:
+    def config(self):
+        return {"model": "EOT20", "ensemble_models": None, "ranking_points": None}
+
+    def model_tides(self, x, y, time, crs, mode="one-to-many"):
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(time, len(x)), np.tile(x, len(time)), np.tile(y, len(time))],
+            names=["time", "x", "y"],
+        )
+        return pd.DataFrame({"tide_model": "EOT20", "tide_height": 1.0}, index=index)
+
+
+def test_tide_cube_must_match_model_config(ds):
+    cube = xr.Dataset(
+        {"tide_height": (("time", "y", "x"), np.zeros((2, 2, 2)))},
+        coords={"time": ds.time.values[:2], "y": [-7.0, -8.0], "x": [116.0, 117.0]},
+    )
+    cube.attrs = {
+        "tide_model": "ensemble",
+        "model_config": json.dumps(
+            {"ensemble_models": ["FES2014", "TPXO9"], "ranking_points": None}
+        ),
+    }
+
+    with pytest.raises(ValueError, match="built with"):
+        TideContext.from_dataset(
+            ds, None, "ensemble", ensemble_model_list=["FES2014", "EOT20"], tide_cube=cube
+        )
+    with pytest.raises(ValueError, match="built with"):
+        TideContext.from_dataset(ds, None, "FES2014", tide_cube=cube)
+
+
+def test_tide_service_round_trip(tmp_path):
+    address = str(tmp_path / "tides.sock")
+    log = logging.getLogger("test")
+    threading.Thread(target=serve, args=(ConstantTides(), address, log), daemon=True).start()
+    while not os.path.exists(address):
+        time.sleep(0.01)
+
+    client = TideServiceClient(address)
+    times = pd.date_range("2020-01-01", periods=3)
+    tides = client.model_tides([1.0, 2.0], [3.0, 4.0], times, "EPSG:4326", "EOT20")
+    assert len(tides) == 6
+
+    with pytest.raises(ValueError):
+        client.model_tides([1.0], [3.0], times, "EPSG:4326", "ensemble")
+
+
+def test_compress_netcdf_keeps_values(tmp_path):
+    lat = np.arange(-10, 10, 0.125)
+    lon = np.arange(100, 130, 0.125)
+    amplitude = np.broadcast_to(np.sin(lon / 10), (len(lat), len(lon)))
+    nc = xr.Dataset(
+        {"amplitude": (("lat", "lon"), amplitude.astype("float32"))},
+        coords={"latitude": ("lat", lat), "longitude": ("lon", lon)},
+    )
+    path = tmp_path / "m2.nc"
+    nc.to_netcdf(path, format="NETCDF3_64BIT")
+    size = path.stat().st_size
+
+    assert compress_netcdf(path)
+    assert path.stat().st_size < size
+    with xr.open_dataset(path) as compressed:
+        xr.testing.assert_identical(compressed, nc)
@@ -0,0 +1,21 @@
+import click
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from coastlines.utils import subset_tiles
+
+
+def test_subset_tiles():
+    tiles = gpd.GeoDataFrame(
+        geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)], index=["0,0", "1,0"], crs=4326
+    )
+
+    assert list(subset_tiles(tiles, "[]").index) == ["0,0", "1,0"]
+    assert list(subset_tiles(tiles, '["1,0"]').index) == ["1,0"]
+
+    with pytest.raises(click.BadParameter):
+        subset_tiles(tiles, "[1,0")
+
+    with pytest.raises(click.BadParameter, match="2,0"):
+        subset_tiles(tiles, '["1,0", "2,0"]')